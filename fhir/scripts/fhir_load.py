@@ -3,16 +3,36 @@ import os
 import logging
 import glob
 import concurrent.futures
+import time
 import requests
 from requests.auth import HTTPBasicAuth
 import json
 
+from anvil.clients.transport import new_session
+
 # TODO - smilecdr throws exceptions when multiple connections (validating each request)
 
 
-CONNECTIONS = 10
+CONNECTIONS = int(os.getenv("CONNECTIONS") or 10)
 TIMEOUT = 50
 
+# resources per Bundle, 0 writes each resource with its own PUT
+BUNDLE_SIZE = int(os.getenv("BUNDLE_SIZE") or 0)
+# `batch` entries succeed or fail independently, `transaction` is all or nothing
+BUNDLE_TYPE = os.getenv("BUNDLE_TYPE") or "batch"
+# per bundle retries, sleep BACKOFF * 2^attempt seconds between attempts
+RETRIES = int(os.getenv("RETRIES") or 5)
+BACKOFF = float(os.getenv("BACKOFF") or 0.5)
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# requests (or bundles) submitted but not yet completed, bounds memory regardless of input size
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT") or CONNECTIONS * 2)
+# number of resource types loaded at the same time
+TYPE_CONNECTIONS = int(os.getenv("TYPE_CONNECTIONS") or 4)
+# keep-alive connections kept in the session pool, every loader thread gets its own
+POOL_MAXSIZE = int(os.getenv("POOL_MAXSIZE") or CONNECTIONS * TYPE_CONNECTIONS)
+# gzip request bodies (Bundles) at least this many bytes, 0 disables
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE") or 0)
+
 
 logging.basicConfig(level=logging.WARN, format='%(asctime)s %(levelname)-8s %(message)s')
 DASHBOARD_OUTPUT_PATH = "/tmp/ThousandGenomes"
@@ -28,13 +48,13 @@ FHIR_COOKIE = os.getenv("FHIR_COOKIE") or None
 
 def config():
     """Configure context used for all tests."""
-    session = requests.session()
+    session = new_session(pool_maxsize=POOL_MAXSIZE, gzip_min_size=GZIP_MIN_SIZE)
     if not FHIR_COOKIE:
         session.auth = HTTPBasicAuth(FHIR_USER, FHIR_PW)
-    session.headers = {
+    session.headers.update({
         "Content-Type": "application/fhir+json",
         "accept": "application/fhir+json;charset=utf-8"
-    }
+    })
     if FHIR_COOKIE:
         session.headers["cookie"] = f"AWSELBAuthSessionCookie-0={FHIR_COOKIE}"
 
@@ -48,7 +68,7 @@ def config():
 
 
 def put(connection, url, entity):
-    """Write entity to connection."""
+    """Write entity to connection, return status code."""
     response = connection.put(
         url=url,
         json=entity,
@@ -58,37 +78,222 @@ def put(connection, url, entity):
         response.json()
     except Exception as ex:
         logging.error(f"url:{url}\nbody:{json.dumps(entity)}\nerror: {response.text}\n{ex}")
+    return response.status_code
 
 
 def entity_reader(_config, resourceType, inputs):
-    """Read inputs, yield entity."""
-    for line in inputs.readlines():
+    """Read inputs line by line, yield entity."""
+    for line in inputs:
+        if not line.strip():
+            continue
         entity = json.loads(line)
         id = entity['id']
         url = f"{_config.base_url}{resourceType}/{id}"
         yield (url, entity, )
 
 
-def load_all_files():
-    """Load all data to the FHIR server."""
-    _config = config()
-    for resourceType in ['Practitioner', 'Organization', 'ResearchStudy', 'Patient', 'ResearchSubject', 'Specimen', 'Observation', 'DocumentReference', 'Task']:
-        path = f"{DASHBOARD_OUTPUT_PATH}/**/{resourceType}.json"
-        paths = glob.glob(path, recursive=True)
-        if len(paths) == 0:
-            print(f"Loading {resourceType} missing")
-        for path in paths:
-            with open(path, "r") as inputs:
-                print(f"Loading {path}")
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=CONNECTIONS) as executor:
-                    future_to_url = (executor.submit(put, _config.connection, url, entity) for url, entity in entity_reader(_config, resourceType, inputs))
-                    for future in concurrent.futures.as_completed(future_to_url):
-                        try:
-                            data = future.result()
-                            assert data, "Future should return result"
-                        except Exception as exc:
-                            logging.getLogger(__name__).error(f"{exc}")
+class RetryableError(Exception):
+    """Server responded with a status worth retrying."""
+
+    pass
+
+
+def bundle_reader(resourceType, inputs, bundle_size=BUNDLE_SIZE, bundle_type=BUNDLE_TYPE):
+    """Read inputs line by line, yield Bundles of at most bundle_size entries."""
+    entries = []
+    for line in inputs:
+        if not line.strip():
+            continue
+        entity = json.loads(line)
+        entries.append({
+            "resource": entity,
+            "request": {"method": "PUT", "url": f"{resourceType}/{entity['id']}"}
+        })
+        if len(entries) == bundle_size:
+            yield {"resourceType": "Bundle", "type": bundle_type, "entry": entries}
+            entries = []
+    if entries:
+        yield {"resourceType": "Bundle", "type": bundle_type, "entry": entries}
+
+
+def post_bundle(connection, base_url, bundle, retries=RETRIES, backoff=BACKOFF):
+    """Write bundle to connection, retry with exponential backoff. Return list of failed entry responses."""
+    attempt = 0
+    while True:
+        try:
+            response = connection.post(url=base_url, json=bundle, timeout=TIMEOUT)
+            if response.status_code in RETRY_STATUS_CODES:
+                raise RetryableError(f"status:{response.status_code} {response.text}")
+            assert response.ok, f"bundle of {len(bundle['entry'])}\nerror: {response.text}"
+            break
+        except (RetryableError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+            if attempt >= retries:
+                raise
+            logging.getLogger(__name__).warning(f"retrying bundle of {len(bundle['entry'])} attempt {attempt + 1} {ex}")
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+    # batch entries succeed or fail individually
+    return [
+        entry.get('response', {}) for entry in response.json().get('entry', [])
+        if not entry.get('response', {}).get('status', '').startswith('2')
+    ]
+
+
+def submit_bounded(executor, fn, items, max_in_flight):
+    """Submit fn(item) for each item, never holding more than max_in_flight futures. Yield futures as they complete."""
+    in_flight = set()
+    for item in items:
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from done
+        in_flight.add(executor.submit(fn, item))
+    for future in concurrent.futures.as_completed(in_flight):
+        yield future
+
+
+def load_resources(_config, resourceType, inputs, connections=CONNECTIONS, max_in_flight=MAX_IN_FLIGHT):
+    """PUT each resource in inputs, at most max_in_flight requests outstanding. Return (written, failed) counts."""
+    written = failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        def _put(url_entity):
+            """Put entity, return True if written."""
+            url, entity = url_entity
+            try:
+                return put(_config.connection, url, entity) is not None
+            except Exception as exc:
+                logging.getLogger(__name__).error(f"{exc}")
+                return False
+
+        for future in submit_bounded(executor, _put, entity_reader(_config, resourceType, inputs), max_in_flight):
+            if future.result():
+                written += 1
+            else:
+                failed += 1
+    return written, failed
+
+
+def load_bundles(_config, resourceType, inputs, bundle_size=BUNDLE_SIZE, bundle_type=BUNDLE_TYPE, connections=CONNECTIONS, retries=RETRIES, backoff=BACKOFF):
+    """Write inputs as Bundles, at most MAX_IN_FLIGHT bundles outstanding. Return (written, failed) entry counts."""
+    written = failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        def _post(bundle):
+            """Post bundle, all entries fail if the bundle fails."""
+            try:
+                return len(bundle['entry']), post_bundle(_config.connection, _config.base_url, bundle, retries, backoff)
+            except Exception as exc:
+                return len(bundle['entry']), [{'status': 'error', 'outcome': f"{exc}"}] * len(bundle['entry'])
+
+        bundles = bundle_reader(resourceType, inputs, bundle_size, bundle_type)
+        for future in submit_bounded(executor, _post, bundles, max(MAX_IN_FLIGHT, connections)):
+            entry_count, failures = future.result()
+            for failure in failures[:1]:
+                logging.getLogger(__name__).error(f"{resourceType} {len(failures)} failed {failure}")
+            written += entry_count - len(failures)
+            failed += len(failures)
+    return written, failed
+
+
+# reference dependencies between the resource types FhirTransformer emits, keyed by file name
+# a type is loaded once all of the types it references are committed
+# Task.output references the DocumentReferences (and Task.input/focus the Specimen), so Task is loaded after them.
+# The transformer also writes a context.related reference to the Task into each DocumentReference (see
+# SpecimenTask.build_entity); that back reference is deliberately not modeled here, it would be a cycle
+RESOURCE_DEPENDENCIES = {
+    'Practitioner': [],
+    'Organization': [],
+    'PractitionerRole': ['Practitioner', 'Organization'],
+    'ResearchStudy': ['Organization', 'Practitioner'],
+    'ResearchStudyObservation': ['ResearchStudy'],
+    'Patient': ['Organization'],
+    'ResearchSubject': ['ResearchStudy', 'Patient'],
+    'Specimen': ['Patient'],
+    'Observation': ['Patient'],
+    'DocumentReference': ['Organization', 'Patient'],
+    'Task': ['Specimen', 'Patient', 'Organization', 'DocumentReference'],
+}
+# file names that differ from the resourceType they contain
+FILE_RESOURCE_TYPES = {
+    'ResearchStudyObservation': 'Observation',
+}
+
+
+def schedule(dependencies, fn, max_workers=TYPE_CONNECTIONS):
+    """Call fn(name) for each name in dependencies once all the names it depends on have completed.
+
+    Independent names run concurrently. If fn raises, names that depend on it are skipped.
+    Return dict of name: fn's result (or the exception).
+    """
+    for name, depends_on in dependencies.items():
+        for d in depends_on:
+            assert d in dependencies, f"{name} depends on unknown {d}"
+    results = {}
+    pending = dict(dependencies)
+    failed = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            ready = True
+            while ready:
+                ready = [n for n, depends_on in pending.items() if not set(depends_on) - set(results)]
+                for name in ready:
+                    del pending[name]
+                    if set(dependencies[name]) & failed:
+                        logging.getLogger(__name__).error(f"Skipping {name}, depends on failed {set(dependencies[name]) & failed}")
+                        failed.add(name)
+                        results[name] = None
+                        continue
+                    running[executor.submit(fn, name)] = name
+            if not running:
+                assert not pending, f"Dependency cycle in {list(pending)}"
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as exc:
+                    logging.getLogger(__name__).error(f"{name} {exc}")
+                    failed.add(name)
+                    results[name] = exc
+    return results
+
+
+def file_lines(paths):
+    """Yield lines of all paths, one file open at a time."""
+    for path in paths:
+        with open(path, "r") as inputs:
+            print(f"Loading {path}")
+            yield from inputs
+
+
+def load_type(_config, name, output_path=DASHBOARD_OUTPUT_PATH):
+    """Load all files for name. Return dict with written, failed, elapsed and per second throughput."""
+    resourceType = FILE_RESOURCE_TYPES.get(name, name)
+    paths = glob.glob(f"{output_path}/**/{name}.json", recursive=True)
+    if len(paths) == 0:
+        print(f"Loading {name} missing")
+    start = time.time()
+    if BUNDLE_SIZE > 0:
+        written, failed = load_bundles(_config, resourceType, file_lines(paths))
+    else:
+        written, failed = load_resources(_config, resourceType, file_lines(paths))
+    elapsed = time.time() - start
+    stats = {'written': written, 'failed': failed, 'elapsed': elapsed, 'per_second': written / elapsed if elapsed else 0}
+    print(f"Loaded {name} written:{written} failed:{failed} in {elapsed:.1f}s ({stats['per_second']:.1f}/s)")
+    return stats
+
+
+def load_all_files(output_path=DASHBOARD_OUTPUT_PATH, dependencies=RESOURCE_DEPENDENCIES, _config=None):
+    """Load all data to the FHIR server, resource types in dependency order."""
+    _config = _config or config()
+    results = schedule(dependencies, lambda name: load_type(_config, name, output_path))
+    print(f"{'type':<26}{'written':>10}{'failed':>10}{'seconds':>10}{'per sec':>10}")
+    for name, stats in results.items():
+        if not isinstance(stats, dict):
+            print(f"{name:<26}{'not loaded':>40}")
+            continue
+        print(f"{name:<26}{stats['written']:>10}{stats['failed']:>10}{stats['elapsed']:>10.1f}{stats['per_second']:>10.1f}")
+    return results
 
 
 def get(connection, url):
@@ -114,5 +319,6 @@ def read_all(resourceTypes):
 
 
 # TODO - add cli handler
-load_all_files()
-# read_all(['ResearchStudy'])
+if __name__ == '__main__':
+    load_all_files()
+    # read_all(['ResearchStudy'])
@@ -1,10 +1,11 @@
 """Extract all workspaces."""
 import os
 import logging
-import requests
 from requests.auth import HTTPBasicAuth
 import json
 
+from anvil.clients.transport import new_session
+
 # TODO - smilecdr throws exceptions when multiple connections (validating each request)
 
 
@@ -30,13 +31,13 @@ FHIR_COOKIE = os.getenv("FHIR_COOKIE") or None
 
 def config():
     """Configure context used for all tests."""
-    session = requests.session()
+    session = new_session(pool_maxsize=CONNECTIONS)
     if not FHIR_COOKIE:
         session.auth = HTTPBasicAuth(FHIR_USER, FHIR_PW)
-    session.headers = {
+    session.headers.update({
         "Content-Type": "application/fhir+json",
         "accept": "application/fhir+json;charset=utf-8"
-    }
+    })
     if FHIR_COOKIE:
         session.headers["cookie"] = f"AWSELBAuthSessionCookie-0={FHIR_COOKIE}"
 
@@ -7,6 +7,8 @@ import requests
 import glob
 from requests.auth import HTTPBasicAuth
 import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
 
@@ -191,3 +193,115 @@ def load_configurations(config, extensions, profiles, examples, codesystems, val
             config_resource_urls.append(url)
 
     return config_resource_urls
+
+
+class StubFHIRServer(ThreadingHTTPServer):
+    """Minimal HAPI-like FHIR server, keeps resources in memory.
+
+    Supports `PUT /<type>/<id>`, `GET /<type>/<id>` and batch/transaction Bundles posted to `/`.
+    Set `fail_next` to answer the next n requests with a 503, `latency` to delay every response.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        """Bind to a free port."""
+        super().__init__(('127.0.0.1', 0), StubFHIRHandler)
+        self.resources = {}
+        self.requests = []
+        self.fail_next = 0
+        self.latency = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        """Url of the server root, with trailing slash."""
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def write(self, resourceType, id, resource):
+        """Save a resource, return status code."""
+        if not resource.get('id', None) or resource.get('resourceType', None) != resourceType or resource['id'] != id:
+            return 400
+        with self.lock:
+            status = 200 if (resourceType, id) in self.resources else 201
+            self.resources[(resourceType, id)] = resource
+        return status
+
+
+class StubFHIRHandler(BaseHTTPRequestHandler):
+    """Handle requests for StubFHIRServer."""
+
+    def log_message(self, format, *args):
+        """Quiet."""
+        pass
+
+    def _reply(self, status, body=None):
+        content = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read(self):
+        return json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def _fail(self):
+        """Record the request, return True if this request should fail."""
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests.append((self.command, self.path))
+            if server.fail_next > 0:
+                server.fail_next -= 1
+                return True
+        return False
+
+    def do_GET(self):
+        """Read a resource."""
+        if self._fail():
+            return self._reply(503)
+        resourceType, id = self.path.strip('/').split('/')[:2]
+        resource = self.server.resources.get((resourceType, id), None)
+        if resource is None:
+            return self._reply(404, {'resourceType': 'OperationOutcome'})
+        self._reply(200, resource)
+
+    def do_PUT(self):
+        """Update or create a resource."""
+        if self._fail():
+            return self._reply(503)
+        resourceType, id = self.path.strip('/').split('/')[:2]
+        resource = self._read()
+        status = self.server.write(resourceType, id, resource)
+        self._reply(status, resource if status < 300 else {'resourceType': 'OperationOutcome'})
+
+    def do_POST(self):
+        """Process a batch or transaction Bundle."""
+        if self._fail():
+            return self._reply(503)
+        bundle = self._read()
+        entries = bundle.get('entry', [])
+        if bundle['type'] == 'transaction':
+            # all or nothing
+            for entry in entries:
+                resource = entry['resource']
+                if not resource.get('id', None) or entry['request']['url'] != f"{resource['resourceType']}/{resource['id']}":
+                    return self._reply(400, {'resourceType': 'OperationOutcome'})
+        responses = []
+        for entry in entries:
+            resourceType, id = entry['request']['url'].split('/')[:2]
+            status = self.server.write(resourceType, id, entry['resource'])
+            responses.append({'response': {'status': f"{status} {'OK' if status < 300 else 'Bad Request'}"}})
+        self._reply(200, {'resourceType': 'Bundle', 'type': f"{bundle['type']}-response", 'entry': responses})
+
+
+@pytest.fixture
+def fhir_stub():
+    """Run a StubFHIRServer for the duration of a test."""
+    server = StubFHIRServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
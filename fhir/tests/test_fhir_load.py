@@ -0,0 +1,142 @@
+"""Test fhir_load against a local stub server."""
+
+import io
+import json
+import os
+import sys
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts'))
+import fhir_load  # noqa: E402
+
+
+class StubConfig:
+    """Store config in class."""
+
+    def __init__(self, base_url):
+        """Point at stub."""
+        self.base_url = base_url
+        self.connection = requests.session()
+        self.connection.headers = {"Content-Type": "application/fhir+json"}
+
+
+def ndjson(resourceType, count, start=0):
+    """Create file like object, one resource per line."""
+    return io.StringIO(''.join(json.dumps({'resourceType': resourceType, 'id': f"id-{i}"}) + '\n' for i in range(start, start + count)))
+
+
+def test_bundle_reader():
+    """Should group lines into bundles."""
+    bundles = list(fhir_load.bundle_reader('Patient', ndjson('Patient', 25), bundle_size=10, bundle_type='transaction'))
+    assert [len(b['entry']) for b in bundles] == [10, 10, 5]
+    assert bundles[0]['type'] == 'transaction'
+    assert bundles[0]['entry'][0]['request'] == {'method': 'PUT', 'url': 'Patient/id-0'}
+
+
+def test_load_bundles(fhir_stub):
+    """Should write all resources with one POST per bundle."""
+    written, failed = fhir_load.load_bundles(StubConfig(fhir_stub.base_url), 'Patient', ndjson('Patient', 95), bundle_size=10, connections=3)
+    assert (written, failed) == (95, 0)
+    assert len(fhir_stub.resources) == 95
+    assert len([r for r in fhir_stub.requests if r[0] == 'POST']) == 10
+
+
+def test_load_bundles_retry(fhir_stub):
+    """Should retry bundles after transient errors."""
+    fhir_stub.fail_next = 3
+    written, failed = fhir_load.load_bundles(StubConfig(fhir_stub.base_url), 'Specimen', ndjson('Specimen', 20), bundle_size=5, connections=1, backoff=0.01)
+    assert (written, failed) == (20, 0)
+    assert len(fhir_stub.requests) == 4 + 3
+
+
+def test_load_bundles_entry_failures(fhir_stub):
+    """Should count failed batch entries."""
+    inputs = io.StringIO(ndjson('Patient', 4).getvalue() + json.dumps({'resourceType': 'Specimen', 'id': 'x'}) + '\n')
+    written, failed = fhir_load.load_bundles(StubConfig(fhir_stub.base_url), 'Patient', inputs, bundle_size=10, bundle_type='batch')
+    assert (written, failed) == (4, 1)
+
+
+def test_load_bundles_gives_up(fhir_stub):
+    """Should report bundles that exhaust their retries as failed."""
+    fhir_stub.fail_next = 100
+    written, failed = fhir_load.load_bundles(StubConfig(fhir_stub.base_url), 'Specimen', ndjson('Specimen', 7), bundle_size=5, connections=1, retries=2, backoff=0.01)
+    assert (written, failed) == (0, 7)
+
+
+def test_schedule():
+    """Should start types once their dependencies complete, skip dependents of failures."""
+    import threading
+    import time
+    started = {}
+    lock = threading.Lock()
+
+    def fn(name):
+        with lock:
+            started[name] = len(started)
+        time.sleep(0.05)
+        if name == 'Specimen':
+            raise Exception('boom')
+        return name
+
+    results = fhir_load.schedule(fhir_load.RESOURCE_DEPENDENCIES, fn, max_workers=4)
+    for name, depends_on in fhir_load.RESOURCE_DEPENDENCIES.items():
+        if name == 'Task':
+            continue
+        for d in depends_on:
+            assert started[d] < started[name], f"{d} should start before {name}"
+    assert 'Task' not in started, "Task depends on failed Specimen"
+    assert results['Task'] is None
+    assert results['Patient'] == 'Patient'
+    # independent types overlap
+    assert {started['Practitioner'], started['Organization']} == {0, 1}
+
+
+def test_load_all_files(fhir_stub, tmp_path):
+    """Should load every file, report throughput per type."""
+    for workspace in ['w1', 'w2']:
+        for name in fhir_load.RESOURCE_DEPENDENCIES:
+            path = tmp_path / 'CMG' / workspace / 'protected'
+            path.mkdir(parents=True, exist_ok=True)
+            resourceType = fhir_load.FILE_RESOURCE_TYPES.get(name, name)
+            (path / f"{name}.json").write_text(
+                ''.join(json.dumps({'resourceType': resourceType, 'id': f"{workspace}-{name}-{i}"}) + '\n' for i in range(3))
+            )
+    results = fhir_load.load_all_files(str(tmp_path), _config=StubConfig(fhir_stub.base_url))
+    assert len(fhir_stub.resources) == 2 * 3 * len(fhir_load.RESOURCE_DEPENDENCIES)
+    for name, stats in results.items():
+        assert stats['written'] == 6, name
+        assert stats['failed'] == 0, name
+
+
+def test_submit_bounded():
+    """Should never read more than max_in_flight items ahead of completions."""
+    import concurrent.futures
+    import threading
+    lock = threading.Lock()
+    counts = {'read': 0, 'done': 0, 'max_ahead': 0}
+
+    def items():
+        for i in range(100):
+            with lock:
+                counts['read'] += 1
+                counts['max_ahead'] = max(counts['max_ahead'], counts['read'] - counts['done'])
+            yield i
+
+    def fn(i):
+        with lock:
+            counts['done'] += 1
+        return i
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = sorted(f.result() for f in fhir_load.submit_bounded(executor, fn, items(), 5))
+    assert results == list(range(100))
+    assert counts['max_ahead'] <= 6
+
+
+def test_load_resources(fhir_stub):
+    """Should PUT every resource, count successes and failures."""
+    inputs = io.StringIO(ndjson('Patient', 30).getvalue() + '\n' + json.dumps({'resourceType': 'Specimen', 'id': 'x'}) + '\n')
+    written, failed = fhir_load.load_resources(StubConfig(fhir_stub.base_url), 'Patient', inputs, connections=4, max_in_flight=8)
+    assert (written, failed) == (30, 1)
+    assert len(fhir_stub.resources) == 30
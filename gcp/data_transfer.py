@@ -7,6 +7,8 @@ import os
 
 from dotenv import load_dotenv
 
+from anvil.clients.healthcare_import import HealthcareImporter
+
 # env constants
 load_dotenv()
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID", "")
@@ -17,7 +19,8 @@ GCP_JSON_BUCKET = os.getenv("GCP_JSON_BUCKET", "")
 SA_NAME = os.getenv("SA_NAME", "")
 
 
-def main():
+def main(gcs_uri=None):
+    """Import gcs_uri (default the whole GCP_JSON_BUCKET) into GCP_DATASTORE"""
     # error checking
     try:
         checkEnv()
@@ -37,18 +40,26 @@ def main():
     except Exception as err:
         raise Exception(f"500 Internal Server Error: {err}")
 
-    # make gsutil call
+    # import in process, wait for the long running operation
     try:
-        gsutil_cmd = f"gcloud healthcare fhir-stores import gcs {GCP_DATASTORE} --project={GCP_PROJECT_ID} --location={GCP_LOCATION} --dataset={GCP_DATASET} --gcs-uri=gs://{GCP_JSON_BUCKET} --content-structure=resource"
-        print(f"CMD: {gsutil_cmd}")
-        process = subprocess.Popen(gsutil_cmd.split(), stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        print(f"OUTPUT: {output}")
-
-        if error:
-            raise Exception(f"500 Internal Server Error: {error}")
+        jobs = transfer([(GCP_DATASTORE, gcs_uri or f"gs://{GCP_JSON_BUCKET}")])
     except Exception as err:
         raise Exception(f"500 Internal Server Error: {err}")
+    errors = [job for job in jobs if job.error]
+    if errors:
+        raise Exception(f"500 Internal Server Error: {errors}")
+
+
+def transfer(imports, importer=None):
+    """Import (data_store, gcs_uri) pairs, concurrently per data store; print per store throughput.
+
+    Pass an importer (e.g. pointed at a local stub) to override the Healthcare API transport.
+    """
+    importer = importer or HealthcareImporter(GCP_PROJECT_ID, GCP_LOCATION, GCP_DATASET)
+    jobs = importer.import_all(imports)
+    for row in importer.report(jobs):
+        print(f"IMPORTED: {row}")
+    return jobs
 
 
 def checkEnv():
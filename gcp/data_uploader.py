@@ -1,9 +1,18 @@
 """
 Upload files form OUTPUT_PATH to GCP_JSON_BUCKET
+- uploads run in parallel, large files use chunked resumable uploads
+- objects whose CRC32C matches the local file are skipped, so re-runs into the same prefix only upload what changed;
+  main.py uploads every generation of a PFB to the same prefix, replacing the objects of the previous one
+- set STORAGE_EMULATOR_HOST to run against a local fake-GCS emulator
 """
 
+import base64
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import google_crc32c
 from google.cloud import storage
 
 from dotenv import load_dotenv
@@ -12,27 +21,110 @@ from dotenv import load_dotenv
 load_dotenv()
 GCP_JSON_BUCKET = os.getenv("GCP_JSON_BUCKET")
 OUTPUT_PATH = os.getenv("OUTPUT_PATH", "./data")
+# optional, only upload these files: transform-changes.json style {"files": [...]} or one path per line
+UPLOAD_MANIFEST = os.getenv("UPLOAD_MANIFEST")
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+# files larger than this are uploaded in resumable chunks (must be a multiple of 256KB)
+RESUMABLE_THRESHOLD = int(os.getenv("RESUMABLE_THRESHOLD", str(8 * 1024 * 1024)))
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", str(8 * 1024 * 1024)))
+STORAGE_EMULATOR_HOST = os.getenv("STORAGE_EMULATOR_HOST")
 
 
-def main():
+def main(bucket=None, output_path=OUTPUT_PATH, prefix="", replace=False):
+    """Upload output_path, objects are named prefix/filename when prefix is set
+
+    With replace, objects under prefix that are not in output_path (e.g. left by an earlier upload) are deleted
+    """
     # error checking
-    if not GCP_JSON_BUCKET:
+    if not GCP_JSON_BUCKET and not bucket:
         err = "no GCP_JSON_BUCKET in .env"
         raise Exception(f"501 Not Implemented: {err}")
 
     # create cloud storage client
-    client = storage.Client()
-    bucket = client.get_bucket(GCP_JSON_BUCKET)
+    bucket = bucket or get_bucket(GCP_JSON_BUCKET)
 
-    # upload each .ndjson in OUTPUT_PATH
+    # upload each .ndjson in OUTPUT_PATH (or the manifest)
     try:
-        for filename in os.listdir(OUTPUT_PATH):
-            local_path = os.path.join(OUTPUT_PATH, filename)
-            blob = bucket.blob(filename)
-            blob.upload_from_filename(local_path)
-            print(f"Uploaded {local_path} to {filename}!")
+        filenames = read_manifest(UPLOAD_MANIFEST, output_path) if UPLOAD_MANIFEST else list_files(output_path)
+        results = upload_all(bucket, filenames, output_path, prefix)
+        if replace and prefix:
+            delete_stale(bucket, prefix, [r["name"] for r in results])
     except Exception as err:
         raise Exception(f"500 Internal Server Error: {err}")
+    uploaded = [r for r in results if r["status"] == "uploaded"]
+    print(f"Uploaded {len(uploaded)} files {sum(r['size'] for r in uploaded)} bytes, skipped {len(results) - len(uploaded)} unchanged files")
+    return results
+
+
+def get_bucket(bucket_name):
+    """Return bucket, uses anonymous credentials when STORAGE_EMULATOR_HOST is set."""
+    if STORAGE_EMULATOR_HOST:
+        from google.auth.credentials import AnonymousCredentials
+        client = storage.Client(project="emulator", credentials=AnonymousCredentials())
+    else:
+        client = storage.Client()
+    return client.bucket(bucket_name)
+
+
+def list_files(path):
+    """Return names of files in path."""
+    return sorted(f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)))
+
+
+def read_manifest(manifest_path, output_path=OUTPUT_PATH):
+    """Return file names from a changes manifest, relative to output_path."""
+    with open(manifest_path) as inputs:
+        text = inputs.read()
+    try:
+        paths = json.loads(text)["files"]
+    except (ValueError, KeyError, TypeError):
+        paths = [line.strip() for line in text.splitlines() if line.strip()]
+    output_path = os.path.abspath(output_path)
+    return sorted(
+        os.path.relpath(os.path.abspath(os.path.join(output_path, p)), output_path) for p in paths
+    )
+
+
+def crc32c(local_path):
+    """Return base64 CRC32C of file, the format GCS reports in blob.crc32c."""
+    checksum = google_crc32c.Checksum()
+    with open(local_path, "rb") as inputs:
+        for chunk in iter(lambda: inputs.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def upload(bucket, filename, output_path=OUTPUT_PATH, prefix=""):
+    """Upload output_path/filename unless an identical object exists."""
+    local_path = os.path.join(output_path, filename)
+    name = f"{prefix}/{filename}" if prefix else filename
+    size = os.path.getsize(local_path)
+    local_crc32c = crc32c(local_path)
+    existing = bucket.get_blob(name)
+    if existing is not None and existing.crc32c == local_crc32c:
+        return {"name": name, "status": "skipped", "size": size, "seconds": 0}
+    start = time.time()
+    # resumable uploads retry failed chunks instead of the whole file
+    blob = bucket.blob(name, chunk_size=CHUNK_SIZE if size > RESUMABLE_THRESHOLD else None)
+    blob.upload_from_filename(local_path, checksum="crc32c")
+    print(f"Uploaded {local_path} to {name}!")
+    return {"name": name, "status": "uploaded", "size": size, "seconds": time.time() - start}
+
+
+def delete_stale(bucket, prefix, names):
+    """Delete objects under prefix not in names, return their names."""
+    names = set(names)
+    stale = [blob for blob in bucket.list_blobs(prefix=f"{prefix}/") if blob.name not in names]
+    for blob in stale:
+        blob.delete()
+        print(f"Deleted stale {blob.name}")
+    return [blob.name for blob in stale]
+
+
+def upload_all(bucket, filenames, output_path=OUTPUT_PATH, prefix="", workers=UPLOAD_WORKERS):
+    """Upload files in parallel, return a result per file."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda filename: upload(bucket, filename, output_path, prefix), filenames))
 
 
 if __name__ == "__main__":
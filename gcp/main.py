@@ -1,22 +1,26 @@
 """
 Handles PubSub requests sent to the container
 - This performs all ETL operations and transfers to Healthcare API
+- PFBs move through a staged pipeline (see pipeline.py), so one PFB can be extracted while the next downloads
 """
 
-import threading
+import hashlib
 import os
+import shutil
 
 # debugger imports
 # from . import pfb_downloader
 # from . import pfb_extractor
 # from . import data_uploader
 # from . import data_transfer
+# from .pipeline import Pipeline
 
 # production imports
 import pfb_downloader
 import pfb_extractor
 import data_uploader
 import data_transfer
+from pipeline import Pipeline
 
 from flask import Flask, request
 
@@ -24,9 +28,105 @@ from dotenv import load_dotenv
 
 # env constants
 load_dotenv()
+GCP_JSON_BUCKET = os.getenv("GCP_JSON_BUCKET", "")
+# each PFB is downloaded and extracted in its own directory
+WORK_PATH = os.getenv("WORK_PATH", "./work")
+# PFBs waiting between stages
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "2"))
+# completed PFBs remembered to ignore redeliveries
+PIPELINE_MAX_COMPLETED = int(os.getenv("PIPELINE_MAX_COMPLETED", "1000"))
+PIPELINE_DOWNLOAD_WORKERS = int(os.getenv("PIPELINE_DOWNLOAD_WORKERS", "2"))
+# extract the PFB while it downloads, rather than after
+STREAM_PFB = os.getenv("STREAM_PFB", "false").lower() == "true"
+# keep a local copy of a streamed PFB, to retry extraction without downloading again
+PFB_SPILL = os.getenv("PFB_SPILL", "true").lower() == "true"
+
+
+def workdir(job):
+    """Set the job's working directory, PFB and ndjson paths."""
+    job.context["workdir"] = os.path.join(
+        WORK_PATH, hashlib.sha256(job.key.encode("utf-8")).hexdigest()[:16]
+    )
+    os.makedirs(job.context["workdir"], exist_ok=True)
+    job.context["avro_path"] = os.path.join(job.context["workdir"], "export.avro")
+    job.context["output_path"] = os.path.join(job.context["workdir"], "data")
+    # the same for every upload of this PFB, so each upload replaces the previous one's gen3 nodes
+    job.context["source"] = pfb_downloader.message_source(
+        pfb_downloader.parse_message(job.payload)
+    )
+
+
+def download(job):
+    """Download the PFB into the job's workdir."""
+    workdir(job)
+    pfb_downloader.main(job.payload, avro_path=job.context["avro_path"])
+
+
+def extract(job, stream=None):
+    """Extract the PFB (or stream) into ndjson."""
+    pfb_extractor.main(
+        avro_path=job.context["avro_path"],
+        output_path=job.context["output_path"],
+        stream=stream,
+        source=job.context["source"],
+    )
+
+
+def ingest(job):
+    """Download and extract at the same time, fall back to the spilled (or a fresh) download on error."""
+    workdir(job)
+    avro_path = job.context["avro_path"]
+    try:
+        with pfb_downloader.open_stream(
+            job.payload, spill_path=avro_path if PFB_SPILL else None
+        ) as stream:
+            extract(job, stream=stream)
+    except Exception as err:
+        print(f"[Retry] streaming extract failed: {err}")
+        if not os.path.isfile(avro_path):
+            pfb_downloader.main(job.payload, avro_path=avro_path)
+        extract(job)
+
+
+def upload(job):
+    """Upload the job's ndjson to GCP_JSON_BUCKET."""
+    # each PFB's ndjson lands under its own prefix, so transfers don't import each other's files; the prefix is the
+    # same for every generation of the PFB, unchanged files are skipped and files the new generation lacks deleted;
+    # a generation uploaded while the previous one is still transferring is imported again by its own transfer
+    job.context["prefix"] = hashlib.sha256(
+        job.context["source"].encode("utf-8")
+    ).hexdigest()[:16]
+    data_uploader.main(
+        output_path=job.context["output_path"],
+        prefix=job.context["prefix"],
+        replace=True,
+    )
+
+
+def transfer(job):
+    """Import the job's uploaded ndjson into the Healthcare API."""
+    data_transfer.main(gcs_uri=f"gs://{GCP_JSON_BUCKET}/{job.context['prefix']}/*")
+
+
+def cleanup(job):
+    """Log the outcome and remove the job's workdir."""
+    print(f"[{'Error' if job.error else 'Successful'}]: {job.key} timings: {job.timings}")
+    if "workdir" in job.context:
+        shutil.rmtree(job.context["workdir"], ignore_errors=True)
+
+
+# extract keeps module state (pfb_extractor.gen3_entities) and imports to a store must not overlap, so one worker each
+STAGES = [
+    ("download", download, PIPELINE_DOWNLOAD_WORKERS),
+    ("extract", extract, 1),
+    ("upload", upload, 1),
+    ("transfer", transfer, 1),
+]
+if STREAM_PFB:
+    STAGES = [("ingest", ingest, 1)] + STAGES[2:]
 
 app = Flask(__name__)
-sem = threading.Semaphore()
+pipeline = Pipeline(STAGES, queue_size=PIPELINE_QUEUE_SIZE, on_done=cleanup, max_completed=PIPELINE_MAX_COMPLETED)
 
 
 @app.route("/", methods=["POST"])
@@ -35,9 +135,6 @@ def index():
 
     Note: We send 202 for error messages to ack PubSub, else it infinitely loops
     """
-    # grabs semaphore
-    sem.acquire()
-
     # gets the pubsub message
     envelope = request.get_json()
 
@@ -45,52 +142,37 @@ def index():
     if not envelope:
         err = "no PubSub message received"
         print(f"[Error] 400 Bad Request: {err}")
-        sem.release()
         return f"[Error] 400 Bad Request: {err}", 400
     if not isinstance(envelope, dict) or "message" not in envelope:
         err = "invalid PubSub message format"
         print(f"[Error] 400 Bad Request: {err}")
-        sem.release()
         return f"[Error] 400 Bad Request: {err}", 400
 
-    # download PFB
+    # check the notification before queueing it
     try:
-        pfb_downloader.main(envelope)
+        key = pfb_downloader.message_key(pfb_downloader.parse_message(envelope))
     except Exception as err:
         print(f"[Error] {err}")
-        sem.release()
         return f"[Error] {err}", 202
 
-    # extract PFB
-    try:
-        pfb_extractor.main()
-    except Exception as err:
-        print(f"[Error] {err}")
-        sem.release()
-        return f"[Error] {err}", 202
+    # repeated deliveries of the same object generation wait for (or reuse) the first delivery's job
+    job, is_new = pipeline.run(key, envelope)
+    if not is_new:
+        print(f"[Duplicate]: {key} already processed")
+    if job.error:
+        print(f"[Error] {job.error}")
+        return f"[Error] {job.error}", 202
 
-    # upload ndjson
-    try:
-        data_uploader.main()
-    except Exception as err:
-        print(f"[Error] {err}")
-        sem.release()
-        return f"[Error] {err}", 202
-
-    # transfer ndjson to healthcare API
-    try:
-        data_transfer.main()
-    except Exception as err:
-        print(f"[Error] {err}")
-        sem.release()
-        return f"[Error] {err}", 202
-
-    # release semaphore after successful run
     print("[Successful]: files processed without errors")
-    sem.release()
     return "[Successful]: files processed without errors", 200
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Return per stage job counts and timings."""
+    return pipeline.metrics(), 200
+
+
 if __name__ == "__main__":
     app.run(
         debug=True, host="127.0.0.1", port=int(os.environ.get("PORT", 8080))
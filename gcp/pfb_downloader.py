@@ -6,6 +6,8 @@ import base64
 import json
 import os
 
+from anvil.util.stream import PrefetchReader
+
 from google.cloud import storage
 
 from dotenv import load_dotenv
@@ -13,14 +15,12 @@ from dotenv import load_dotenv
 # env constants
 load_dotenv()
 GCP_PFB_BUCKET = os.getenv("GCP_PFB_BUCKET", "")
+# bytes per ranged GET when streaming
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(8 * 1024 * 1024)))
 
 
-def main(envelope):
-    # error checking
-    if not GCP_PFB_BUCKET:
-        err = "no GCP_PFB_BUCKET in .env"
-        raise Exception(f"501 Not Implemented: {err}")
-
+def parse_message(envelope):
+    """Return the storage object notification in a PubSub envelope, must be a finalized .avro"""
     # extract message data
     pubsub_message = envelope["message"]
     message = ""
@@ -42,6 +42,27 @@ def main(envelope):
     if not avro_file.endswith(".avro"):
         err = "uploaded file not .avro"
         raise Exception(f"412 Precondition Failed: {err}")
+    return message
+
+
+def message_source(message):
+    """Return bucket/name, identifies a PFB across its uploads"""
+    bucket = message.get("bucket", GCP_PFB_BUCKET)
+    return f"{bucket}/{message['name']}"
+
+
+def message_key(message):
+    """Return bucket/name#generation, identifies one upload of a PFB"""
+    return f"{message_source(message)}#{message.get('generation', '')}"
+
+
+def main(envelope, avro_path="export.avro"):
+    # error checking
+    if not GCP_PFB_BUCKET:
+        err = "no GCP_PFB_BUCKET in .env"
+        raise Exception(f"501 Not Implemented: {err}")
+
+    avro_file = parse_message(envelope)["name"]
 
     # download avro
     try:
@@ -49,7 +70,7 @@ def main(envelope):
         storage_client = storage.Client.from_service_account_json("creds.json")
 
         print(f"Downloading {avro_file}...")
-        with open("export.avro", "w+b") as export_file:
+        with open(avro_path, "w+b") as export_file:
             storage_client.download_blob_to_file(
                 f"gs://{GCP_PFB_BUCKET}/{avro_file}", export_file
             )
@@ -59,5 +80,29 @@ def main(envelope):
         raise Exception(f"500 Internal Server Error: {err}")
 
 
+def open_stream(envelope, spill_path=None):
+    """Return a file like stream of the PFB, read ahead in the background while the caller parses it
+
+    If spill_path is set, the download is also saved there once complete, so a failed extraction can be retried without downloading again
+    """
+    # error checking
+    if not GCP_PFB_BUCKET:
+        err = "no GCP_PFB_BUCKET in .env"
+        raise Exception(f"501 Not Implemented: {err}")
+
+    avro_file = parse_message(envelope)["name"]
+    try:
+        storage_client = storage.Client.from_service_account_json("creds.json")
+        blob = storage_client.bucket(GCP_PFB_BUCKET).blob(avro_file)
+        print(f"Streaming {avro_file}...")
+        return PrefetchReader(
+            blob.open("rb", chunk_size=STREAM_CHUNK_SIZE),
+            spill_path=spill_path,
+            chunk_size=STREAM_CHUNK_SIZE,
+        )
+    except Exception as err:
+        raise Exception(f"500 Internal Server Error: {err}")
+
+
 if __name__ == "__main__":
     main()
@@ -26,15 +26,18 @@ GCP_DATASET = os.getenv("GCP_DATASET", "")
 GCP_DATASTORE = os.getenv("GCP_DATASTORE", "")
 GCP_JSON_BUCKET = os.getenv("GCP_JSON_BUCKET", "")
 SA_NAME = os.getenv("SA_NAME", "")
+# gen3 nodes of every PFB loaded so far, kept between PFBs so a new upload only applies its differences
+GEN3_DRS_PATH = os.getenv("GEN3_DRS_PATH", "./gen3-drs.sqlite")
 
 
 def reconcile_all(
     user_project,
     consortiums,
     namespace=DEFAULT_NAMESPACE,
-    output_path=DASHBOARD_OUTPUT_PATH,
+    drs_file_path=None,
+    terra_output_path=None,
 ):
-    """Reconcile and aggregate results
+    """Reconcile and aggregate results, drs_file_path is the gen3-drs.sqlite loaded by Entities
 
     e.g. bin/reconciler --user_project <your-billing-project> --consortium ThousandGenomes ^1000G-high-coverage-2019$
     --consortium CMG AnVIL_CMG.* --consortium CCDG AnVIL_CCDG.* --consortium GTEx ^AnVIL_GTEx_V8_hg38$
@@ -42,7 +45,12 @@ def reconcile_all(
     for (name, workspace_regex) in consortiums:
         print(f"Reconciling {name}...")
         reconciler = Reconciler(
-            name, user_project, namespace, workspace_regex, AVRO_PATH
+            name,
+            user_project,
+            namespace,
+            workspace_regex,
+            drs_file_path,
+            terra_output_path,
         )
         num_processed = 0
         for workspace in reconciler.workspaces:
@@ -70,8 +78,8 @@ def append_drs(sample):
         print(f"{err}: {sample.id}")
 
 
-def all_instances(clazz):
-    """Return all subjects"""
+def all_instances(clazz, drs_file_path):
+    """Return all instances of clazz, all items if None"""
     print(
         "Starting aggregation for all AnVIL workspaces, this will take several minutes"
     )
@@ -84,7 +92,9 @@ def all_instances(clazz):
     )
 
     for item in reconcile_all(
-        user_project=BILLING_PROJECT, consortiums=consortiums
+        user_project=BILLING_PROJECT,
+        consortiums=consortiums,
+        drs_file_path=drs_file_path,
     ):
         if isinstance(item, Sample):
             append_drs(item)
@@ -92,7 +102,7 @@ def all_instances(clazz):
             yield item
 
 
-def save_all(workspaces):
+def save_all(workspaces, output_path=DASHBOARD_OUTPUT_PATH):
     """Save all data to the file system"""
     emitters = {}
     entity = None
@@ -113,8 +123,8 @@ def save_all(workspaces):
 
         try:
             # Create output directory
-            if not os.path.isdir(DASHBOARD_OUTPUT_PATH):
-                os.mkdir(DASHBOARD_OUTPUT_PATH)
+            if not os.path.isdir(output_path):
+                os.mkdir(output_path)
 
             for item in transformer.transform():
                 for entity in item.entity():
@@ -122,7 +132,7 @@ def save_all(workspaces):
                     emitter = emitters.get(resourceType, None)
                     if emitter is None:
                         emitter = open(
-                            f"{DASHBOARD_OUTPUT_PATH}/{resourceType}.ndjson",
+                            f"{output_path}/{resourceType}.ndjson",
                             "w+",
                         )
                         emitters[resourceType] = emitter
@@ -136,11 +146,11 @@ def save_all(workspaces):
         stream.close()
 
 
-def validate():
+def validate(output_path=DASHBOARD_OUTPUT_PATH):
     """Check all validations exist"""
     print("Validating files...")
     FHIR_OUTPUT_PATHS = [
-        f"{DASHBOARD_OUTPUT_PATH}/{p}"
+        f"{output_path}/{p}"
         for p in """
     DocumentReference.ndjson
     Organization.ndjson
@@ -167,32 +177,47 @@ def validate():
     print("Validated files!")
 
 
-def main():
+def main(
+    avro_path=AVRO_PATH,
+    output_path=DASHBOARD_OUTPUT_PATH,
+    stream=None,
+    source=None,
+    drs_file_path=GEN3_DRS_PATH,
+):
+    """Extract avro_path, or stream (see pfb_downloader.open_stream) while it downloads, into output_path
+
+    source identifies the PFB across uploads (see pfb_downloader.message_source), a new upload of it
+    deletes the gen3 nodes it no longer contains from drs_file_path
+    """
     # setup gcloud
     try:
         gcloud_cmd = f"gcloud auth activate-service-account {SA_NAME}@{GCP_PROJECT_ID}.iam.gserviceaccount.com --key-file=./creds.json"
         print(f"CMD: {gcloud_cmd}")
-        process = subprocess.Popen(gcloud_cmd.split(), stdout=subprocess.PIPE)
+        process = subprocess.Popen(
+            gcloud_cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
         output, error = process.communicate()
         print(f"OUTPUT: {output}")
 
-        if error:
+        if process.returncode:
             raise Exception(error)
     except Exception as err:
+        # raised, so the pipeline fails the job rather than uploading stale or empty output
         print(f"[Error] 500 Internal Server Error: {err}")
-        return f"[Error] 500 Internal Server Error: {err}", 202
+        raise Exception(f"500 Internal Server Error: {err}")
 
     # init AVRO file
     global gen3_entities
-    gen3_entities = Entities(AVRO_PATH)
+    gen3_entities = Entities(avro_path, drs_file_path, source=source)
 
     # generate JSON
     print("Loading entities...")
-    gen3_entities.load()
-    workspaces = list(all_instances(Workspace))
-    save_all(workspaces)
+    # runs inside gunicorn's threads, decode in this process rather than a process pool
+    gen3_entities.load(stream, workers=1)
+    workspaces = list(all_instances(Workspace, drs_file_path))
+    save_all(workspaces, output_path=output_path)
     print("Loaded entities!")
-    validate()
+    validate(output_path=output_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+"""Staged pipeline: download -> extract -> upload -> transfer.
+
+- each stage has its own workers, stages are connected by bounded queues so different PFBs overlap
+- jobs are de-duplicated by key (bucket/object#generation), repeated PubSub deliveries share one job;
+  the most recent completed jobs are remembered, older ones are evicted
+- per stage timings are recorded on each job and aggregated in metrics()
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+class Job:
+    """One PFB moving through the pipeline."""
+
+    def __init__(self, key, payload):
+        """Set key and payload (the PubSub envelope)."""
+        self.key = key
+        self.payload = payload
+        self.context = {}
+        self.timings = {}
+        self.error = None
+        self.stage = None
+        self.submitted = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    @property
+    def elapsed(self):
+        """Seconds since submitted, until finished."""
+        return (self.finished or time.time()) - self.submitted
+
+    def __repr__(self):
+        """Show key, stage, error and timings."""
+        return f"Job({self.key} stage:{self.stage} error:{self.error} timings:{self.timings})"
+
+
+class Pipeline:
+    """Run jobs through stages, a stage is (name, function(job), workers).
+
+    Stage functions are plain callables so the pipeline can be run against local fakes.
+    """
+
+    def __init__(self, stages, queue_size=2, on_done=None, max_completed=1000):
+        """Start stage workers; queue_size jobs may wait before each stage, max_completed successful jobs are remembered."""
+        self.stages = stages
+        self.on_done = on_done
+        self.max_completed = max_completed
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        # jobs in flight and recently completed, by key
+        self.jobs = {}
+        # keys of completed jobs, oldest first
+        self.completed = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            name: {"jobs": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "wait_seconds": 0.0}
+            for name, _, _ in stages
+        }
+        self.threads = []
+        for index, (name, _, workers) in enumerate(stages):
+            for _ in range(workers):
+                thread = threading.Thread(target=self._work, args=(index,), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, key, payload):
+        """Queue a job, return (job, is_new); a key already running or completed returns the existing job."""
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None:
+                return job, False
+            job = Job(key, payload)
+            self.jobs[key] = job
+        job.context["queued"] = time.time()
+        # blocks when the first stage is backed up
+        self.queues[0].put(job)
+        return job, True
+
+    def run(self, key, payload, timeout=None):
+        """Submit job and wait for it to finish, return (job, is_new)."""
+        job, is_new = self.submit(key, payload)
+        job.done.wait(timeout)
+        return job, is_new
+
+    def _work(self, index):
+        name, function, _ = self.stages[index]
+        while True:
+            job = self.queues[index].get()
+            start = time.time()
+            job.stage = name
+            try:
+                function(job)
+            except Exception as err:
+                job.error = err
+            seconds = time.time() - start
+            job.timings[name] = round(seconds, 3)
+            with self.lock:
+                stats = self.stats[name]
+                stats["jobs"] += 1
+                stats["errors"] += 1 if job.error else 0
+                stats["seconds"] += seconds
+                stats["max_seconds"] = max(stats["max_seconds"], seconds)
+                stats["wait_seconds"] += start - job.context.pop("queued", start)
+            if job.error or index == len(self.stages) - 1:
+                self._finish(job)
+            else:
+                job.context["queued"] = time.time()
+                # blocks when the next stage is backed up
+                self.queues[index + 1].put(job)
+
+    def _finish(self, job):
+        job.finished = time.time()
+        with self.lock:
+            # failed jobs are forgotten so a redelivery can retry them
+            if job.error:
+                self.jobs.pop(job.key, None)
+            else:
+                self.completed[job.key] = job
+                while len(self.completed) > self.max_completed:
+                    key, _ = self.completed.popitem(last=False)
+                    self.jobs.pop(key, None)
+        try:
+            if self.on_done:
+                self.on_done(job)
+        finally:
+            job.done.set()
+
+    def metrics(self):
+        """Return per stage counts, total/mean/max seconds, time spent queued and current queue depth."""
+        with self.lock:
+            metrics = {}
+            for (name, _, workers), _queue in zip(self.stages, self.queues):
+                stats = dict(self.stats[name])
+                stats["workers"] = workers
+                stats["queued"] = _queue.qsize()
+                stats["mean_seconds"] = round(stats["seconds"] / stats["jobs"], 3) if stats["jobs"] else 0
+                for key in ("seconds", "max_seconds", "wait_seconds"):
+                    stats[key] = round(stats[key], 3)
+                metrics[name] = stats
+            return metrics
@@ -0,0 +1 @@
+"""gcp tests."""
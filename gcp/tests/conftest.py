@@ -0,0 +1,7 @@
+"""Provide test fixtures."""
+
+import os
+import sys
+
+# the container runs main.py from this folder, its modules import each other as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+"""Test uploads against a fake bucket."""
+
+import data_uploader
+
+
+class FakeBlob:
+    """Record uploads, report crc32c like GCS."""
+
+    def __init__(self, name, chunk_size=None, crc32c=None):
+        """Set name, resumable chunk size and checksum."""
+        self.name = name
+        self.chunk_size = chunk_size
+        self.crc32c = crc32c
+        self.uploaded = None
+        self.deleted = False
+
+    def upload_from_filename(self, filename, checksum=None):
+        """Record filename, checksum becomes the file's."""
+        assert checksum == "crc32c"
+        self.uploaded = filename
+        self.crc32c = data_uploader.crc32c(filename)
+
+    def delete(self):
+        """Mark deleted."""
+        self.deleted = True
+
+
+class FakeBucket:
+    """Objects by name."""
+
+    def __init__(self):
+        """Start empty."""
+        self.blobs = {}
+
+    def get_blob(self, name):
+        """Return existing blob or None."""
+        return self.blobs.get(name)
+
+    def list_blobs(self, prefix=""):
+        """Return blobs whose names start with prefix."""
+        return [blob for name, blob in sorted(self.blobs.items()) if name.startswith(prefix)]
+
+    def blob(self, name, chunk_size=None):
+        """Return a new blob."""
+        self.blobs[name] = FakeBlob(name, chunk_size)
+        return self.blobs[name]
+
+
+def test_upload_skips_unchanged(tmp_path, monkeypatch):
+    """Objects with the local file's crc32c are skipped, changed and new files are uploaded."""
+    for name, text in [("Patient.ndjson", "a\n"), ("Specimen.ndjson", "b\n"), ("Task.ndjson", "c\n" * 100)]:
+        (tmp_path / name).write_text(text)
+    bucket = FakeBucket()
+    bucket.blobs["data/Patient.ndjson"] = FakeBlob("data/Patient.ndjson", crc32c=data_uploader.crc32c(tmp_path / "Patient.ndjson"))
+    bucket.blobs["data/Specimen.ndjson"] = FakeBlob("data/Specimen.ndjson", crc32c="stale")
+    monkeypatch.setattr(data_uploader, "RESUMABLE_THRESHOLD", 100)
+
+    results = data_uploader.upload_all(bucket, data_uploader.list_files(tmp_path), str(tmp_path), prefix="data")
+    assert [(r["name"], r["status"]) for r in results] == [
+        ("data/Patient.ndjson", "skipped"),
+        ("data/Specimen.ndjson", "uploaded"),
+        ("data/Task.ndjson", "uploaded"),
+    ]
+    assert bucket.blobs["data/Patient.ndjson"].uploaded is None
+    assert bucket.blobs["data/Specimen.ndjson"].uploaded == str(tmp_path / "Specimen.ndjson")
+    # large files are uploaded in resumable chunks
+    assert bucket.blobs["data/Specimen.ndjson"].chunk_size is None
+    assert bucket.blobs["data/Task.ndjson"].chunk_size == data_uploader.CHUNK_SIZE
+
+    # nothing changed, nothing uploaded
+    results = data_uploader.upload_all(bucket, data_uploader.list_files(tmp_path), str(tmp_path), prefix="data")
+    assert {r["status"] for r in results} == {"skipped"}
+
+
+def test_replace_deletes_stale(tmp_path, monkeypatch):
+    """Replacing a prefix deletes the objects an earlier upload left, other prefixes are kept."""
+    (tmp_path / "Patient.ndjson").write_text("a\n")
+    bucket = FakeBucket()
+    for name in ["pfb/Patient.ndjson", "pfb/Task.ndjson", "pfb-2/Task.ndjson"]:
+        bucket.blobs[name] = FakeBlob(name, crc32c="stale")
+    monkeypatch.setattr(data_uploader, "UPLOAD_MANIFEST", None)
+
+    data_uploader.main(bucket=bucket, output_path=str(tmp_path), prefix="pfb", replace=True)
+    assert bucket.blobs["pfb/Patient.ndjson"].uploaded == str(tmp_path / "Patient.ndjson")
+    assert [name for name, blob in sorted(bucket.blobs.items()) if blob.deleted] == ["pfb/Task.ndjson"]
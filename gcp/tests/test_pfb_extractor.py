@@ -0,0 +1,106 @@
+"""Test the extractor against pyAnVIL's reconciler."""
+
+import pytest
+
+import anvil.terra.reconciler
+from anvil.terra.workspace import Workspace
+
+import pfb_extractor
+
+
+class FailedProcess:
+    """A gcloud command that exits with an error."""
+
+    returncode = 1
+
+    def __init__(self, *args, **kwargs):
+        """Ignore the command."""
+
+    def communicate(self):
+        """Return stdout and stderr."""
+        return b"", b"ERROR: (gcloud.auth.activate-service-account) could not read json file"
+
+
+class SucceededProcess(FailedProcess):
+    """A gcloud command that exits without error."""
+
+    returncode = 0
+
+
+class FakeTransformer:
+    """Yield the workspace rather than its FHIR entities."""
+
+    def __init__(self, workspace):
+        """Keep workspace."""
+        self.workspace = workspace
+
+    def transform(self):
+        """Yield workspace."""
+        yield self.workspace
+
+
+def test_all_instances(tmp_path, monkeypatch):
+    """Workspaces are reconciled with the gen3 sqlite the extractor loaded."""
+    searched = []
+
+    def _get_projects(namespaces, project_pattern):
+        searched.append((namespaces, project_pattern))
+        return [{"workspace": {"name": "1000G-high-coverage-2019", "attributes": {}}}]
+
+    monkeypatch.setattr(anvil.terra.reconciler, "get_projects", _get_projects)
+    monkeypatch.setattr(pfb_extractor, "FhirTransformer", FakeTransformer)
+    monkeypatch.setattr(pfb_extractor, "BILLING_PROJECT", "user-project")
+    drs_file_path = str(tmp_path / "gen3-drs.sqlite")
+
+    workspaces = list(pfb_extractor.all_instances(Workspace, drs_file_path))
+
+    assert searched == [
+        (pfb_extractor.DEFAULT_NAMESPACE, "^1000G-high-coverage-2019$")
+    ]
+    assert [w.name for w in workspaces] == ["1000G-high-coverage-2019"]
+    assert workspaces[0].drs_file_path == drs_file_path
+    assert workspaces[0].attributes.reconciler_name == "ThousandGenomes"
+
+
+def test_main_raises_if_gcloud_fails(tmp_path, monkeypatch):
+    """A failed gcloud activation fails the extract stage, nothing is loaded."""
+    monkeypatch.setattr(pfb_extractor.subprocess, "Popen", FailedProcess)
+    monkeypatch.setattr(pfb_extractor, "Entities", None)
+    with pytest.raises(Exception, match="could not read json file"):
+        pfb_extractor.main(
+            avro_path=str(tmp_path / "export.avro"), output_path=str(tmp_path / "data")
+        )
+
+
+def test_main_loads_into_a_shared_store(tmp_path, monkeypatch):
+    """Every upload of a PFB is loaded into the same store under the same source."""
+    loaded = []
+
+    class Loaded(Exception):
+        """Stop once entities are loaded."""
+
+    class FakeEntities:
+        """Record how entities are loaded."""
+
+        def __init__(self, avro_path, drs_file_path, source=None):
+            """Record arguments."""
+            loaded.append((avro_path, drs_file_path, source))
+
+        def load(self, stream=None, workers=None):
+            """Stop the extraction."""
+            raise Loaded()
+
+    monkeypatch.setattr(pfb_extractor.subprocess, "Popen", SucceededProcess)
+    monkeypatch.setattr(pfb_extractor, "Entities", FakeEntities)
+    drs_file_path = str(tmp_path / "gen3-drs.sqlite")
+    for generation in ("1", "2"):
+        with pytest.raises(Loaded):
+            pfb_extractor.main(
+                avro_path=str(tmp_path / generation / "export.avro"),
+                output_path=str(tmp_path / generation / "data"),
+                source="pfb-bucket/export.avro",
+                drs_file_path=drs_file_path,
+            )
+    assert [(drs, source) for _, drs, source in loaded] == [
+        (drs_file_path, "pfb-bucket/export.avro")
+    ] * 2
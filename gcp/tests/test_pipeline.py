@@ -0,0 +1,111 @@
+"""Test the staged pipeline with fake stages."""
+
+import threading
+import time
+
+from pipeline import Pipeline
+
+
+def _recorder(calls, name, wait=None, fail=None):
+    """Return a stage function appending (name, key) to calls, optionally waiting on an event or raising for a key."""
+
+    def _stage(job):
+        if wait:
+            wait.wait(5)
+        if fail == job.key:
+            raise Exception(f"{name} failed {job.key}")
+        calls.append((name, job.key))
+
+    return _stage
+
+
+def _wait_for(condition, timeout=5):
+    """Poll until condition() is true."""
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_dedup_by_key():
+    """Repeated deliveries of a key share one job, while running and after it completed."""
+    calls, release = [], threading.Event()
+    pipeline = Pipeline([("download", _recorder(calls, "download", wait=release), 1), ("upload", _recorder(calls, "upload"), 1)])
+    job, is_new = pipeline.submit("bucket/a.avro#1", {})
+    duplicate, is_duplicate_new = pipeline.submit("bucket/a.avro#1", {})
+    assert is_new and not is_duplicate_new and duplicate is job
+    release.set()
+    assert pipeline.run("bucket/a.avro#1", {}, timeout=5) == (job, False)
+    assert job.done.is_set() and job.error is None
+    assert calls == [("download", "bucket/a.avro#1"), ("upload", "bucket/a.avro#1")]
+    # a new generation is a new job
+    assert pipeline.run("bucket/a.avro#2", {}, timeout=5)[1]
+    assert len(calls) == 4
+
+
+def test_error_skips_stages_and_reaches_cleanup():
+    """A failing stage ends the job, on_done sees the error, a redelivery retries."""
+    calls, done = [], []
+    pipeline = Pipeline(
+        [("download", _recorder(calls, "download", fail="bad"), 1), ("upload", _recorder(calls, "upload"), 1)],
+        on_done=done.append,
+    )
+    job, _ = pipeline.run("bad", {}, timeout=5)
+    assert str(job.error) == "download failed bad"
+    assert done == [job]
+    assert calls == []
+    assert list(job.timings) == ["download"]
+    retry, is_new = pipeline.run("bad", {}, timeout=5)
+    assert is_new and retry is not job
+    pipeline.run("good", {}, timeout=5)
+    assert calls == [("download", "good"), ("upload", "good")]
+    assert [j.key for j in done] == ["bad", "bad", "good"]
+
+
+def test_back_pressure():
+    """A stalled stage stops earlier stages once the queues between them are full."""
+    calls, release = [], threading.Event()
+    pipeline = Pipeline([("download", _recorder(calls, "download"), 1), ("upload", _recorder(calls, "upload", wait=release), 1)], queue_size=1)
+
+    def _submit():
+        for i in range(5):
+            pipeline.submit(f"job-{i}", {})
+
+    submitter = threading.Thread(target=_submit, daemon=True)
+    submitter.start()
+    # one job in upload, one queued for it, one downloaded and waiting to be queued, one queued for download
+    _wait_for(lambda: pipeline.metrics()["download"]["queued"] == 1 and pipeline.metrics()["upload"]["queued"] == 1)
+    time.sleep(0.1)
+    assert len([c for c in calls if c[0] == "download"]) == 3
+    assert submitter.is_alive(), "submit blocks while the first queue is full"
+    release.set()
+    submitter.join(5)
+    _wait_for(lambda: len(pipeline.completed) == 5)
+    assert [key for name, key in calls if name == "upload"] == [f"job-{i}" for i in range(5)]
+
+
+def test_metrics():
+    """Counts, errors and timings per stage."""
+    pipeline = Pipeline([("download", lambda job: time.sleep(0.05), 2), ("upload", _recorder([], "upload", fail="bad"), 1)])
+    for key in ["a", "b", "bad"]:
+        pipeline.run(key, {}, timeout=5)
+    metrics = pipeline.metrics()
+    assert metrics["download"]["jobs"] == 3 and metrics["download"]["errors"] == 0
+    assert metrics["download"]["workers"] == 2
+    assert metrics["download"]["mean_seconds"] >= 0.05
+    assert metrics["download"]["max_seconds"] >= metrics["download"]["mean_seconds"]
+    assert metrics["upload"]["jobs"] == 3 and metrics["upload"]["errors"] == 1
+    assert metrics["upload"]["queued"] == 0
+
+
+def test_completed_jobs_are_evicted():
+    """Only the most recent max_completed jobs are remembered."""
+    calls = []
+    pipeline = Pipeline([("download", _recorder(calls, "download"), 1)], max_completed=2)
+    for key in ["a", "b", "c"]:
+        pipeline.run(key, {}, timeout=5)
+    assert list(pipeline.completed) == ["b", "c"]
+    assert set(pipeline.jobs) == {"b", "c"}
+    assert not pipeline.run("c", {}, timeout=5)[1]
+    assert pipeline.run("a", {}, timeout=5)[1]
+    assert calls == [("download", "a"), ("download", "b"), ("download", "c"), ("download", "a")]
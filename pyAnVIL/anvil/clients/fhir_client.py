@@ -2,11 +2,10 @@
 
 
 import logging
-import threading
-from urllib.parse import urlparse
 from fhirclient import client
-from fhirclient.models.meta import Meta
-from fhirclient.models.bundle import Bundle
+from anvil.clients.transport import auth_session
+from anvil.clients.http_cache import fhir_cache
+from anvil.clients.fhir_dispatch import iter_pages, dispatch, bundle_resources, patch_search, PREFETCH
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +16,8 @@ class FHIRClient(client.FHIRClient):
     Parameters:
         See https://github.com/smart-on-fhir/client-py/blob/master/fhirclient/client.py#L19
 
+    :param cache: Optional anvil.clients.http_cache.ResponseCache, defaults to ANVIL_FHIR_CACHE
+
     Returns:
         Instance of client, with injected authorization method
 
@@ -44,12 +45,15 @@ class FHIRClient(client.FHIRClient):
         if 'auth' in kwargs:
             auth = kwargs['auth']
             del kwargs['auth']
+        # grab response cache if passed, defaults to ANVIL_FHIR_CACHE
+        cache = kwargs.pop('cache', fhir_cache())
         super(FHIRClient, self).__init__(*args, **kwargs)
         client_major_version = int(client.__version__.split('.')[0])
         assert client_major_version >= 4, f"requires version >= 4.0.0 current version {client.__version__} `pip install -e git+https://github.com/smart-on-fhir/client-py#egg=fhirclient`"
+        # pooled, keep-alive session shared by all clients using this authenticator
+        self.server.session = auth_session(auth, cache)
         if auth:
             self.server.auth = auth
-            self.server.session.hooks['response'].append(self.server.auth.handle_401)
         self.prepare()
         assert self.ready, "server should be ready"
 
@@ -61,6 +65,8 @@ class DispatchingFHIRClient(client.FHIRClient):
         See https://github.com/smart-on-fhir/client-py/blob/master/fhirclient/client.py#L19
 
     :param settings.api_bases: The servers against which to perform the search **settings.api_base ignored**
+    :param settings.prefetch: Optional, pages requested ahead of the caller per server, see anvil.clients.fhir_dispatch.PREFETCH
+    :param cache: Optional anvil.clients.http_cache.ResponseCache, defaults to ANVIL_FHIR_CACHE
     :param access_token: Optional access token, if none provided `gcloud auth print-access-token` is used
 
     Returns:
@@ -97,6 +103,7 @@ class DispatchingFHIRClient(client.FHIRClient):
         """Pass args to super, patches `perform` to our dispatching version."""
         # use the first entry as 'our' server
         _settings = dict(kwargs['settings'])
+        _settings['api_bases'] = list(_settings['api_bases'])
         api_base = _settings['api_bases'].pop()
         _settings['api_base'] = api_base
         kwargs['settings'] = _settings
@@ -107,20 +114,29 @@ class DispatchingFHIRClient(client.FHIRClient):
             self._retrieve_all = kwargs['settings']['retrieve_all']
             del kwargs['settings']['retrieve_all']
 
+        # grab prefetch if passed
+        self._prefetch = PREFETCH
+        if 'prefetch' in kwargs['settings']:
+            self._prefetch = kwargs['settings']['prefetch']
+            del kwargs['settings']['prefetch']
+
         # grab auth if passed
         auth = None
         if 'auth' in kwargs:
             auth = kwargs['auth']
             del kwargs['auth']
+        # grab response cache if passed, defaults to ANVIL_FHIR_CACHE
+        cache = kwargs.pop('cache', fhir_cache())
 
         # normal setup with our authenticator
         super(DispatchingFHIRClient, self).__init__(*args, **kwargs)
         client_major_version = int(client.__version__.split('.')[0])
         assert client_major_version >= 4, f"requires version >= 4.0.0 current version {client.__version__} `pip install -e git+https://github.com/smart-on-fhir/client-py#egg=fhirclient`"
 
+        # pooled, keep-alive session shared with the per api_base clients below
+        self.server.session = auth_session(auth, cache)
         if auth:
             self.server.auth = auth
-            self.server.session.hooks['response'].append(self.server.auth.handle_401)
         self.prepare()
         assert self.ready, "server should be ready"
 
@@ -132,124 +148,63 @@ class DispatchingFHIRClient(client.FHIRClient):
             __settings = dict(_settings)
             __settings['api_base'] = api_base
             _client = client.FHIRClient(settings=__settings)
+            _client.server.session = self.server.session
             _client.server.auth = self.server.auth
-            _client.server.session.hooks['response'].append(self.server.auth.handle_401)
             _client.prepare()
             self._clients.append(_client)
 
-        # monkey patch search perform if we haven't already
-        from fhirclient.models.fhirsearch import FHIRSearch
-        if not hasattr(FHIRSearch, '_anvil_patch'):
-            FHIRSearch._anvil_patch = True
-            original_perform = FHIRSearch.perform
-            me = self
-
-            def _perform(self, server):
-                """Dispatch query to api_bases."""
-                # FHIRSearch can be used by multiple classes, don't dispatch unless one of ours
-                if not server.client.__class__.__name__ == 'DispatchingFHIRClient':
-                    logger.debug(f"* * * * * * * original_perform {server.client.__class__.__name__}")
-                    return original_perform(self, server)
-
-                def _worker(self, server, _results):
-                    """Dispatches request to underlying class, return an entry indexed by base uri.
-
-                    Sets bundle.meta.source
-                    See https://www.hl7.org/fhir/resource-definitions.html#Meta.source
-
-                    :param server: The server against which to perform the search
-                    :_results: Result of operation added to this array
-                    """
-                    logger.debug(f"worker starting {server.base_uri}")
-                    result = original_perform(self, server)
-                    logger.debug(f"worker got {result}")
-                    while result:
-
-                        # add source to meta if it doesn't already exist
-                        if not result.meta:
-                            result.meta = Meta()
-                        if not result.meta.source:
-                            result.meta.source = server.base_uri
-                        _results.append(result)
-                        if not me._retrieve_all:
-                            break
-
-                        # follow `next` link for pagination
-                        if hasattr(result, 'link'):
-                            _next = next((lnk.as_json() for lnk in result.link if lnk.relation == 'next'), None)
-                            result = None
-                            if _next:
-                                logger.debug(f"has next {_next}")
-                                # request_json takes a full path & query (not host)
-                                parts = urlparse(_next['url'])
-                                assert len(parts.query) > 0, parts
-                                path = f"{parts.path}?{parts.query}"
-                                logger.debug(f"attempting next {path}")
-                                res = server.request_json(path)
-                                result = Bundle(res)
-                                result.origin_server = server
-                        else:
-                            result = None
-                    logger.debug(f"worker done {result}")
-
-                logger.debug("starting threads")
-                workers = []
-                results = []
-                for _client in server.client._clients:
-                    workers.append(
-                        threading.Thread(target=_worker, args=(self, _client.server, results, ))
-                    )
-                # Start workers.
-                for w in workers:
-                    w.start()
-
-                # Wait for workers to quit.
-                logger.debug("waiting for results.")
-                for w in workers:
-                    w.join()
-                logger.debug(f"all workers done. {len(results)}")
-                return results
-            # monkey patch
-            FHIRSearch.perform = _perform
-
-            # since perform returns an array, patch _perform_resources as well.
-            def _perform_resources(self, server):
-                """Perform the search by calling `perform`, then extracts all Bundle entries and returns a list of Resource instances.
-
-                Sets resource.meta.source
-                See https://www.hl7.org/fhir/resource-definitions.html#Meta.source
-
-                :param server: The server against which to perform the search
-                :returns: A list of Resource instances
-                """
-                # flatten into an array of resources
-                bundles = self.perform(server)
-                resources = []
-                if bundles is not None:
-                    if not isinstance(bundles, list):
-                        bundles = [bundles]
-                    for bundle in bundles:
-                        if bundle.entry:
-                            for entry in bundle.entry:
-                                if not entry.resource.meta:
-                                    entry.resource.meta = Meta()
-
-                                if not entry.resource.meta.source:
-                                    entry.resource.meta.source = bundle.meta.source
-
-                                # add tag for fullURL, allows caller
-                                # to disambiguate resources returned from different base URL
-                                # TODO Expecting property "tag" on <class 'fhirclient.models.meta.Meta'> to be <class 'fhirclient.models.coding.Coding'>, but is <class 'dict'>
-                                # if not entry.resource.meta.tag:
-                                #     entry.resource.meta.tag = []
-                                # entry.resource.meta.tag.append({
-                                #     "system" : "https://nih-ncpi.github.io/ncpi-fhir-ig/#fullUrl",
-                                #     "code" : entry.fullUrl
-                                # })
-                                resources.append(entry.resource)
-                return resources
-            FHIRSearch.perform_resources = _perform_resources
-            logger.debug("Patched FHIRSearch")
+        # searches against this client fan out to all api_bases
+        patch_search()
+
+    def search_bundles(self, search, count=None):
+        """Perform search on all servers, yield Bundles as they arrive; pages from one server are in order.
+
+        Servers are searched on a shared, bounded thread pool, the next page of each server is prefetched
+        while the caller processes the current one. See anvil.clients.fhir_dispatch.
+
+        :param search: FHIRSearch
+        :param count: page size (`_count`) requested from each server
+        """
+        pages = dispatch(
+            [iter_pages(search, _client.server, self._retrieve_all, count) for _client in self._clients],
+            prefetch=self._prefetch
+        )
+        try:
+            for _, bundle in pages:
+                yield bundle
+        finally:
+            # stops fetching if the caller stops early
+            pages.close()
+
+    def iter_resources(self, search, count=None, limit=None):
+        """Perform search on all servers, yield resources as pages arrive.
+
+        Only the pages being consumed or prefetched are held in memory. Closing the iterator,
+        or reaching `limit`, stops further requests.
+
+        Sets resource.meta.source
+        See https://www.hl7.org/fhir/resource-definitions.html#Meta.source
+
+        Examples: ::
+
+            for patient in smart.iter_resources(Patient.where(struct={}), count=1000, limit=10):
+                print(patient.meta.source, patient.id)
+
+        :param search: FHIRSearch
+        :param count: page size (`_count`) requested from each server
+        :param limit: stop after this many resources
+        """
+        bundles = self.search_bundles(search, count)
+        try:
+            yielded = 0
+            for bundle in bundles:
+                for resource in bundle_resources(bundle):
+                    if limit is not None and yielded >= limit:
+                        return
+                    yielded += 1
+                    yield resource
+        finally:
+            bundles.close()
 
     @property
     def clients(self):
@@ -0,0 +1,238 @@
+"""Fan out FHIR searches across servers with bounded concurrency and per server page prefetch."""
+
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from fhirclient.models.bundle import Bundle
+from fhirclient.models.meta import Meta
+
+logger = logging.getLogger(__name__)
+
+# threads shared by all searches in this process, regardless of the number of servers
+MAX_WORKERS = int(os.getenv('ANVIL_FHIR_MAX_WORKERS') or 8)
+# pages buffered ahead of the consumer per server, the next page is always requested while the current one is consumed
+PREFETCH = int(os.getenv('ANVIL_FHIR_PREFETCH') or 1)
+
+_executor = None
+_executor_lock = threading.Lock()
+_DONE = object()
+
+
+def executor():
+    """Return the process wide pool used to dispatch searches."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='fhir-dispatch')
+        return _executor
+
+
+def next_path(bundle):
+    """Return path and query of the bundle's `next` link, or None."""
+    _next = next((lnk.url for lnk in bundle.link or [] if lnk.relation == 'next'), None)
+    if not _next:
+        return None
+    # request_json takes a full path & query (not host)
+    parts = urlparse(_next)
+    assert len(parts.query) > 0, parts
+    return f"{parts.path}?{parts.query}"
+
+
+def search_path(search, count=None):
+    """Return the search's path and query, with `_count` replaced if count is set."""
+    path = search.construct()
+    if not count:
+        return path
+    resource_type, _, query = path.partition('?')
+    parts = [part for part in query.split('&') if part and not part.startswith('_count=')]
+    parts.append(f"_count={count}")
+    return f"{resource_type}?{'&'.join(parts)}"
+
+
+def iter_pages(search, server, retrieve_all=True, count=None):
+    """Perform search on server, yield Bundles following `next` links.
+
+    Sets bundle.meta.source
+    See https://www.hl7.org/fhir/resource-definitions.html#Meta.source
+
+    :param search: FHIRSearch
+    :param server: The server against which to perform the search
+    :param retrieve_all: follow `next` links, otherwise only the first page is returned
+    :param count: page size requested from the server (`_count`), None uses the search's or server's default
+    """
+    logger.debug(f"starting {server.base_uri}")
+    bundle = Bundle.read_from(search_path(search, count), server)
+    while bundle:
+        # add source to meta if it doesn't already exist
+        if not bundle.meta:
+            bundle.meta = Meta()
+        if not bundle.meta.source:
+            bundle.meta.source = server.base_uri
+        path = next_path(bundle) if retrieve_all else None
+        yield bundle
+        bundle = None
+        if path:
+            logger.debug(f"attempting next {path}")
+            bundle = Bundle(server.request_json(path))
+            bundle.origin_server = server
+    logger.debug(f"done {server.base_uri}")
+
+
+def bundle_resources(bundle):
+    """Yield the resources in bundle, sets resource.meta.source from the bundle."""
+    for entry in bundle.entry or []:
+        if not entry.resource:
+            continue
+        if not entry.resource.meta:
+            entry.resource.meta = Meta()
+        if not entry.resource.meta.source:
+            entry.resource.meta.source = bundle.meta.source if bundle.meta else None
+        yield entry.resource
+
+
+def iter_json_pages(session, url, timeout=None):
+    """GET url, yield each page's JSON, following `next` links.
+
+    Works on raw JSON, for callers that don't need fhirclient models (e.g. bin/fhir_query).
+    """
+    while url:
+        response = session.get(url, timeout=timeout)
+        page = response.json()
+        yield page
+        url = next((lnk['url'] for lnk in page.get('link', []) if lnk.get('relation') == 'next'), None)
+
+
+def prefetch_iter(iterator, depth=PREFETCH, pool=None):
+    """Run iterator in the background, up to `depth` items ahead of the caller.
+
+    For a pager, page N+1 is requested while the caller processes page N.
+    """
+    items = dispatch([iterator], prefetch=depth, pool=pool)
+    try:
+        for _, item in items:
+            yield item
+    finally:
+        items.close()
+
+
+def dispatch(iterators, prefetch=PREFETCH, pool=None):
+    """Drain iterators concurrently, yield (index, item) as items arrive.
+
+    Items from one iterator keep their order. Each iterator runs at most `prefetch` items ahead of the consumer,
+    so memory is bounded by the number of iterators, not the size of their results.
+    Closing the generator stops the producers; the first exception raised by an iterator is re-raised.
+
+    :param iterators: list of iterators, e.g. iter_pages for each server
+    :param prefetch: items buffered ahead of the consumer, per iterator
+    :param pool: executor, defaults to the shared, bounded pool
+    """
+    pool = pool or executor()
+    iterators = [iter(iterator) for iterator in iterators]
+    results = queue.Queue()
+    stop = threading.Event()
+    lock = threading.Lock()
+    credits = [prefetch] * len(iterators)
+    paused = [False] * len(iterators)
+
+    def _produce(index):
+        """Push the next item from iterator, resubmit while it has credit, otherwise pause until the consumer frees a slot.
+
+        Each call fetches a single item, so a producer never holds a pool thread while waiting on the consumer,
+        and searches dispatched from within a consumer (nested searches) always get a thread.
+        """
+        if stop.is_set():
+            return
+        try:
+            item = next(iterators[index])
+        except StopIteration:
+            results.put((index, _DONE, None))
+            return
+        except Exception as e:
+            results.put((index, _DONE, e))
+            return
+        results.put((index, item, None))
+        with lock:
+            credits[index] -= 1
+            if credits[index] > 0:
+                pool.submit(_produce, index)
+            else:
+                paused[index] = True
+
+    for index in range(len(iterators)):
+        pool.submit(_produce, index)
+    remaining = len(iterators)
+    try:
+        while remaining:
+            index, item, error = results.get()
+            if item is _DONE:
+                remaining -= 1
+                if error:
+                    raise error
+                continue
+            with lock:
+                credits[index] += 1
+                if paused[index] and not stop.is_set():
+                    paused[index] = False
+                    pool.submit(_produce, index)
+            yield index, item
+    finally:
+        stop.set()
+
+
+def patch_search():
+    """Patch fhirclient's FHIRSearch so searches against a dispatching client fan out to all of its servers.
+
+    A client dispatches if it has `search_bundles` and `iter_resources`, e.g. anvil.clients.fhir_client.DispatchingFHIRClient,
+    any other client gets fhirclient's own implementation. Patched once per process, whichever client is created first.
+    """
+    from fhirclient.models.fhirsearch import FHIRSearch
+    with _executor_lock:
+        if hasattr(FHIRSearch, '_anvil_patch'):
+            return
+        FHIRSearch._anvil_patch = True
+        original_perform = FHIRSearch.perform
+        original_perform_resources = FHIRSearch.perform_resources
+
+        def _dispatches(server):
+            """Return True if server belongs to a dispatching client."""
+            return hasattr(server.client, 'search_bundles') and hasattr(server.client, 'iter_resources')
+
+        def _perform(self, server):
+            """Dispatch query to api_bases, return a list of Bundles."""
+            if not _dispatches(server):
+                return original_perform(self, server)
+            return list(server.client.search_bundles(self))
+
+        def _perform_resources(self, server):
+            """Dispatch query to api_bases, return a list of resources with meta.source set."""
+            if not _dispatches(server):
+                return original_perform_resources(self, server)
+            return list(server.client.iter_resources(self))
+
+        FHIRSearch.perform = _perform
+        FHIRSearch.perform_resources = _perform_resources
+
+        # fhirclient >= 4.1 iterator API, stream from all api_bases
+        if hasattr(FHIRSearch, 'perform_resources_iter'):
+            original_perform_iter = FHIRSearch.perform_iter
+            original_perform_resources_iter = FHIRSearch.perform_resources_iter
+
+            def _perform_iter(self, server):
+                """Yield Bundles from all api_bases as they arrive."""
+                if not _dispatches(server):
+                    return original_perform_iter(self, server)
+                return server.client.search_bundles(self)
+
+            def _perform_resources_iter(self, server):
+                """Yield resources from all api_bases as pages arrive."""
+                if not _dispatches(server):
+                    return original_perform_resources_iter(self, server)
+                return server.client.iter_resources(self)
+
+            FHIRSearch.perform_iter = _perform_iter
+            FHIRSearch.perform_resources_iter = _perform_resources_iter
+        logger.debug("Patched FHIRSearch")
@@ -5,9 +5,10 @@ import requests
 import base64
 
 from datetime import datetime
-from subprocess import Popen, PIPE
 from requests.auth import AuthBase
 
+from anvil.clients.token_provider import TokenProvider, gcloud_provider
+
 
 TERRA_TOKEN_URL = "https://broad-bond-prod.appspot.com/api/link/v1/anvil/accesstoken"
 
@@ -31,6 +32,7 @@ class Gen3TerraAuth(AuthBase):
     Args:
         * terra_auth_url (str): URL of the terra endpoint Default: "https://broad-bond-prod.appspot.com/api/link/v1/anvil/accesstoken".
         * user_email (str): Optional, google id to pass to 'gcloud auth print-access-token' Default: None.
+        * gcloud_token_provider (TokenProvider): Optional, source of google tokens Default: shared gcloud provider for user_email.
 
     Examples: ::
 
@@ -53,14 +55,21 @@ class Gen3TerraAuth(AuthBase):
 
     """
 
-    def __init__(self, endpoint, terra_auth_url=TERRA_TOKEN_URL, user_email=None):
+    def __init__(self, endpoint, terra_auth_url=TERRA_TOKEN_URL, user_email=None, gcloud_token_provider=None):
         """Initialize properties."""
-        self._access_token = None
         self._terra_auth_url = terra_auth_url
         assert self._terra_auth_url, "MUST have _terra_auth_url"
         self._user_email = user_email
         self.endpoint = endpoint
         self._logger = logging.getLogger(__name__)
+        # fence tokens are cached until shortly before `expires_at`, concurrent refreshes are coalesced
+        self._gcloud_token_provider = gcloud_token_provider or gcloud_provider(user_email)
+        self._token_provider = TokenProvider(self._fetch_terra_token)
+
+    @property
+    def token_provider(self):
+        """Return TokenProvider, see its `stats` for refreshes, replays and retries avoided."""
+        return self._token_provider
 
     def __call__(self, request):
         """Add authorization header to the request.
@@ -98,10 +107,12 @@ class Gen3TerraAuth(AuthBase):
         # copy the request to resend
         newreq = response.request.copy()
 
-        self._access_token = None
+        # only the first request failing with this token triggers a refresh
+        self._token_provider.invalidate(response.request.headers.get('Authorization', '').replace('Bearer ', '', 1))
         self._logger.debug("_handle_401, cleared _access_token, retrying with new token")
 
         newreq.headers["Authorization"] = self._get_auth_value()
+        self._token_provider.record_replay(newreq)
 
         _response = response.connection.send(newreq, **kwargs)
         _response.history.append(response)
@@ -113,46 +124,41 @@ class Gen3TerraAuth(AuthBase):
         """Return the Authorization header value for the request.
 
         This gets called when added the Authorization header to the request.
-        This fetches the access token from the refresh token if the access token is missing.
+        This fetches the access token from terra if the access token is missing or about to expire.
 
         """
-        if not self._access_token:
-            try:
-                # get the local access token using gcloud
-                cmd = ['gcloud', 'auth', 'print-access-token']
-                if self._user_email:
-                    cmd.append(self._user_email)
-
-                self._logger.debug(f"get gcloud_access_token {cmd}")
-                p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-                gcloud_access_token, stderr = p.communicate()
-                gcloud_access_token = gcloud_access_token.decode("utf-8").rstrip()
-                assert len(gcloud_access_token) > 0, f'get gcloud_access_token MUST have an access token {stderr}'
-                self._logger.debug(f"gcloud_access_token {gcloud_access_token}")
-                # authenticate to terra, ask for fence/accesstoken
-                headers = {'Authorization': f'Bearer {gcloud_access_token}'}
-                r = requests.get(self._terra_auth_url, headers=headers)
-                assert r.status_code == 200, f'MUST respond with 200 {self._terra_auth_url} {r.text}'
-                self._logger.debug(r.text)
-                terra_access_token = r.json()
-                assert len(terra_access_token['token']) > 0, 'MUST have an access token'
-                assert len(terra_access_token['expires_at']) > 0, 'MUST have an expires_at '
-
-                expires_at = datetime.fromisoformat(terra_access_token['expires_at'])
-                now = datetime.now()
-                assert expires_at > now, 'expires_at MUST be in the future'
-
-                self._access_token = terra_access_token['token']
-
-                if self._logger.level == logging.DEBUG:
-                    self._logger.debug(f'Terra access token expires in {str(expires_at - now)}')
-                    self._logger.debug(self._access_token)
-                    # add padding
-                    self._logger.debug(base64.b64decode(self._access_token.split('.')[1] + "==="))
-
-            except Exception as e:
-                raise AnVILAuthError(
-                    "Failed to authenticate to {}\n{}".format(self._terra_auth_url, str(e))
-                )
-
-        return "Bearer " + self._access_token
+        try:
+            # preflight, never sign with a token that may expire mid request
+            return "Bearer " + self._token_provider.preflight()
+        except Exception as e:
+            raise AnVILAuthError(
+                "Failed to authenticate to {}\n{}".format(self._terra_auth_url, str(e))
+            )
+
+    def _fetch_terra_token(self):
+        """Exchange the gcloud access token for a fence access token, return (token, expires_at)."""
+        gcloud_access_token = self._gcloud_token_provider.token()
+        # authenticate to terra, ask for fence/accesstoken
+        headers = {'Authorization': f'Bearer {gcloud_access_token}'}
+        r = requests.get(self._terra_auth_url, headers=headers)
+        if r.status_code in (401, 403):
+            self._gcloud_token_provider.invalidate(gcloud_access_token)
+        assert r.status_code == 200, f'MUST respond with 200 {self._terra_auth_url} {r.text}'
+        self._logger.debug(r.text)
+        terra_access_token = r.json()
+        assert len(terra_access_token['token']) > 0, 'MUST have an access token'
+        assert len(terra_access_token['expires_at']) > 0, 'MUST have an expires_at '
+
+        expires_at = datetime.fromisoformat(terra_access_token['expires_at'])
+        now = datetime.now()
+        assert expires_at > now, 'expires_at MUST be in the future'
+
+        access_token = terra_access_token['token']
+
+        if self._logger.level == logging.DEBUG:
+            self._logger.debug(f'Terra access token expires in {str(expires_at - now)}')
+            self._logger.debug(access_token)
+            # add padding
+            self._logger.debug(base64.b64decode(access_token.split('.')[1] + "==="))
+
+        return access_token, expires_at.timestamp()
@@ -0,0 +1,201 @@
+"""Import NDJSON from GCS into Google Healthcare API FHIR stores, without the gcloud CLI.
+
+Imports to different stores run concurrently, imports to the same store run in order.
+Long running operations are polled with exponential backoff.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.auth import AuthBase
+
+from anvil.clients.transport import new_session
+from anvil.clients.token_provider import gcloud_provider
+
+logger = logging.getLogger(__name__)
+
+HEALTHCARE_API = os.getenv('HEALTHCARE_API') or 'https://healthcare.googleapis.com/v1'
+# stores imported at the same time
+MAX_WORKERS = int(os.getenv('HEALTHCARE_IMPORT_WORKERS') or 8)
+# first poll after POLL_INTERVAL seconds, then multiplied by POLL_BACKOFF up to MAX_POLL_INTERVAL
+POLL_INTERVAL = float(os.getenv('HEALTHCARE_POLL_INTERVAL') or 2)
+POLL_BACKOFF = 1.5
+MAX_POLL_INTERVAL = 60
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class HealthcareImportError(Exception):
+    """Reports an import that could not be started or polled."""
+
+    pass
+
+
+class BearerAuth(AuthBase):
+    """Sign requests with a token from a TokenProvider."""
+
+    def __init__(self, token_provider):
+        """Set provider."""
+        self.token_provider = token_provider
+
+    def __call__(self, request):
+        """Add Authorization header."""
+        request.headers['Authorization'] = f"Bearer {self.token_provider.preflight()}"
+        return request
+
+
+class ImportJob:
+    """State of one import operation."""
+
+    def __init__(self, store, gcs_uri, content_structure):
+        """Initialize properties."""
+        self.store = store
+        self.gcs_uri = gcs_uri
+        self.content_structure = content_structure
+        self.operation = None
+        self.done = False
+        self.error = None
+        self.success = 0
+        self.failure = 0
+        self.polls = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        """Seconds from start to completion (or now)."""
+        if not self.started:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def __repr__(self):
+        """Summarize job."""
+        return f"ImportJob({self.store} {self.gcs_uri} done:{self.done} success:{self.success} failure:{self.failure} error:{self.error})"
+
+
+class HealthcareImporter:
+    """Start and track FHIR store imports.
+
+    Examples: ::
+
+        importer = HealthcareImporter(project, location, dataset)
+        jobs = importer.import_all([
+            ('public', 'gs://my-bucket/workspace/public/*.json'),
+            ('1000G', 'gs://my-bucket/workspace/protected/*.json'),
+        ])
+        for row in importer.report(jobs):
+            print(row)
+
+    :param session: transport, a requests.Session like object; defaults to a pooled session signed with token_provider
+    :param api: base url of the Healthcare API, point at a local stub for testing
+    :param token_provider: defaults to the shared gcloud TokenProvider, ignored if session is passed
+    """
+
+    def __init__(self, project, location, dataset, session=None, api=HEALTHCARE_API, token_provider=None,
+                 max_workers=MAX_WORKERS, poll_interval=POLL_INTERVAL, max_poll_interval=MAX_POLL_INTERVAL, timeout=None):
+        """Initialize properties."""
+        self.dataset_path = f"projects/{project}/locations/{location}/datasets/{dataset}"
+        self.api = api.rstrip('/')
+        if session is None:
+            session = new_session()
+            session.auth = BearerAuth(token_provider or gcloud_provider())
+        self.session = session
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+
+    def _request(self, method, url, **kwargs):
+        """Send request, retry transient errors with backoff, return json."""
+        delay = self.poll_interval
+        for attempt in range(5):
+            response = self.session.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
+            logger.debug(f"{method} {url} returned {response.status_code}, retrying in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, self.max_poll_interval)
+        if not response.ok:
+            raise HealthcareImportError(f"{method} {url} returned {response.status_code} {response.text}")
+        return response.json()
+
+    def start(self, store, gcs_uri, content_structure='RESOURCE'):
+        """Start an import, return ImportJob."""
+        job = ImportJob(store, gcs_uri, content_structure)
+        url = f"{self.api}/{self.dataset_path}/fhirStores/{store}:import"
+        body = {'contentStructure': content_structure, 'gcsSource': {'uri': gcs_uri}}
+        job.started = time.time()
+        job.operation = self._request('POST', url, json=body)['name']
+        logger.info(f"started import {store} {gcs_uri} {job.operation}")
+        return job
+
+    def wait(self, job):
+        """Poll the job's operation until done, return job."""
+        delay = self.poll_interval
+        url = f"{self.api}/{job.operation}"
+        while not job.done:
+            if self.timeout and job.elapsed > self.timeout:
+                raise HealthcareImportError(f"timed out waiting for {job}")
+            time.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, self.max_poll_interval)
+            operation = self._request('GET', url)
+            job.polls += 1
+            counter = operation.get('metadata', {}).get('counter', {})
+            job.success = int(counter.get('success', 0))
+            job.failure = int(counter.get('failure', 0))
+            if operation.get('done'):
+                job.done = True
+                job.finished = time.time()
+                if 'error' in operation:
+                    job.error = operation['error'].get('message', str(operation['error']))
+        logger.info(f"finished {job}")
+        return job
+
+    def import_all(self, imports):
+        """Run imports, concurrently per store, in order within a store; return ImportJobs in the order given.
+
+        Errors starting or polling an import are recorded on the job, remaining imports for the store still run.
+
+        :param imports: list of (store, gcs_uri) or (store, gcs_uri, content_structure)
+        """
+        by_store = defaultdict(list)
+        jobs = [None] * len(imports)
+        for index, _import in enumerate(imports):
+            by_store[_import[0]].append((index, _import))
+        lock = threading.Lock()
+
+        def _run_store(store_imports):
+            for index, _import in store_imports:
+                store, gcs_uri = _import[0], _import[1]
+                content_structure = _import[2] if len(_import) > 2 else 'RESOURCE'
+                try:
+                    job = self.wait(self.start(store, gcs_uri, content_structure))
+                except Exception as e:
+                    job = ImportJob(store, gcs_uri, content_structure)
+                    job.error = str(e)
+                    logger.warning(f"import failed {job}")
+                with lock:
+                    jobs[index] = job
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(_run_store, by_store.values()))
+        return jobs
+
+    @staticmethod
+    def report(jobs):
+        """Return a summary per store: imports, resources imported, failures, errors, seconds and resources per second."""
+        rows = {}
+        for job in jobs:
+            row = rows.setdefault(job.store, {'store': job.store, 'imports': 0, 'success': 0, 'failure': 0, 'errors': 0, 'elapsed': 0.0})
+            row['imports'] += 1
+            row['success'] += job.success
+            row['failure'] += job.failure
+            row['errors'] += 1 if job.error else 0
+            row['elapsed'] += job.elapsed
+        for row in rows.values():
+            row['elapsed'] = round(row['elapsed'], 2)
+            row['per_second'] = round(row['success'] / row['elapsed'], 1) if row['elapsed'] else 0
+        return list(rows.values())
@@ -0,0 +1,223 @@
+"""Client side cache for GET responses, in memory and optionally sqlite, revalidated with ETag/Last-Modified."""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from anvil.clients.transport import GzipAdapter
+
+# `memory` or a sqlite path enables caching for anvil FHIR clients
+FHIR_CACHE = os.getenv('ANVIL_FHIR_CACHE') or None
+# seconds a response is served without contacting the server, after that it is revalidated
+FHIR_CACHE_TTL = int(os.getenv('ANVIL_FHIR_CACHE_TTL') or 300)
+# responses larger than this are not cached, bounds memory to MEMORY_ENTRIES * FHIR_CACHE_MAX_BYTES
+FHIR_CACHE_MAX_BYTES = int(os.getenv('ANVIL_FHIR_CACHE_MAX_BYTES') or 1024 * 1024)
+# entries are shared by all requests with this scope, regardless of credentials; only set it if they all see the same data
+FHIR_CACHE_SCOPE = os.getenv('ANVIL_FHIR_CACHE_SCOPE') or None
+# responses kept in memory
+MEMORY_ENTRIES = 1000
+
+# headers that describe the wire format, not the (decoded) content we store
+_WIRE_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+logger = logging.getLogger(__name__)
+_fhir_cache = None
+_fhir_cache_lock = threading.Lock()
+
+
+def auth_scope(request, scope=None):
+    """Return a digest of the request's principal, responses are only shared by requests with the same scope.
+
+    The principal is the caller supplied, trusted scope, otherwise it is the credentials themselves;
+    claims inside a token are never used, the cache can't verify them.
+    """
+    principal = scope or request.headers.get('Authorization', '')
+    credentials = f"{principal}|{request.headers.get('Cookie', '')}"
+    return hashlib.sha256(credentials.encode()).hexdigest()[:16]
+
+
+class ResponseCache:
+    """Store successful GET responses by URL and auth scope.
+
+    Entries live in an LRU dict and, if path is set, in sqlite so they survive restarts.
+    Only responses with an ETag or Last-Modified, of at most max_bytes, are stored.
+
+    :param scope: Optional, principal shared by all requests using this cache, see auth_scope
+    """
+
+    def __init__(self, path=None, ttl=FHIR_CACHE_TTL, memory_entries=MEMORY_ENTRIES, max_bytes=FHIR_CACHE_MAX_BYTES, scope=None):
+        """Set up memory and optional sqlite storage."""
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.scope = scope
+        self._memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key text PRIMARY KEY,
+                stored_at real,
+                status integer,
+                headers text,
+                body blob
+            );""")
+            self._conn.execute('PRAGMA synchronous = OFF')
+            self._conn.commit()
+
+    def get(self, key):
+        """Return entry dict or None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+            if self._conn is None:
+                return None
+            data = self._conn.execute("SELECT stored_at, status, headers, body FROM responses where key=?", (key,)).fetchone()
+            if data is None:
+                return None
+            entry = {'stored_at': data[0], 'status': data[1], 'headers': json.loads(data[2]), 'body': data[3]}
+            self._remember(key, entry)
+            return entry
+
+    def put(self, key, status, headers, body):
+        """Save a response."""
+        entry = {
+            'stored_at': time.time(),
+            'status': status,
+            'headers': {k: v for k, v in headers.items() if k.lower() not in _WIRE_HEADERS},
+            'body': body,
+        }
+        with self._lock:
+            self._remember(key, entry)
+            self._save(key, entry)
+        return entry
+
+    def touch(self, key, entry):
+        """Mark entry as fresh after the server confirmed it is unchanged."""
+        entry['stored_at'] = time.time()
+        with self._lock:
+            self._remember(key, entry)
+            self._save(key, entry)
+
+    def cacheable(self, response, stream=False):
+        """Return True if a 200 response can be revalidated later and is small enough to keep; reads the body unless streamed."""
+        headers = response.headers
+        if response.status_code != 200 or 'no-store' in headers.get('Cache-Control', ''):
+            return False
+        if not (headers.get('ETag') or headers.get('Last-Modified')):
+            return False
+        if int(headers.get('Content-Length') or 0) > self.max_bytes:
+            return False
+        # don't read a streamed body into memory
+        if stream:
+            return False
+        return len(response.content) <= self.max_bytes
+
+    def is_fresh(self, entry):
+        """Return True if entry is younger than ttl."""
+        return time.time() - entry['stored_at'] < self.ttl
+
+    def count(self, name):
+        """Increment a stats counter."""
+        with self._lock:
+            self.stats[name] += 1
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.commit()
+
+    def _remember(self, key, entry):
+        """Add to LRU, evict oldest."""
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_entries:
+            self._memory.popitem(last=False)
+
+    def _save(self, key, entry):
+        """Write to sqlite."""
+        if self._conn is None:
+            return
+        self._conn.execute(
+            "REPLACE into responses values (?, ?, ?, ?, ?);",
+            (key, entry['stored_at'], entry['status'], json.dumps(entry['headers']), entry['body'])
+        )
+        self._conn.commit()
+
+
+class CachingAdapter(GzipAdapter):
+    """Serve GETs from a ResponseCache; stale entries are revalidated with If-None-Match/If-Modified-Since."""
+
+    def __init__(self, cache, **kwargs):
+        """Set cache, pass pool settings to super."""
+        self.cache = cache
+        super(CachingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """Return cached response if fresh, otherwise make a (conditional) request."""
+        if request.method != 'GET' or 'no-cache' in request.headers.get('Cache-Control', ''):
+            return super(CachingAdapter, self).send(request, **kwargs)
+        key = f"{auth_scope(request, self.cache.scope)}|{request.url}"
+        entry = self.cache.get(key)
+        if entry and self.cache.is_fresh(entry):
+            self.cache.count('hits')
+            return self._cached_response(request, entry)
+        if entry:
+            etag, last_modified = entry['headers'].get('ETag'), entry['headers'].get('Last-Modified')
+            if etag:
+                request.headers['If-None-Match'] = etag
+            if last_modified:
+                request.headers['If-Modified-Since'] = last_modified
+        response = super(CachingAdapter, self).send(request, **kwargs)
+        if entry and response.status_code == 304:
+            response.close()
+            self.cache.count('revalidated')
+            self.cache.touch(key, entry)
+            return self._cached_response(request, entry)
+        self.cache.count('misses')
+        if self.cache.cacheable(response, kwargs.get('stream', False)):
+            self.cache.put(key, response.status_code, response.headers, response.content)
+        return response
+
+    def _cached_response(self, request, entry):
+        """Build a Response from a cache entry."""
+        response = Response()
+        response.status_code = entry['status']
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = entry['body']
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.from_cache = True
+        logger.debug(f"cached {request.url}")
+        return response
+
+
+def fhir_cache():
+    """Return the process wide ResponseCache configured by ANVIL_FHIR_CACHE, or None."""
+    global _fhir_cache
+    if not FHIR_CACHE:
+        return None
+    with _fhir_cache_lock:
+        if _fhir_cache is None:
+            _fhir_cache = ResponseCache(path=None if FHIR_CACHE == 'memory' else FHIR_CACHE, ttl=FHIR_CACHE_TTL, scope=FHIR_CACHE_SCOPE)
+        return _fhir_cache
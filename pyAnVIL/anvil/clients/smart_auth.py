@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 """Google gcloud access_token handling class for smart-on-fhir/client-py FHIR client."""
 import logging
-from subprocess import Popen, PIPE
 
 from fhirclient import auth
 
+from anvil.clients.token_provider import gcloud_provider, TokenError
+
 logger = logging.getLogger(__name__)
 
 REGISTERED = []
@@ -23,6 +24,7 @@ class GoogleFHIRAuth(auth.FHIRAuth):
         `pip install -e git+https://github.com/smart-on-fhir/client-py#egg=fhirclient`
 
     :param access_token: Optional access token, if none provided `gcloud auth print-access-token` is used
+    :param token_provider: Optional anvil.clients.token_provider.TokenProvider, defaults to the shared gcloud provider
 
     Examples:
         from fhirclient import client
@@ -45,10 +47,13 @@ class GoogleFHIRAuth(auth.FHIRAuth):
 
     auth_type = 'bearer'
 
-    def __init__(self, state=None, access_token=None):
+    def __init__(self, state=None, access_token=None, token_provider=None):
         """Initialize access_token, call super."""
         self.access_token = access_token
+        # a passed access_token is used as is, otherwise cached, refreshed tokens come from the provider
+        self._token_provider = None
         if not self.access_token:
+            self._token_provider = token_provider or gcloud_provider()
             self.access_token = self._get_auth_value()
         super(GoogleFHIRAuth, self).__init__(state=state)
 
@@ -57,6 +62,11 @@ class GoogleFHIRAuth(auth.FHIRAuth):
         """Return True if access_token exists."""
         return True if self.access_token else False
 
+    @property
+    def token_provider(self):
+        """Return TokenProvider, see its `stats` for refreshes, replays and retries avoided."""
+        return self._token_provider
+
     def reset(self):
         """Clear access_token."""
         super(GoogleFHIRAuth, self).reset()
@@ -73,6 +83,9 @@ class GoogleFHIRAuth(auth.FHIRAuth):
 
         if headers is None:
             headers = {}
+        if self._token_provider:
+            # picks up background refreshes
+            self.access_token = self._get_auth_value()
         headers['Authorization'] = "Bearer {0}".format(self.access_token)
 
         return headers
@@ -111,11 +124,16 @@ class GoogleFHIRAuth(auth.FHIRAuth):
         # copy the request to resend
         newreq = response.request.copy()
 
+        # only the first request failing with this token triggers a refresh
+        if not self._token_provider:
+            self._token_provider = gcloud_provider()
+        self._token_provider.invalidate(response.request.headers.get('Authorization', '').replace('Bearer ', '', 1))
         self.access_token = None
         logger.debug("handle_401, cleared _access_token, retrying with new token")
 
         self.access_token = self._get_auth_value()
         newreq.headers["Authorization"] = "Bearer {0}".format(self.access_token)
+        self._token_provider.record_replay(newreq)
 
         _response = response.connection.send(newreq, **kwargs)
         _response.history.append(response)
@@ -144,26 +162,11 @@ class GoogleFHIRAuth(auth.FHIRAuth):
         This fetches the access token from the refresh token if the access token is missing.
 
         """
-        if not self.access_token:
+        if self._token_provider:
             try:
-                # get the local access token using gcloud
-                cmd = ['gcloud', 'auth', 'print-access-token']
-                logger.debug(f"getting gcloud_access_token {cmd}")
-                p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-                gcloud_access_token, stderr = p.communicate()
-                # remove CR
-                gcloud_access_token = gcloud_access_token.decode("utf-8").rstrip()
-                assert len(gcloud_access_token) > 0, f'get gcloud_access_token MUST have an access token {stderr}'
-                logger.debug(f"gcloud_access_token {gcloud_access_token}")
-                self.access_token = gcloud_access_token
-                if logger.level == logging.DEBUG:
-                    logger.debug(self.access_token)
-                    print(self.access_token)
-                    # expires_at = datetime.fromisoformat(self.access_token['expires_at'])
-                    # logger.debug(f'access token expires in {str(expires_at - now)}')
-                    # # add padding
-                    # logger.debug(base64.b64decode(self._access_token.split('.')[1] + "==="))
-            except Exception as e:
+                # preflight, never sign with a token that may expire mid request
+                self.access_token = self._token_provider.preflight()
+            except TokenError as e:
                 raise FHIRAuthError(f"Failed to get gcloud_access_token {e}")
         return self.access_token
 
@@ -0,0 +1,209 @@
+"""Thread safe access token cache with expiry, proactive background refresh and coalesced refreshes."""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from subprocess import Popen, PIPE
+
+logger = logging.getLogger(__name__)
+
+# path to the gcloud binary, tests point this at a stub
+GCLOUD = os.getenv('ANVIL_GCLOUD') or 'gcloud'
+# assumed lifetime if `gcloud config config-helper` does not report the token's expiry
+GCLOUD_TOKEN_LIFETIME = int(os.getenv('ANVIL_GCLOUD_TOKEN_LIFETIME') or 3600)
+# refresh tokens this many seconds before they expire
+REFRESH_MARGIN = int(os.getenv('ANVIL_TOKEN_REFRESH_MARGIN') or 300)
+# a request is only signed with a token valid for at least this many seconds, longer than a large upload takes
+PREFLIGHT_MARGIN = int(os.getenv('ANVIL_TOKEN_PREFLIGHT_MARGIN') or 60)
+
+_gcloud_providers = {}
+_gcloud_providers_lock = threading.Lock()
+
+
+class TokenError(Exception):
+    """Reports any problem retrieving a token."""
+
+    pass
+
+
+class TokenProvider:
+    """Cache a token until shortly before it expires.
+
+    * `token()` returns the cached token, fetching one if missing or expired
+    * within `refresh_margin` of expiry a single background thread refreshes it, callers keep using the current token
+    * concurrent callers needing a new token wait for one fetch instead of each fetching
+    * `invalidate(token)` after a 401 forces a refresh, once, no matter how many requests failed with that token
+    * `preflight()` signs requests: a token about to expire is replaced before the request is sent,
+      and requests started during a refresh are held until it completes, rather than failing and being replayed
+
+    `stats` counts fetches, preflight refreshes and held requests (both are 401 retries avoided, a request is counted as one or the other) and replays.
+
+    :param fetch: callable returning (token, expires_at) where expires_at is epoch seconds
+    :param refresh_margin: seconds before expiry to start a background refresh
+    :param preflight_margin: seconds a token must remain valid to sign a request, see preflight()
+    """
+
+    def __init__(self, fetch, refresh_margin=REFRESH_MARGIN, preflight_margin=PREFLIGHT_MARGIN):
+        """Set fetch function."""
+        self._fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.preflight_margin = preflight_margin
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self.stats = {
+            'fetches': 0, 'background_refreshes': 0, 'invalidations': 0,
+            'preflight_refreshes': 0, 'held': 0, 'replays': 0, 'replayed_bytes': 0,
+        }
+
+    @property
+    def expires_at(self):
+        """Epoch seconds the current token expires, 0 if none."""
+        return self._expires_at
+
+    def is_valid(self, margin=0):
+        """Return True if there is a token valid for at least margin seconds."""
+        return self._token is not None and time.time() + margin < self._expires_at
+
+    @property
+    def retries_avoided(self):
+        """Requests that would have failed with an expired token and been replayed, each counted once."""
+        return self.stats['preflight_refreshes'] + self.stats['held']
+
+    def token(self, min_validity=0):
+        """Return a token valid for at least min_validity seconds."""
+        if not self.is_valid(min_validity):
+            preflight = self.is_valid()
+            if preflight:
+                self._count('preflight_refreshes')
+            return self.refresh(min_validity=min_validity, counted=preflight)
+        if not self.is_valid(self.refresh_margin):
+            self._refresh_in_background()
+        return self._token
+
+    def preflight(self):
+        """Return a token that will not expire while a request is in flight."""
+        return self.token(min_validity=self.preflight_margin)
+
+    def refresh(self, stale=None, min_validity=0, counted=False):
+        """Fetch a new token, unless another thread already replaced `stale` (or the expired token) while we waited.
+
+        :param counted: the request was already counted as a preflight refresh, don't count it as held as well
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            # another thread is refreshing, hold this request until it is done;
+            # only a request that would have been sent with the current token would have failed, not one waiting for the first
+            if not counted and self._token is not None:
+                self._count('held')
+            self._refresh_lock.acquire()
+        try:
+            if self.is_valid(min_validity) and (stale is None or self._token != stale):
+                return self._token
+            return self._do_fetch()
+        finally:
+            self._refresh_lock.release()
+
+    def record_replay(self, request):
+        """Count a request re-sent after a 401."""
+        body = request.body or b''
+        with self._lock:
+            self.stats['replays'] += 1
+            self.stats['replayed_bytes'] += len(body) if isinstance(body, (bytes, str)) else 0
+
+    def invalidate(self, token):
+        """Discard token if it is still current, e.g. after the server rejected it."""
+        with self._lock:
+            if self._token == token:
+                self.stats['invalidations'] += 1
+                self._expires_at = 0
+
+    def _count(self, name):
+        """Increment a stats counter."""
+        with self._lock:
+            self.stats[name] += 1
+
+    def _do_fetch(self):
+        """Call fetch, store result; callers hold _refresh_lock."""
+        token, expires_at = self._fetch()
+        with self._lock:
+            self._token, self._expires_at = token, expires_at
+            self.stats['fetches'] += 1
+        logger.debug(f"fetched token, expires in {int(expires_at - time.time())}s")
+        return token
+
+    def _refresh_in_background(self):
+        """Start one thread to refresh the token before it expires."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self.stats['background_refreshes'] += 1
+
+        def _refresh():
+            try:
+                with self._refresh_lock:
+                    if not self.is_valid(self.refresh_margin):
+                        self._do_fetch()
+            except Exception as e:
+                # callers still have the current token, the next token() call retries
+                logger.warning(f"background token refresh failed {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=_refresh, daemon=True).start()
+
+
+def gcloud_access_token(user_email=None, gcloud=None, min_validity=0):
+    """Run `gcloud config config-helper`, return (token, expires_at) of the account's current access token.
+
+    gcloud returns its cached token until it expires, one valid for less than min_validity seconds is refreshed
+    with `--force-auth-refresh`.
+    """
+    token, expires_at = _config_helper(user_email, gcloud)
+    if expires_at - time.time() < min_validity:
+        token, expires_at = _config_helper(user_email, gcloud, force_refresh=True)
+    return token, expires_at
+
+
+def _config_helper(user_email=None, gcloud=None, force_refresh=False):
+    """Run `gcloud config config-helper`, return (token, expires_at)."""
+    cmd = [gcloud or GCLOUD, 'config', 'config-helper', '--format=json']
+    if user_email:
+        cmd.append(f"--account={user_email}")
+    if force_refresh:
+        cmd.append('--force-auth-refresh')
+    logger.debug(f"getting gcloud_access_token {cmd}")
+    try:
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        output, stderr = p.communicate()
+    except OSError as e:
+        raise TokenError(f"Failed to run {cmd} {e}")
+    try:
+        credential = json.loads(output)['credential']
+    except (ValueError, KeyError, TypeError):
+        raise TokenError(f'get gcloud_access_token MUST have an access token {stderr}')
+    access_token = credential.get('access_token')
+    if not access_token:
+        raise TokenError(f'get gcloud_access_token MUST have an access token {stderr}')
+    token_expiry = credential.get('token_expiry')
+    if not token_expiry:
+        return access_token, time.time() + GCLOUD_TOKEN_LIFETIME
+    # e.g. 2021-10-01T12:00:00Z
+    return access_token, datetime.fromisoformat(token_expiry.replace('Z', '+00:00')).timestamp()
+
+
+def gcloud_provider(user_email=None, gcloud=None):
+    """Return the process wide TokenProvider for gcloud account user_email (None is the active account)."""
+    key = (user_email, gcloud or GCLOUD)
+    with _gcloud_providers_lock:
+        if key not in _gcloud_providers:
+            # a token refreshed because it is within refresh_margin of expiry must be a new one
+            provider = TokenProvider(lambda: gcloud_access_token(user_email, gcloud, min_validity=provider.refresh_margin))
+            _gcloud_providers[key] = provider
+        return _gcloud_providers[key]
@@ -0,0 +1,115 @@
+"""Shared HTTP transport for FHIR clients and scripts: sized keep-alive connection pools, gzip bodies."""
+
+import gzip
+import logging
+import os
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# number of hosts to keep pools for
+POOL_CONNECTIONS = int(os.getenv('ANVIL_POOL_CONNECTIONS') or 10)
+# connections kept alive per host, should be >= number of threads sharing the session
+POOL_MAXSIZE = int(os.getenv('ANVIL_POOL_MAXSIZE') or 32)
+# compress request bodies at least this large, 0 disables
+GZIP_MIN_SIZE = int(os.getenv('ANVIL_GZIP_MIN_SIZE') or 0)
+
+# authenticator -> {cache -> session}, released with the authenticator
+_auth_sessions = weakref.WeakKeyDictionary()
+# cache -> session, for servers without an authenticator
+_anonymous_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class GzipAdapter(HTTPAdapter):
+    """HTTPAdapter that gzip compresses large request bodies.
+
+    Responses are already decompressed by urllib3 when the server honors `Accept-Encoding: gzip`.
+    """
+
+    def __init__(self, gzip_min_size=GZIP_MIN_SIZE, **kwargs):
+        """Set threshold, pass pool settings to super."""
+        self.gzip_min_size = gzip_min_size
+        super(GzipAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """Compress body if large enough and not already encoded."""
+        body = request.body
+        if self.gzip_min_size and body and 'Content-Encoding' not in request.headers and not hasattr(body, 'read'):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            if len(body) >= self.gzip_min_size:
+                request.body = gzip.compress(body, compresslevel=5)
+                request.headers['Content-Encoding'] = 'gzip'
+                request.headers['Content-Length'] = str(len(request.body))
+        return super(GzipAdapter, self).send(request, **kwargs)
+
+
+def configure_session(session, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, gzip_min_size=GZIP_MIN_SIZE, max_retries=0, cache=None):
+    """Mount sized, blocking connection pools on session.
+
+    With `pool_block`, threads beyond pool_maxsize wait for a free connection instead of opening
+    (and then discarding) extra connections, so TLS handshakes are paid once per pooled connection.
+
+    Note: requests (and so fhirclient) only speaks HTTP/1.1, keep-alive reuse is the available optimization.
+
+    :param cache: optional anvil.clients.http_cache.ResponseCache for GET responses
+    """
+    adapter_kwargs = dict(
+        gzip_min_size=gzip_min_size,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+        max_retries=max_retries,
+    )
+    if cache is not None:
+        from anvil.clients.http_cache import CachingAdapter
+        adapter = CachingAdapter(cache, **adapter_kwargs)
+    else:
+        adapter = GzipAdapter(**adapter_kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.headers['Connection'] = 'keep-alive'
+    logger.debug(f"configured session pool_connections:{pool_connections} pool_maxsize:{pool_maxsize} gzip_min_size:{gzip_min_size}")
+    return session
+
+
+def new_session(**kwargs):
+    """Return a requests.Session configured with configure_session(**kwargs)."""
+    return configure_session(requests.Session(), **kwargs)
+
+
+def _weak_hook(method):
+    """Return a response hook calling method while its object is alive, so a session doesn't keep its authenticator alive."""
+    ref = weakref.WeakMethod(method)
+
+    def _hook(response, **kwargs):
+        """Pass response to method, or through if its object is gone."""
+        _method = ref()
+        return _method(response, **kwargs) if _method else response
+
+    return _hook
+
+
+def auth_session(auth=None, cache=None):
+    """Return the shared session for a FHIR authenticator, its handle_401 hook is registered once.
+
+    An authenticator's sessions are kept in a WeakKeyDictionary, so they are released with it
+    (keying a dict on id(auth) leaked them, and could hand them to a new object re-using the id).
+
+    :param cache: optional ResponseCache, see anvil.clients.http_cache.fhir_cache
+    """
+    with _sessions_lock:
+        sessions = _auth_sessions.setdefault(auth, {}) if auth else _anonymous_sessions
+        # keyed on the cache object itself, held as long as the session, so its id can't be re-used
+        session = sessions.get(cache)
+        if session is None:
+            session = sessions[cache] = new_session(cache=cache)
+            if auth:
+                session.hooks['response'].append(_weak_hook(auth.handle_401))
+    return session
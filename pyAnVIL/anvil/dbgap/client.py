@@ -0,0 +1,143 @@
+"""Fetch dbGap studies concurrently, keeping only the fields the dashboard uses."""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from anvil.clients.transport import new_session
+
+logger = logging.getLogger(__name__)
+
+# override to point at a local stub
+DBGAP_URL = os.getenv('ANVIL_DBGAP_URL') or 'https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin'
+# accessions fetched at once
+MAX_WORKERS = int(os.getenv('ANVIL_DBGAP_MAX_WORKERS') or 4)
+# requests per second across all workers, NCBI allows 3 without an API key
+RATE = float(os.getenv('ANVIL_DBGAP_RATE') or 3)
+# same file as anvil.util.cache, a table of its own
+CACHE_PATH = os.getenv('PYANVIL_CACHE_PATH', '/tmp/pyanvil-cache.sqlite')
+CACHE_TTL = 60 * 60 * 24 * 7
+
+
+class RateLimiter:
+    """Space calls to acquire() at least 1/rate seconds apart, across threads."""
+
+    def __init__(self, rate=RATE):
+        """Set rate, calls per second; 0 disables."""
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for the next slot."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class StudyCache:
+    """Studies in sqlite, one row per accession: qualified_accession, sample_count and sample_ids."""
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL):
+        """Create table."""
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._ttl = ttl
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS dbgap_studies (
+            accession text PRIMARY KEY,
+            qualified_accession text,
+            sample_count integer,
+            sample_ids text,
+            expiry TIMESTAMP
+        );""")
+        self._conn.commit()
+
+    def get(self, accession):
+        """Return study dict, None if missing or expired."""
+        now = datetime.now().replace(microsecond=0).isoformat()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT accession, qualified_accession, sample_count, sample_ids FROM dbgap_studies where accession = ? and expiry > ?;",
+                (accession, now)
+            ).fetchone()
+        if not row:
+            return None
+        return {'accession': row[0], 'qualified_accession': row[1], 'sample_count': row[2], 'sample_ids': json.loads(row[3])}
+
+    def put(self, study):
+        """Save study."""
+        expiry = (datetime.now() + timedelta(seconds=self._ttl)).replace(microsecond=0).isoformat()
+        with self._lock:
+            self._conn.execute(
+                "REPLACE into dbgap_studies values (?, ?, ?, ?, ?);",
+                (study['accession'], study['qualified_accession'], study['sample_count'], json.dumps(study['sample_ids']), expiry)
+            )
+            self._conn.commit()
+
+
+def sample_ids(stream):
+    """Return submitted sample ids of the Sample elements in a GetSampleStatus xml stream.
+
+    Elements are parsed incrementally and discarded, memory does not grow with the document.
+    """
+    ids = []
+    for _, element in ET.iterparse(stream):
+        if element.tag == 'Sample':
+            ids.append(element.get('submitted_sample_id'))
+            element.clear()
+    return ids
+
+
+def fetch_study(session, accession, limiter=None, base_url=DBGAP_URL):
+    """Return {'accession', 'qualified_accession', 'sample_count', 'sample_ids'}, None if the study can't be retrieved."""
+    qualified_accession = None
+    try:
+        if limiter:
+            limiter.acquire()
+        r = session.get(f"{base_url}/study.cgi?study_id={accession}", allow_redirects=False)
+        assert r.status_code == 302, r.status_code
+        qualified_accession = r.headers['location'].split('=')[1]
+        assert len(qualified_accession) > 0, f"No qualified study for {accession}"
+        if limiter:
+            limiter.acquire()
+        with session.get(f"{base_url}/GetSampleStatus.cgi?study_id={qualified_accession}&rettype=xml", stream=True) as r:
+            assert r.status_code == 200, f"status_code: {r.status_code} text:{r.text}"
+            r.raw.decode_content = True
+            ids = sample_ids(r.raw)
+        return {'accession': accession, 'qualified_accession': qualified_accession, 'sample_count': len(ids), 'sample_ids': ids}
+    except Exception as e:
+        logger.warning(f"{accession}/{qualified_accession} error: {e}")
+        return None
+
+
+def get_studies(accessions, max_workers=MAX_WORKERS, rate=RATE, cache=None, session=None, base_url=DBGAP_URL):
+    """Return {accession: study or None}, fetching accessions missing from cache concurrently.
+
+    :param cache: StudyCache, a default one is opened if None; failures are not cached
+    """
+    cache = cache or StudyCache()
+    studies = {}
+    for accession in set(accessions):
+        studies[accession] = cache.get(accession)
+    missing = [accession for accession, study in studies.items() if study is None]
+    if not missing:
+        return studies
+    session = session or new_session(pool_maxsize=max_workers)
+    limiter = RateLimiter(rate)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dbgap') as executor:
+        for accession, study in zip(missing, executor.map(lambda accession: fetch_study(session, accession, limiter, base_url), missing)):
+            studies[accession] = study
+            if study:
+                cache.put(study)
+    logger.info(f"Fetched {len(missing)} dbGap studies, {len(studies) - len(missing)} from cache")
+    return studies
@@ -2,11 +2,10 @@
 
 
 import logging
-import threading
-from urllib.parse import urlparse
 from fhirclient import client
-from fhirclient.models.meta import Meta
-from fhirclient.models.bundle import Bundle
+from anvil.clients import fhir_client
+from anvil.clients.transport import auth_session
+from anvil.clients.http_cache import fhir_cache
 
 from anvil.fhir.smart_auth import GoogleFHIRAuth
 
@@ -45,18 +44,20 @@ class FHIRClient(client.FHIRClient):
         client_major_version = int(client.__version__.split('.')[0])
         assert client_major_version >= 4, f"requires version >= 4.0.0 current version {client.__version__} `pip install -e git+https://github.com/smart-on-fhir/client-py#egg=fhirclient`"
         self.server.auth = GoogleFHIRAuth()
-        self.server.session.hooks['response'].append(self.server.auth.handle_401)
+        # pooled, keep-alive session
+        self.server.session = auth_session(self.server.auth, fhir_cache())
         self.prepare()
         assert self.ready, "server should be ready"
 
 
-class DispatchingFHIRClient(client.FHIRClient):
+class DispatchingFHIRClient(fhir_client.DispatchingFHIRClient):
     """Instances of this class handle authorizing and talking to Google Healthcare API FHIR Service.
 
     Parameters:
         See https://github.com/smart-on-fhir/client-py/blob/master/fhirclient/client.py#L19
 
     :param settings.api_bases: The servers against which to perform the search **settings.api_base ignored**
+    :param settings.retrieve_all: Optional, follow `next` links, defaults to True
     :param access_token: Optional access token, if none provided `gcloud auth print-access-token` is used
 
     Returns:
@@ -90,135 +91,8 @@ class DispatchingFHIRClient(client.FHIRClient):
     """
 
     def __init__(self, *args, **kwargs):
-        """Pass args to super, patches `perform` to our dispatching version."""
-        # use the first entry as 'our' server
-        _settings = dict(kwargs['settings'])
-        api_base = _settings['api_bases'].pop()
-        _settings['api_base'] = api_base
-        kwargs['settings'] = _settings
-
-        # grab a token if passed
-        access_token = None
-        if 'access_token' in kwargs:
-            access_token = kwargs['access_token']
-            del kwargs['access_token']
-
-        # normal setup with our authenticator
+        """Pass args to super with a GoogleFHIRAuth authenticator, all pages are retrieved unless settings.retrieve_all is False."""
+        kwargs['auth'] = GoogleFHIRAuth(access_token=kwargs.pop('access_token', None))
+        kwargs['settings'] = dict(kwargs['settings'])
+        kwargs['settings'].setdefault('retrieve_all', True)
         super(DispatchingFHIRClient, self).__init__(*args, **kwargs)
-        client_major_version = int(client.__version__.split('.')[0])
-        assert client_major_version >= 4, f"requires version >= 4.0.0 current version {client.__version__} `pip install -e git+https://github.com/smart-on-fhir/client-py#egg=fhirclient`"
-        self.server.auth = GoogleFHIRAuth(access_token=access_token)
-        self.server.session.hooks['response'].append(self.server.auth.handle_401)
-        self.prepare()
-        assert self.ready, "server should be ready"
-
-        # set up an array of FHIRClients, including this instance, in self._clients
-        # re-use authenticator
-        self._clients = [self]
-        self._api_bases = _settings['api_bases']
-        for api_base in self._api_bases:
-            __settings = dict(_settings)
-            __settings['api_base'] = api_base
-            _client = client.FHIRClient(settings=__settings)
-            _client.server.auth = self.server.auth
-            _client.server.session.hooks['response'].append(self.server.auth.handle_401)
-            _client.prepare()
-            self._clients.append(_client)
-
-        # monkey patch search perform if we haven't already
-        from fhirclient.models.fhirsearch import FHIRSearch
-        if not hasattr(FHIRSearch, '_anvil_patch'):
-            FHIRSearch._anvil_patch = True
-            logger.debug("******** Needs patching ********")
-            original_perform = FHIRSearch.perform
-            me = self
-
-            def _perform(self, server):
-                """Dispatch query to api_bases."""
-
-                def _worker(self, server, _results):
-                    """Dispatches request to underlying class, return an entry indexed by base uri.
-
-                    Sets bundle.meta.source
-                    See https://www.hl7.org/fhir/resource-definitions.html#Meta.source
-
-                    :param server: The server against which to perform the search
-                    :_results: Result of operation added to this array
-                    """
-                    logger.debug(f"worker starting {server.base_uri}")
-                    result = original_perform(self, server)
-                    logger.debug(f"worker got {result}")
-                    while result:
-
-                        # add source to meta if it doesn't already exist
-                        if not result.meta:
-                            result.meta = Meta()
-                        if not result.meta.source:
-                            result.meta.source = server.base_uri
-                        _results.append(result)
-
-                        # follow `next` link for pagination
-                        if hasattr(result, 'link'):
-                            _next = next((lnk.as_json() for lnk in result.link if lnk.relation == 'next'), None)
-                            result = None
-                            if _next:
-                                logger.debug(f"has next {_next}")
-                                # request_json takes a full path & query (not host)
-                                parts = urlparse(_next['url'])
-                                assert len(parts.query) > 0, parts
-                                path = f"{parts.path}?{parts.query}"
-                                logger.debug(f"attempting next {path}")
-                                res = server.request_json(path)
-                                result = Bundle(res)
-                                result.origin_server = server
-                        else:
-                            result = None
-                    logger.debug(f"worker done {result}")
-
-                logger.debug("starting threads")
-                workers = []
-                results = []
-                for _client in me._clients:
-                    workers.append(
-                        threading.Thread(target=_worker, args=(self, _client.server, results, ))
-                    )
-                # Start workers.
-                for w in workers:
-                    w.start()
-
-                # Wait for workers to quit.
-                logger.debug("waiting for results.")
-                for w in workers:
-                    w.join()
-                logger.debug(f"all workers done. {len(results)}")
-                return results
-            # monkey patch
-            FHIRSearch.perform = _perform
-
-            # since perform returns an array, patch _perform_resources as well.
-            def _perform_resources(self, server):
-                """Perform the search by calling `perform`, then extracts all Bundle entries and returns a list of Resource instances.
-
-                Sets resource.meta.source
-                See https://www.hl7.org/fhir/resource-definitions.html#Meta.source
-
-                :param server: The server against which to perform the search
-                :returns: A list of Resource instances
-                """
-                # flatten into an array of resources
-                bundles = self.perform(server)
-                resources = []
-                if bundles is not None:
-                    if not isinstance(bundles, list):
-                        bundles = [bundles]
-                    for bundle in bundles:
-                        if bundle.entry:
-                            for entry in bundle.entry:
-                                if not entry.resource.meta:
-                                    entry.resource.meta = Meta()
-                                if not entry.resource.meta.source:
-                                    entry.resource.meta.source = bundle.meta.source
-                                resources.append(entry.resource)
-                logger.debug("_perform_resources done.")
-                return resources
-            FHIRSearch.perform_resources = _perform_resources
@@ -1,9 +1,57 @@
 """Parse PFB avro, write sqlite, summarize."""
-from fastavro import reader
+from fastavro import reader, schemaless_reader
+from fastavro.read import HEADER_SCHEMA
+import hashlib
+import io
 import json
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, datetime
 import sqlite3
 import logging
+from itertools import islice
+
+from anvil.util.hyperloglog import HyperLogLog
+
+# records decoded and written per executemany / transaction; larger batches keep more records alive
+# and make the garbage collector's full collections slower than the sqlite calls saved
+BATCH_SIZE = 5000
+# processes decoding avro blocks, see Entities.load_parallel; 1 decodes in the calling process,
+# more is an explicit opt in for command line loads, not for threaded servers (e.g. gcp's gunicorn container)
+WORKERS = int(os.getenv('ANVIL_PFB_WORKERS') or 1)
+# bytes of avro blocks decoded per task
+CHUNK_BYTES = 8 * 1024 * 1024
+# node properties projected into vertices columns at load time, so queries don't parse json; column: property
+COLUMNS = {
+    'project_id': 'project_id',
+    'anvil_project_id': 'anvil_project_id',
+    'participant_id': 'participant_id',
+    'object_submitter_id': 'submitter_id',
+    'sample_id': 'sample_id',
+    'specimen_id': 'specimen_id',
+    'ga4gh_drs_uri': 'ga4gh_drs_uri',
+    'file_name': 'file_name',
+    'md5sum': 'md5sum',
+}
+PROPERTIES = list(COLUMNS.values())
+# summarize with HyperLogLog sketches, one pass in fixed memory per project, counts within ~1%
+APPROXIMATE_SUMMARY = (os.getenv('ANVIL_APPROXIMATE_SUMMARY') or '').lower() == 'true'
+SUMMARY_COUNTS = {
+    'subject_count': 'subject_id',
+    'sample_count': 'sample_id',
+    'sequencing_count': 'sequencing_id',
+    'ga4gh_drs_uri_count': 'ga4gh_drs_uri',
+}
+# hash: of the node's json, source: identity of the export that last wrote the node, see Entities
+VERTEX_COLUMNS = ['key', 'submitter_id', 'name', 'json'] + list(COLUMNS) + ['hash', 'source']
+INSERT_VERTEX = f"into {{table}}({', '.join(VERTEX_COLUMNS)}) values ({', '.join(['?'] * len(VERTEX_COLUMNS))});"
+# per export counts of records read and nodes inserted, updated, deleted and unchanged
+HISTORY_COLUMNS = {
+    'signature': 'text', 'loaded_at': 'text',
+    'records': 'integer', 'inserted': 'integer', 'updated': 'integer', 'deleted': 'integer', 'unchanged': 'integer',
+}
 
 
 def json_serial(obj):
@@ -13,12 +61,229 @@ def json_serial(obj):
     raise TypeError("Type %s not serializable" % type(obj))
 
 
+_encode = json.JSONEncoder(default=json_serial, check_circular=False).encode
+
+
+def _read_long(fo):
+    """Read a zig-zag varint, None at end of file."""
+    b = fo.read(1)
+    if not b:
+        return None
+    n = b[0] & 0x7F
+    shift = 7
+    while b[0] & 0x80:
+        b = fo.read(1)
+        n |= (b[0] & 0x7F) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1)
+
+
+def avro_blocks(avro_path):
+    """Return (header_size, [(offset, size), ...]) of the data blocks in an avro container file, without decoding them."""
+    blocks = []
+    with open(avro_path, 'rb') as fo:
+        sync = schemaless_reader(fo, HEADER_SCHEMA)['sync']
+        header_size = fo.tell()
+        while True:
+            offset = fo.tell()
+            if _read_long(fo) is None:
+                break
+            size = _read_long(fo)
+            fo.seek(size, io.SEEK_CUR)
+            if fo.read(16) != sync:
+                raise ValueError(f"{avro_path} sync marker not found after block at {offset}")
+            blocks.append((offset, fo.tell() - offset))
+    return header_size, blocks
+
+
+def _chunks(blocks, chunk_bytes):
+    """Group consecutive blocks into (start, end) byte ranges of about chunk_bytes."""
+    start = end = None
+    for offset, size in blocks:
+        if start is None:
+            start = offset
+        end = offset + size
+        if end - start >= chunk_bytes:
+            yield start, end
+            start = None
+    if start is not None:
+        yield start, end
+
+
+def ensure_columns(conn):
+    """Add columns missing from vertices and history tables created by an older version, filling COLUMNS from json."""
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(vertices);")}
+    missing = [column for column in COLUMNS if column not in existing]
+    for column in missing + [column for column in ['hash', 'source'] if column not in existing]:
+        conn.execute(f"ALTER TABLE vertices ADD COLUMN {column} text;")
+    if missing:
+        assignments = ', '.join(f"{column} = json_extract(json, '$.object.{COLUMNS[column]}')" for column in missing)
+        conn.execute(f"UPDATE vertices SET {assignments};")
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(history);")}
+    for column, _type in HISTORY_COLUMNS.items():
+        if existing and column not in existing:
+            conn.execute(f"ALTER TABLE history ADD COLUMN {column} {_type};")
+    conn.commit()
+
+
+FLATTENED = """
+    select
+        su.project_id as "project_id",
+        su.anvil_project_id as "anvil_project_id",
+        su.name as "subject_type",
+        su.key as "subject_id",
+        su.participant_id as "participant_id",
+        su.object_submitter_id as "subject_submitter_id",
+        sa.name as "sample_type",
+        sa.key  as "sample_id",
+        sa.sample_id as "sample_sample_id",
+        sa.object_submitter_id as "sample_submitter_id",
+        sa.specimen_id as "sample_specimen_id",
+        'sequencing' as "sequencing_type",
+        sequencing_edge.src  as "sequencing_id",
+        sq.object_submitter_id as "sequencing_submitter_id",
+        sq.ga4gh_drs_uri as "ga4gh_drs_uri"
+        from vertices as su
+            join edges as sample_edge on sample_edge.dst = su.key and sample_edge.src_name = 'sample'
+                join vertices as sa on sample_edge.src = sa.key
+                    left join edges as sequencing_edge on sequencing_edge.dst = sa.key and sequencing_edge.src_name = 'sequencing'
+                        join vertices as sq on sequencing_edge.src = sq.key
+
+        where
+        su.name = 'subject'
+"""
+
+
+def _table_exists(conn, name):
+    """Return True if table exists."""
+    return conn.execute("select count(*) from sqlite_master where type = 'table' and name = ?;", (name,)).fetchone()[0] == 1
+
+
+def _select_projects(conn, projects):
+    """Store project_ids in temp.selected_projects, return the filter for a project_id column."""
+    conn.executescript("drop table if exists temp.selected_projects; create temp table selected_projects (project_id text primary key);")
+    conn.executemany("insert or ignore into selected_projects values (?);", [(project,) for project in projects])
+    return "project_id in (select project_id from temp.selected_projects)"
+
+
+def flatten(conn, projects=None):
+    """Create the flattened table (subject, sample, sequencing rows), or refresh only the rows of projects."""
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(flattened);")}
+    # a flattened table from an older version lacks sample_specimen_id, rebuild it
+    rebuild = projects is None or 'sample_specimen_id' not in existing
+    if rebuild:
+        conn.executescript(f"drop table if exists flattened; create table flattened as {FLATTENED};")
+    # delta loads delete and re-insert the rows of affected projects
+    conn.execute("CREATE INDEX IF NOT EXISTS flattened_project_id ON flattened(project_id);")
+    if not rebuild:
+        where = _select_projects(conn, projects)
+        conn.execute(f"delete from flattened where {where};")
+        conn.execute(f"insert into flattened {FLATTENED} and su.{where};")
+    conn.commit()
+
+
+def summarize(conn, approximate=False, projects=None):
+    """Create the summary table, distinct subjects, samples, sequencing and drs uris per project from flattened.
+
+    One grouped pass over flattened; with approximate, a streaming pass updating HyperLogLog sketches per project.
+    With projects, only those projects' rows are recomputed.
+    """
+    where = 'true'
+    if projects is None or not _table_exists(conn, 'summary'):
+        conn.execute("drop table if exists summary;")
+        conn.execute(f"create table summary (project_id text, anvil_project_id text, {', '.join(f'{name} integer' for name in SUMMARY_COUNTS)});")
+        conn.execute("CREATE INDEX summary_project_id ON summary(project_id);")
+    else:
+        conn.execute("CREATE INDEX IF NOT EXISTS summary_project_id ON summary(project_id);")
+        where = _select_projects(conn, projects)
+        conn.execute(f"delete from summary where {where};")
+    if not approximate:
+        counts = ', '.join(f'count(distinct {column}) as "{name}"' for name, column in SUMMARY_COUNTS.items())
+        conn.execute(f"""
+            insert into summary
+            select project_id, anvil_project_id, {counts}
+            from flattened
+            where {where}
+            group by project_id, anvil_project_id;
+        """)
+        conn.commit()
+        return
+    sketches = {}
+    for row in conn.execute(f"select project_id, anvil_project_id, {', '.join(SUMMARY_COUNTS.values())} from flattened where {where};"):
+        project = sketches.get(row[:2])
+        if project is None:
+            project = sketches[row[:2]] = [HyperLogLog() for _ in SUMMARY_COUNTS]
+        for sketch, value in zip(project, row[2:]):
+            sketch.add(value)
+    conn.executemany(
+        f"insert into summary values ({', '.join(['?'] * (2 + len(SUMMARY_COUNTS)))});",
+        [key + tuple(len(sketch) for sketch in project) for key, project in sketches.items()]
+    )
+    conn.commit()
+
+
+def _vertex(record):
+    """Return vertices row for record, without source."""
+    _object = record['object']
+    encoded = _encode(record)
+    digest = hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+    return (record['id'], submitter_id(record), record['name'], encoded) + tuple(_object.get(p) for p in PROPERTIES) + (digest,)
+
+
+def _rows(records, source=None):
+    """Return (vertices, edges) rows for records."""
+    vertices = []
+    edges = []
+    for record in records:
+        vertices.append(_vertex(record) + (source,))
+        edges.extend((record['id'], r['dst_id'], record['name'], r['dst_name']) for r in record['relations'])
+    return vertices, edges
+
+
+def _decode_range(avro_path, header_size, start, end, source=None):
+    """Decode the blocks in [start, end), runs in a worker process."""
+    with open(avro_path, 'rb') as fo:
+        header = fo.read(header_size)
+        fo.seek(start)
+        data = fo.read(end - start)
+    return _rows(reader(io.BytesIO(header + data)), source)
+
+
+def submitter_id(record):
+    """Deduce 'natural' key.
+
+    See https://docs.google.com/spreadsheets/d/1MxfcWDXhTfFNFKsbRGjGTQkBoTirNktj04lf6L9_jmk/edit#gid=0
+    """
+    name = record['name']
+    if 'specimen_id' in record['object'] and name == 'sample':
+        return record['object']['specimen_id']
+    if 'participant_id' in record['object'] and name == 'subject':
+        return record['object']['participant_id']
+    if 'file_name' in record['object'] and name == 'sequencing':
+        return record['object']['file_name']
+    if 'dbgap_accession_number' in record['object'] and name == 'program':
+        return record['object']['dbgap_accession_number']
+    if 'code' in record['object'] and name == 'project':
+        return record['object']['code']
+    if record['name'] == 'Metadata':
+        return f"{record['name']}/schema"
+    if 'submitter_id' in record['object']:
+        return record['object']['submitter_id']
+    assert False, record
+
+
 class Entities:
     """Represent gen3 objects."""
 
-    def __init__(self, avro_path, drs_output_path):
-        """Simplify blob."""
+    def __init__(self, avro_path, drs_output_path, source=None):
+        """Simplify blob.
+
+        :param source: Optional, stable identity of the export (e.g. its program/project), defaults to avro_path;
+            a later export with the same source releases the nodes it no longer contains, whatever its file is named,
+            a node is deleted once no source holds it
+        """
         self.avro_path = avro_path
+        self.source = source or avro_path
         self._conn = sqlite3.connect(drs_output_path)
         cur = self._conn.cursor()
         cur.executescript("""
@@ -26,7 +291,18 @@ class Entities:
             key text PRIMARY KEY,
             submitter_id text,
             name text,
-            json text NOT NULL
+            json text NOT NULL,
+            project_id text,
+            anvil_project_id text,
+            participant_id text,
+            object_submitter_id text,
+            sample_id text,
+            specimen_id text,
+            ga4gh_drs_uri text,
+            file_name text,
+            md5sum text,
+            hash text,
+            source text
         );
         CREATE TABLE IF NOT EXISTS edges (
             src text,
@@ -34,9 +310,25 @@ class Entities:
             src_name text,
             dst_name text
         );
+        -- every source (export) that contains a node
+        CREATE TABLE IF NOT EXISTS sources (
+            source text,
+            key text,
+            PRIMARY KEY (source, key)
+        );
+        CREATE INDEX IF NOT EXISTS sources_key ON sources(key);
         CREATE TABLE IF NOT EXISTS history (
-            key text
+            key text,
+            signature text,
+            loaded_at text,
+            records integer,
+            inserted integer,
+            updated integer,
+            deleted integer,
+            unchanged integer
         );
+        -- de-duplicates edges on insert
+        CREATE UNIQUE INDEX IF NOT EXISTS edges_src_dst ON edges(src, dst, src_name, dst_name);
         """)
         self._conn.commit()
         # optimize for single thread speed
@@ -45,14 +337,27 @@ class Entities:
         self._conn.commit()
         self._conn.close()
         self._conn = sqlite3.connect(drs_output_path, check_same_thread=False, isolation_level='DEFERRED')
+        self._conn.execute('PRAGMA synchronous = OFF')
+        ensure_columns(self._conn)
 
     def put(self, key, submitter_id, name, data, cur):
         """Save an item."""
-        cur.execute("REPLACE into vertices values (?, ?, ?, ?);", (key, submitter_id, name, json.dumps(data, default=json_serial)))
+        cur.execute(f"REPLACE {INSERT_VERTEX.format(table='vertices')}", (key, submitter_id, name) + _vertex(data)[3:] + (None,))
         for r in data['relations']:
             cur.execute("REPLACE into edges values (?, ?, ?, ?);", (key, r['dst_id'], data['name'], r['dst_name']))
         # self._logger.debug(f"put {key}")
 
+    def put_many(self, records, cur, source=None, staged=False):
+        """Save a batch of records, records whose id is already stored are ignored."""
+        return self._write(_rows(records, source), cur, staged)
+
+    def _write(self, rows, cur, staged=False):
+        """Insert (vertices, edges) rows into the store, or the incoming tables if staged; return number of vertices."""
+        vertices, edges = rows
+        cur.executemany(f"INSERT OR IGNORE {INSERT_VERTEX.format(table='incoming' if staged else 'vertices')}", vertices)
+        cur.executemany(f"INSERT OR IGNORE into {'incoming_edges' if staged else 'edges'} values (?, ?, ?, ?);", edges)
+        return len(vertices)
+
     def get(self, key=None, submitter_id=None):
         """Retrieve an item."""
         cur = self._conn.cursor()
@@ -64,108 +369,184 @@ class Entities:
             return json.loads(data[0])
         assert False, f"NOT FOUND {key} {submitter_id}"
 
-    def load(self):
-        """Load sqlite db from file."""
+    def load_records(self, records, source=None, staged=False):
+        """Write records in BATCH_SIZE transactions, return the number of records read."""
+        cur = self._conn.cursor()
+        count = 0
+        start = datetime.now()
+        while True:
+            batch = list(islice(records, BATCH_SIZE))
+            if not batch:
+                break
+            count += self.put_many(batch, cur, source, staged)
+            self._conn.commit()
+        seconds = (datetime.now() - start).total_seconds()
+        logging.getLogger(__name__).info(f'Loaded {count} records in {seconds:.1f}s {count / (seconds or 1):.0f} records/s')
+        return count
+
+    def load_parallel(self, workers=WORKERS, chunk_bytes=CHUNK_BYTES, source=None, staged=False):
+        """Decode avro_path's blocks in a process pool, write them in file order, return the number of records read.
+
+        Workers also JSON encode the records, the main process only writes rows.
+        Workers are spawned rather than forked, the caller's threads and locks are not copied into them.
+        """
+        header_size, blocks = avro_blocks(self.avro_path)
+        cur = self._conn.cursor()
+        count = 0
+        start = datetime.now()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            # a bounded window of tasks keeps decoded rows from piling up faster than sqlite writes them
+            pending = deque()
+            for chunk_start, chunk_end in _chunks(blocks, chunk_bytes):
+                pending.append(pool.submit(_decode_range, self.avro_path, header_size, chunk_start, chunk_end, source))
+                if len(pending) >= workers * 2:
+                    count += self._write(pending.popleft().result(), cur, staged)
+                    self._conn.commit()
+            while pending:
+                count += self._write(pending.popleft().result(), cur, staged)
+                self._conn.commit()
+        seconds = (datetime.now() - start).total_seconds()
+        logging.getLogger(__name__).info(f'Loaded {count} records from {len(blocks)} blocks with {workers} workers in {seconds:.1f}s {count / (seconds or 1):.0f} records/s')
+        return count
+
+    def _signature(self, stream):
+        """Identify the export file's content cheaply: size and modification time, None for streams."""
+        if stream is not None or not os.path.isfile(self.avro_path):
+            return None
+        stat = os.stat(self.avro_path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _stage(self, cur):
+        """Create empty temp tables for an export's rows."""
+        columns = ', '.join(f"{column} text{' PRIMARY KEY' if column == 'key' else ''}" for column in VERTEX_COLUMNS)
+        cur.executescript(f"""
+        drop table if exists temp.incoming;
+        drop table if exists temp.incoming_edges;
+        create temp table incoming ({columns});
+        create temp table incoming_edges (src text, dst text, src_name text, dst_name text);
+        """)
+
+    def _apply(self, cur):
+        """Apply the difference between the incoming tables and the nodes previously loaded from this export.
+
+        Nodes this export no longer contains are released, and deleted if no other source still holds them.
+        Return (counts, affected project_ids).
+        """
+        source = self.source
+        cur.executescript("""
+        drop table if exists temp.changes;
+        create temp table changes (key text PRIMARY KEY, change text);
+        insert into changes
+            select i.key, case when v.key is null then 'inserted' else 'updated' end
+            from incoming as i left join vertices as v on v.key = i.key
+            where v.key is null or v.hash is not i.hash;
+        """)
+        cur.execute("drop table if exists temp.released;")
+        cur.execute("""
+        create temp table released as
+            select key from sources where source = ? and not exists (select 1 from incoming as i where i.key = sources.key);
+        """, (source,))
+        cur.execute("delete from sources where source = ? and key in (select key from released);", (source,))
+        cur.executescript("""
+        insert into changes
+            select r.key, 'deleted' from released as r where not exists (select 1 from sources as s where s.key = r.key);
+        drop table temp.released;
+        """)
+        counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        counts.update(cur.execute("select change, count(*) from changes group by change;").fetchall())
+        counts['unchanged'] = cur.execute("select count(*) from incoming;").fetchone()[0] - counts['inserted'] - counts['updated']
+        # old and new project of every changed node
+        projects = [row[0] for row in cur.execute("""
+            select project_id from vertices where key in (select key from changes)
+            union
+            select project_id from incoming where key in (select key from changes);
+        """) if row[0] is not None]
+
+        columns = ', '.join(VERTEX_COLUMNS)
+        cur.executescript(f"""
+        delete from edges where src in (select key from changes);
+        -- edges into deleted nodes would dangle
+        delete from edges where dst in (select key from changes where change = 'deleted');
+        delete from vertices where key in (select key from changes where change = 'deleted');
+        insert or replace into vertices({columns})
+            select {columns} from incoming where key in (select key from changes where change <> 'deleted');
+        insert or ignore into edges
+            select * from incoming_edges where src in (select key from changes where change <> 'deleted');
+        """)
+        cur.execute("insert or ignore into sources select ?, key from incoming;", (source,))
+        cur.executescript("""
+        drop table temp.changes;
+        drop table temp.incoming;
+        drop table temp.incoming_edges;
+        """)
+        self._conn.commit()
+        return counts, projects
+
+    def load(self, stream=None, workers=WORKERS):
+        """Load the export at avro_path, or stream (e.g. a PrefetchReader over a download) as bytes arrive.
+
+        The first export is written directly. Later exports are staged and compared with the store by node id and
+        content hash: new nodes are inserted, changed nodes updated, and nodes this export (same source, see __init__)
+        loaded before but no longer contains are deleted, with the edges into them, unless another source still holds them. Flattened and summary rows are refreshed for affected projects only.
+        An export whose path, size and modification time are in history is skipped.
+        With workers > 1, files are decoded by that many processes, see load_parallel.
+        History is only written once loading completes, so a failed load can be retried.
+        """
         cur = self._conn.cursor()
-        ids = {}
         logging.getLogger(__name__).info(f'Loading {self.avro_path}')
 
-        loaded_already = cur.execute("SELECT count(*) FROM history WHERE key=?;", (self.avro_path,)).fetchone()[0]
-        if loaded_already == 1:
+        signature = self._signature(stream)
+        loaded_already = cur.execute("SELECT count(*) FROM history WHERE key=? and signature=?;", (self.avro_path, signature)).fetchone()[0]
+        if signature and loaded_already:
             logging.getLogger(__name__).info(f'Already indexed {self.avro_path}')
             return
 
-        # index_count = cur.execute("SELECT count(*) FROM sqlite_master WHERE type='index' and name='vertices_submitter_id';").fetchone()[0]
-        # if index_count == 1:
-        #     logging.getLogger(__name__).info('Already indexed')
-        #     return
-
-        with open(self.avro_path, 'rb') as fo:
-            for record in reader(fo):
-                if record['id'] not in ids:
-                    self.put(record['id'], self._submitter_id(record), record['name'], record, cur)
-                    ids[record['id']] = None
-        self._conn.commit()
+        staged = cur.execute("SELECT count(*) FROM (SELECT key FROM vertices LIMIT 1);").fetchone()[0] == 1
+        if staged:
+            self._stage(cur)
+        if stream is None and workers > 1:
+            records = self.load_parallel(workers, source=self.source, staged=staged)
+        else:
+            fo = stream or open(self.avro_path, 'rb')
+            try:
+                records = self.load_records(reader(fo), source=self.source, staged=staged)
+            finally:
+                if stream is None:
+                    fo.close()
+        # stores loaded before sources was tracked, or this first load, are owned by the source of their nodes
+        cur.execute("insert or ignore into sources select source, key from vertices where source is not null and not exists (select 1 from sources);")
+        if staged:
+            counts, projects = self._apply(cur)
+        else:
+            counts, projects = {'inserted': cur.execute("SELECT count(*) FROM vertices;").fetchone()[0], 'updated': 0, 'deleted': 0, 'unchanged': 0}, None
+        logging.getLogger(__name__).info(f'Loaded {records} records {counts}, affected projects {projects}')
 
         logging.getLogger(__name__).info('Indexing')
         cur.executescript("""
         CREATE  INDEX IF NOT EXISTS vertices_submitter_id ON vertices(submitter_id);
+        -- flatten selects nodes by name, delta loads also by project
+        DROP INDEX IF EXISTS vertices_name;
+        CREATE  INDEX IF NOT EXISTS vertices_name_project_id ON vertices(name, project_id);
+        CREATE  INDEX IF NOT EXISTS vertices_project_id ON vertices(project_id);
+        -- ownership is kept in sources
+        DROP INDEX IF EXISTS vertices_source;
         CREATE UNIQUE INDEX IF NOT EXISTS edges_src_dst ON edges(src, dst, src_name, dst_name);
         CREATE  INDEX IF NOT EXISTS edges_dst ON edges(dst);
         """)
         self._conn.commit()
 
         logging.getLogger(__name__).info('Flattening')
-        cur.executescript("""
-        drop table if exists flattened ;
-        create table flattened
-        as
-        select
-            json_extract(su.json, '$.object.project_id') as "project_id",
-            json_extract(su.json, '$.object.anvil_project_id') as "anvil_project_id",
-            su.name as "subject_type",
-            su.key as "subject_id",
-            json_extract(su.json, '$.object.participant_id') as "participant_id",
-            json_extract(su.json, '$.object.submitter_id') as "subject_submitter_id",
-            sa.name as "sample_type",
-            sa.key  as "sample_id",
-            json_extract(sa.json, '$.object.sample_id') as "sample_sample_id",
-            json_extract(sa.json, '$.object.submitter_id') as "sample_submitter_id",
-            'sequencing' as "sequencing_type",
-            sequencing_edge.src  as "sequencing_id",
-            json_extract(sq.json, '$.object.submitter_id') as "sequencing_submitter_id",
-            json_extract(sq.json, '$.object.ga4gh_drs_uri') as "ga4gh_drs_uri"
-            from vertices as su
-                join edges as sample_edge on sample_edge.dst = su.key and sample_edge.src_name = 'sample'
-                    join vertices as sa on sample_edge.src = sa.key
-                        left join edges as sequencing_edge on sequencing_edge.dst = sa.key and sequencing_edge.src_name = 'sequencing'
-                            join vertices as sq on sequencing_edge.src = sq.key
-
-            where
-            su.name = 'subject'            ;
-        """)
-        self._conn.commit()
+        flatten(self._conn, projects)
 
         logging.getLogger(__name__).info('Summarizing')
-        cur.executescript("""
-            drop table if exists summary ;
-            create table summary
-            as
-            select f.project_id, f.anvil_project_id,
-                count(distinct f.subject_id) as "subject_count",
-                count(distinct f.sample_id) as "sample_count",
-                count(distinct m.sequencing_id) as "sequencing_count",
-                count(distinct m.ga4gh_drs_uri) as "ga4gh_drs_uri_count"
-                from flattened as f
-                    left join flattened as m on f.project_id = m.project_id and f.anvil_project_id = m.anvil_project_id
-                group by f.project_id, f.anvil_project_id;
-        """)
-        self._conn.commit()
+        summarize(self._conn, approximate=APPROXIMATE_SUMMARY, projects=projects)
 
         logging.getLogger(__name__).info('Updating history')
         cur.execute("""
-            insert into history(key) values(?);
-        """, (self.avro_path,))
+            insert into history(key, signature, loaded_at, records, inserted, updated, deleted, unchanged) values(?, ?, ?, ?, ?, ?, ?, ?);
+        """, (self.avro_path, signature, datetime.now().isoformat(), records, counts['inserted'], counts['updated'], counts['deleted'], counts['unchanged']))
         self._conn.commit()
 
     def _submitter_id(self, record):
-        """Deduce 'natural' key.
-
-        See https://docs.google.com/spreadsheets/d/1MxfcWDXhTfFNFKsbRGjGTQkBoTirNktj04lf6L9_jmk/edit#gid=0
-        """
-        name = record['name']
-        if 'specimen_id' in record['object'] and name == 'sample':
-            return record['object']['specimen_id']
-        if 'participant_id' in record['object'] and name == 'subject':
-            return record['object']['participant_id']
-        if 'file_name' in record['object'] and name == 'sequencing':
-            return record['object']['file_name']
-        if 'dbgap_accession_number' in record['object'] and name == 'program':
-            return record['object']['dbgap_accession_number']
-        if 'code' in record['object'] and name == 'project':
-            return record['object']['code']
-        if record['name'] == 'Metadata':
-            return f"{record['name']}/schema"
-        if 'submitter_id' in record['object']:
-            return record['object']['submitter_id']
-        assert False, record
+        """Deduce 'natural' key, see submitter_id."""
+        return submitter_id(record)
@@ -0,0 +1,83 @@
+"""Check the gen3 PFB graph in gen3-drs.sqlite for orphans, childless nodes and dangling edges."""
+
+import logging
+
+# node type -> the type each node should point to (edges.src -> edges.dst)
+EXPECTED_PARENTS = {'sample': 'subject', 'sequencing': 'sample'}
+# node type -> the type that should point to each node
+EXPECTED_CHILDREN = {'subject': 'sample', 'sample': 'sequencing'}
+PROBLEMS = ['missing_parent', 'missing_child', 'dangling']
+
+# covering indexes for the anti joins: is there an edge from key to a node of type, to key from a node of type
+INDEXES = """
+    CREATE INDEX IF NOT EXISTS edges_src_dst_name ON edges(src, dst_name);
+    CREATE INDEX IF NOT EXISTS edges_dst_src_name ON edges(dst, src_name);
+"""
+
+
+def _case(expected, exists):
+    """Return a CASE on v.name, for each expected type the anti join exists, and its parameters."""
+    if not expected:
+        return '0', []
+    whens = ' '.join(f"when ? then not exists ({exists})" for _ in expected)
+    return f"case v.name {whens} else 0 end", [value for item in expected.items() for value in item]
+
+
+def ensure_indexes(conn):
+    """Create the covering indexes the checks use."""
+    conn.executescript(INDEXES)
+    conn.commit()
+
+
+def check(conn, expected_parents=EXPECTED_PARENTS, expected_children=EXPECTED_CHILDREN):
+    """Check every vertex in one pass, return counts per node type and project.
+
+    Creates node_problems, a row per vertex with a problem, and graph_integrity, a row per (name, project_id) with
+    the number of nodes and of nodes with each of PROBLEMS:
+
+    * missing_parent: no edge to a node of its expected parent type (e.g. sample without subject)
+    * missing_child: no edge from a node of its expected child type (e.g. sample without sequencing)
+    * dangling: an edge to a key that is not a vertex
+
+    :return: list of dicts, graph_integrity rows
+    """
+    ensure_indexes(conn)
+    missing_parent, parent_parameters = _case(expected_parents, "select 1 from edges as e where e.src = v.key and e.dst_name = ?")
+    missing_child, child_parameters = _case(expected_children, "select 1 from edges as e where e.dst = v.key and e.src_name = ?")
+    conn.executescript(f"""
+        drop table if exists node_problems;
+        create table node_problems (key text, submitter_id text, name text, project_id text, {', '.join(f'{problem} integer' for problem in PROBLEMS)});
+        drop table if exists graph_integrity;
+        create table graph_integrity (name text, project_id text, nodes integer, {', '.join(f'{problem} integer' for problem in PROBLEMS)});
+    """)
+    cursor = conn.execute(f"""
+        select v.key, v.submitter_id, v.name, v.project_id,
+            {missing_parent} as missing_parent,
+            {missing_child} as missing_child,
+            exists (
+                select 1 from edges as e where e.src = v.key and not exists (select 1 from vertices as d where d.key = e.dst)
+            ) as dangling
+        from vertices as v;
+    """, parent_parameters + child_parameters)
+    counts = {}
+    problems = []
+    for row in cursor:
+        group = counts.get(row[2:4])
+        if group is None:
+            group = counts[row[2:4]] = [0] * (1 + len(PROBLEMS))
+        group[0] += 1
+        flags = row[4:]
+        if any(flags):
+            for index, flag in enumerate(flags):
+                group[index + 1] += flag
+            problems.append(row)
+    conn.executemany(f"insert into node_problems values ({', '.join(['?'] * (4 + len(PROBLEMS)))});", problems)
+    conn.executemany(
+        f"insert into graph_integrity values ({', '.join(['?'] * (3 + len(PROBLEMS)))});",
+        [key + tuple(group) for key, group in counts.items()]
+    )
+    conn.execute("create index node_problems_name on node_problems(name);")
+    conn.commit()
+    logging.getLogger(__name__).info(f"Checked {sum(group[0] for group in counts.values())} vertices, {len(problems)} with problems")
+    columns = ['name', 'project_id', 'nodes'] + PROBLEMS
+    return [dict(zip(columns, row)) for row in conn.execute("select * from graph_integrity order by name, project_id;")]
@@ -0,0 +1,124 @@
+"""Reconcile terra workspace samples with the gen3 PFB in gen3-drs.sqlite."""
+
+import logging
+
+from anvil.gen3.entities import ensure_columns, flatten
+from anvil.gen3.integrity import check
+
+TERRA_DETAILS_COLUMNS = ['workspace_id', 'subject_id', 'sample_id', 'blob']
+# a terra sample_id matches a gen3 sample whose submitter_id is sample_id + SAMPLE_SUFFIX, is sample_id, or whose specimen_id is sample_id;
+# in that order of precedence, samples matched by a later form are ignored if an earlier form matched
+SAMPLE_SUFFIX = '_sample'
+
+# every key a terra sample_id may be matched on with its precedence, normalized once so the join is an index lookup
+SAMPLE_KEYS = f"""
+    select substr(object_submitter_id, 1, length(object_submitter_id) - {len(SAMPLE_SUFFIX)}), key, 0 from vertices
+        where name = 'sample' and substr(object_submitter_id, -{len(SAMPLE_SUFFIX)}) = '{SAMPLE_SUFFIX}'
+    union all
+    select object_submitter_id, key, 1 from vertices where name = 'sample' and object_submitter_id is not null
+    union all
+    select specimen_id, key, 2 from vertices where name = 'sample' and specimen_id is not null
+"""
+
+
+def load_terra_details(conn, records, batch_size=5000):
+    """Replace terra_details with records, dicts with TERRA_DETAILS_COLUMNS, return the number of rows."""
+    conn.executescript(f"""
+        drop table if exists terra_details;
+        create table terra_details ({', '.join(f'{column} text' for column in TERRA_DETAILS_COLUMNS)});
+        create unique index terra_details_idx on terra_details({', '.join(TERRA_DETAILS_COLUMNS)});
+    """)
+    insert = f"insert or ignore into terra_details values ({', '.join(['?'] * len(TERRA_DETAILS_COLUMNS))});"
+    count = 0
+    batch = []
+    for record in records:
+        batch.append(tuple(record[column] for column in TERRA_DETAILS_COLUMNS))
+        if len(batch) == batch_size:
+            conn.executemany(insert, batch)
+            count += len(batch)
+            batch = []
+    conn.executemany(insert, batch)
+    count += len(batch)
+    conn.execute("create index if not exists terra_details_sample_id on terra_details(sample_id);")
+    conn.commit()
+    return count
+
+
+def index_sample_keys(conn):
+    """Create sample_keys, (join_key, sample_key) for every key a gen3 sample can be matched on, keeping only the keys of the first matching form."""
+    conn.executescript(f"""
+        drop table if exists temp.all_sample_keys;
+        create temp table all_sample_keys (join_key text, sample_key text, form integer);
+        insert into all_sample_keys {SAMPLE_KEYS};
+        drop table if exists sample_keys;
+        create table sample_keys (join_key text, sample_key text);
+        insert into sample_keys
+        select k.join_key, k.sample_key from all_sample_keys as k
+            join (select join_key, min(form) as form from all_sample_keys group by join_key) as preferred
+                on preferred.join_key = k.join_key and preferred.form = k.form;
+        drop table temp.all_sample_keys;
+        create index sample_keys_join_key on sample_keys(join_key, sample_key);
+        create index if not exists flattened_sample_id on flattened(sample_id);
+    """)
+    conn.commit()
+
+
+def reconcile_counts(conn):
+    """Create reconcile_counts, terra and gen3 distinct samples and files per workspace.
+
+    A single grouped pass over terra_details, joined through sample_keys to flattened;
+    workspaces without any gen3 match have gen3 counts of 0.
+    A terra sample matching gen3 samples through several forms counts only those of the first form, see SAMPLE_SUFFIX.
+    """
+    conn.executescript("""
+        drop table if exists reconcile_counts;
+        create table reconcile_counts as
+        select w.workspace_id,
+            count(distinct w.sample_id) as "terra_sample_id_count",
+            count(distinct f.sample_submitter_id) as "gen3_sample_id_count",
+            count(distinct w.blob) as "terra_blob_count",
+            count(distinct f.ga4gh_drs_uri) as "gen3_drs_uri_count"
+            from terra_details as w
+                left join sample_keys as k on k.join_key = w.sample_id
+                    left join flattened as f on f.sample_id = k.sample_key
+        group by w.workspace_id;
+    """)
+    conn.commit()
+
+
+def missing_sequencing(conn):
+    """Create missing_sequencing, samples without sequencing, and subjects_missing_sequencing, their subjects.
+
+    Reads node_problems, see anvil.gen3.integrity.check.
+    """
+    conn.executescript("""
+        drop table if exists missing_sequencing;
+        create table missing_sequencing as
+        select key, submitter_id from node_problems where name = 'sample' and missing_child;
+
+        drop table if exists subjects_missing_sequencing;
+        -- cross join fixes the order, driven by the (small) missing set rather than every subject
+        create table subjects_missing_sequencing as
+        select distinct su.key, su.submitter_id from missing_sequencing as ms
+            cross join edges as e on e.src = ms.key
+                cross join vertices as su on su.key = e.dst
+        where su.name = 'subject';
+    """)
+    conn.commit()
+
+
+def reconcile(conn, records=None):
+    """Create flattened, reconcile_counts, graph_integrity, missing_sequencing and subjects_missing_sequencing.
+
+    :param conn: connection to gen3-drs.sqlite
+    :param records: terra details, see load_terra_details; if None an existing terra_details table is used
+    """
+    # vertices from an older load may lack the typed columns the queries use
+    ensure_columns(conn)
+    if records is not None:
+        logging.getLogger(__name__).info(f"Loaded {load_terra_details(conn, records)} terra details")
+    flatten(conn)
+    index_sample_keys(conn)
+    reconcile_counts(conn)
+    check(conn)
+    missing_sequencing(conn)
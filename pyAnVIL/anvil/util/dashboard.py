@@ -0,0 +1,56 @@
+"""Render dashboard project views as a wide table."""
+
+import csv
+
+FIXED_COLUMNS = ['source', 'workspace', 'accession']
+
+
+def columns(aggregations):
+    """Return sorted (file_types, node_types, problem_types) of aggregations, in one pass."""
+    file_types, node_types, problem_types = set(), set(), set()
+    for p in aggregations:
+        file_types.update(f['type'] for f in p.get('files', []))
+        node_types.update(n['type'] for n in p.get('nodes', []))
+        problem_types.update(p.get('problems', []))
+    return sorted(file_types), sorted(node_types), sorted(problem_types)
+
+
+def rows(aggregations, file_types, node_types, problem_types):
+    """Yield a row per aggregation, cells are located through column index dicts rather than list.index()."""
+    offset = len(FIXED_COLUMNS)
+    file_index = {file_type: offset + i for i, file_type in enumerate(file_types)}
+    size_index = offset + len(file_types)
+    node_index = {node_type: size_index + 1 + i for i, node_type in enumerate(node_types)}
+    problem_index = {problem: size_index + 1 + len(node_types) + i for i, problem in enumerate(problem_types)}
+    empty = [None] * offset + [''] * (len(file_types) + 1 + len(node_types) + len(problem_types))
+    for p in aggregations:
+        flat = empty.copy()
+        flat[0], flat[1], flat[2] = p['source'], p['project_id'], p.get('qualified_accession', None)
+        for f in p.get('files', []):
+            flat[file_index[f['type']]] = f['size']
+        flat[size_index] = p.get('size', 0)
+        for n in p.get('nodes', []):
+            flat[node_index[n['type']]] = n['count']
+        for problem in p.get('problems', []):
+            flat[problem_index[problem]] = True
+        yield flat
+
+
+def flatten(aggregations):
+    """Render a dashboard data as key/value (flattened_aggregations, column_names)."""
+    file_types, node_types, problem_types = columns(aggregations)
+    return (
+        list(rows(aggregations, file_types, node_types, problem_types)),
+        FIXED_COLUMNS + file_types + ['size'] + node_types + problem_types
+    )
+
+
+def write_tsv(aggregations, fo):
+    """Write flattened aggregations to fo as they are rendered, in the layout of DataFrame.to_csv with tabs, return the row count."""
+    file_types, node_types, problem_types = columns(aggregations)
+    writer = csv.writer(fo, delimiter='\t', lineterminator='\n')
+    writer.writerow([''] + FIXED_COLUMNS + file_types + ['size'] + node_types + problem_types)
+    count = 0
+    for count, flat in enumerate(rows(aggregations, file_types, node_types, problem_types), 1):
+        writer.writerow([count - 1] + flat)
+    return count
@@ -0,0 +1,52 @@
+"""Buffered newline delimited JSON output."""
+
+import json
+
+# characters buffered before writing to the stream
+BUFFER_SIZE = 1024 * 1024
+
+
+class NDJSONWriter:
+    """Write one compact JSON document per line, in large chunks.
+
+    Examples: ::
+
+        with NDJSONWriter(sys.stdout) as writer:
+            for page in pages:
+                writer.write(page)
+
+    """
+
+    def __init__(self, stream, buffer_size=BUFFER_SIZE):
+        """Wrap stream, a text file like object."""
+        self._stream = stream
+        self._buffer_size = buffer_size
+        self._lines = []
+        self._size = 0
+        self.count = 0
+
+    def write(self, item):
+        """Serialize item, flush when buffer is full."""
+        line = json.dumps(item, separators=(',', ':'))
+        self._lines.append(line)
+        self._size += len(line) + 1
+        self.count += 1
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered lines to stream."""
+        if self._lines:
+            self._lines.append('')
+            self._stream.write('\n'.join(self._lines))
+            self._lines = []
+            self._size = 0
+        self._stream.flush()
+
+    def __enter__(self):
+        """Return self."""
+        return self
+
+    def __exit__(self, *args):
+        """Flush remaining lines."""
+        self.flush()
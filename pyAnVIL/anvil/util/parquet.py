@@ -0,0 +1,110 @@
+"""Export sqlite tables as Parquet datasets partitioned by consortium and project, requires pyarrow."""
+
+import logging
+import queue
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+# rows per arrow record batch read from sqlite
+BATCH_SIZE = 100000
+# table -> (column holding the terra workspace name, column naming the project partition)
+EXPORTS = {
+    'flattened': ('anvil_project_id', 'project_id'),
+    'terra_details': ('workspace_id', 'workspace_id'),
+}
+# directory partitions written per table, AnVIL has a few hundred workspaces
+MAX_PARTITIONS = 10000
+
+
+def consortium(workspace_name, consortiums):
+    """Return the name of the first (name, workspace_regex) in consortiums matching workspace_name, or None."""
+    if workspace_name is None:
+        return None
+    for name, workspace_regex in consortiums:
+        if re.match(workspace_regex, workspace_name, re.IGNORECASE):
+            return name
+    return None
+
+
+def _batches(cursor, schema, workspace_index, consortiums, batch_size):
+    """Yield record batches of the cursor's rows, with a consortium column derived from each row's workspace."""
+    import pyarrow as pa
+
+    names = {}
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        columns = [list(column) for column in zip(*rows)]
+        workspaces = columns[workspace_index]
+        for workspace_name in set(workspaces) - names.keys():
+            names[workspace_name] = consortium(workspace_name, consortiums)
+        columns.append([names[workspace_name] for workspace_name in workspaces])
+        yield pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+
+def export_table(conn, table, output_path, consortiums, workspace_column, project_column, batch_size=BATCH_SIZE):
+    """Write table as parquet files under output_path/consortium=<name>/<project_column>=<value>/, return row count.
+
+    Rows are streamed from sqlite in record batches, so memory is bounded by batch_size rather than the table;
+    a consortium column is added from each row's workspace name. An existing export at output_path is replaced.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    cursor = conn.execute(f"select * from {table};")
+    column_names = [description[0] for description in cursor.description]
+    # sqlite columns of these tables are text
+    schema = pa.schema([(name, pa.string()) for name in column_names + ['consortium']])
+    partitioning = ds.partitioning(pa.schema([('consortium', pa.string()), (project_column, pa.string())]), flavor='hive')
+    shutil.rmtree(output_path, ignore_errors=True)
+
+    # arrow pulls batches from its own thread, but a sqlite connection may only be used by the thread that opened it:
+    # read here, hand batches over a bounded queue to the writer
+    batches = queue.Queue(maxsize=2)
+
+    def queued():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            yield batch
+
+    count = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        writer = executor.submit(
+            ds.write_dataset, pa.RecordBatchReader.from_batches(schema, queued()), output_path,
+            format='parquet', partitioning=partitioning, max_partitions=MAX_PARTITIONS,
+        )
+        for batch in chain(_batches(cursor, schema, column_names.index(workspace_column), consortiums, batch_size), [None]):
+            while not writer.done():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if batch is not None:
+                count += batch.num_rows
+        # raises the writer's error, if any
+        writer.result()
+    logging.getLogger(__name__).info(f"Wrote {count} {table} rows to {output_path}")
+    return count
+
+
+def export(conn, output_path, consortiums, tables=EXPORTS, batch_size=BATCH_SIZE):
+    """Export tables to output_path/<table>, return {table: row count}.
+
+    Examples: ::
+
+        export(sqlite3.connect('gen3-drs.sqlite'), '/tmp/parquet', DEFAULT_CONSORTIUMS)
+        # read back one project, only the files in its partition are opened
+        dataset = pyarrow.dataset.dataset('/tmp/parquet/flattened', partitioning='hive')
+        dataset.to_table(filter=pyarrow.dataset.field('project_id') == 'CF-GREEN')
+
+    """
+    return {
+        table: export_table(conn, table, f"{output_path}/{table}", consortiums, workspace_column, project_column, batch_size)
+        for table, (workspace_column, project_column) in tables.items()
+    }
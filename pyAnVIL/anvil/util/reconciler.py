@@ -1,8 +1,10 @@
 """Reconcile and aggregate results."""
 
 from anvil.dbgap.api import get_accession
-from anvil.dbgap.api import get_study
+from anvil.dbgap.client import get_studies
 from anvil.terra.reconciler import Reconciler
+# flatten moved to anvil.util.dashboard, kept here for existing imports
+from anvil.util.dashboard import flatten  # noqa: F401
 from collections import defaultdict
 import logging
 import os
@@ -31,22 +33,21 @@ def reconcile(name, user_project, namespace, workspace_regex, drs_file_path=None
     reconciler.save()
     reconciled_schemas = reconciler.reconcile_schemas()
     reconciled_schemas['name'] = name
-    for view in reconciler.dashboard_views:
-        accession = get_accession(namespace, view['project_id'])
+    views = list(reconciler.dashboard_views)
+    accessions = {view['project_id']: get_accession(namespace, view['project_id']) for view in views}
+    # fetched together, concurrently, rather than one workspace at a time
+    studies = get_studies([accession for accession in accessions.values() if accession])
+    for view in views:
+        accession = accessions[view['project_id']]
         if accession:
             view['accession'] = accession
-            study_tuple = get_study(accession)
-            if not study_tuple:
+            study = studies[accession]
+            if not study:
                 logger.warning(f"No study found {view['project_id']} accession: {accession}")
                 view['problems'].append('missing_accession')
             else:
-                qualified_accession, study = study_tuple
-                view['qualified_accession'] = qualified_accession
-                try:
-                    view['dbgap_sample_count'] = len(study['DbGap']['Study']['SampleList']['Sample'])
-                except Exception as e:
-                    logger.warning(f"dbGAP's Study missing sample list {view['project_id']} accession: {accession} {e}")
-                    view['dbgap_sample_count'] = 0
+                view['qualified_accession'] = study['qualified_accession']
+                view['dbgap_sample_count'] = study['sample_count']
         yield view
     yield reconciled_schemas
 
@@ -71,48 +72,3 @@ def aggregate(namespace, user_project, consortium, drs_file_path=None, terra_out
         if counts['actual_sample_count'] != counts['expected_sample_count']:
             counts['problems'].append('dbgap_sample_count_mismatch')
         yield counts
-
-
-def flatten(aggregations):
-    """Render a dashboard data as key/value (flattened_aggregations, column_names)."""
-    file_types = set()
-    for p in aggregations:
-        for f in p.get('files', []):
-            file_types.add(f['type'])
-    file_types = sorted(list(file_types))
-
-    node_types = set()
-    for p in aggregations:
-        for n in p.get('nodes', []):
-            node_types.add(n['type'])
-    node_types = sorted(list(node_types))
-
-    problem_types = set()
-    for p in aggregations:
-        for n in p.get('problems', []):
-            problem_types.add(n)
-    problem_types = sorted(list(problem_types))
-
-    flattened = []
-    for p in aggregations:
-        flat = [p['source'], p['project_id'], p.get('qualified_accession', None)]
-
-        file_sizes = [''] * len(file_types)
-        for f in p.get('files', []):
-            file_sizes[file_types.index(f['type'])] = f['size']
-        flat.extend(file_sizes)
-        flat.append(p.get('size', 0))
-
-        node_counts = [''] * len(node_types)
-        for n in p.get('nodes', []):
-            node_counts[node_types.index(n['type'])] = n['count']
-        flat.extend(node_counts)
-
-        problems = [''] * len(problem_types)
-        for n in p.get('problems', []):
-            problems[problem_types.index(n)] = True
-        flat.extend(problems)
-
-        flattened.append(flat)
-
-    return flattened, ['source', 'workspace', 'accession'] + file_types + ['size'] + node_types + problem_types
@@ -0,0 +1,109 @@
+"""Read a byte stream ahead of its consumer, optionally spilling it to disk."""
+
+import os
+import queue
+import threading
+
+# bytes read from the source at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+# chunks read ahead of the consumer
+DEPTH = 4
+
+
+class PrefetchReader:
+    """File like reader that downloads in a background thread while the consumer parses.
+
+    Examples: ::
+
+        with PrefetchReader(blob.open('rb'), spill_path='export.avro') as stream:
+            for record in fastavro.reader(stream):
+                ...
+
+    :param source: file like object with read(size), e.g. a GCS BlobReader or an HTTP response's raw stream
+    :param spill_path: if set, every byte read is also written here; the file only appears once the source is exhausted,
+                       so a complete spill can be re-read on retry instead of downloading again
+    """
+
+    def __init__(self, source, spill_path=None, chunk_size=CHUNK_SIZE, depth=DEPTH):
+        """Start reading source."""
+        self._source = source
+        self.spill_path = spill_path
+        self._chunk_size = chunk_size
+        self._chunks = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._chunk = b''
+        self._position = 0
+        self._eof = False
+        self.bytes_read = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        """Copy source chunks to the queue (and spill), None marks the end."""
+        spill = open(f"{self.spill_path}.part", 'wb') if self.spill_path else None
+        try:
+            while not self._stop.is_set():
+                chunk = self._source.read(self._chunk_size)
+                if not chunk:
+                    break
+                if spill:
+                    spill.write(chunk)
+                self._put(chunk)
+            if spill:
+                spill.close()
+                if not self._stop.is_set():
+                    os.replace(f"{self.spill_path}.part", self.spill_path)
+        except Exception as e:
+            self.error = e
+        finally:
+            if spill and not spill.closed:
+                spill.close()
+            self._put(None)
+
+    def _put(self, chunk):
+        """Queue chunk unless the reader was closed."""
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        """Return up to size bytes, all remaining bytes if size < 0."""
+        parts = []
+        while size != 0:
+            if self._position >= len(self._chunk):
+                if self._eof:
+                    break
+                chunk = self._chunks.get()
+                if chunk is None:
+                    self._eof = True
+                    if self.error:
+                        raise IOError(f"reading source failed {self.error}") from self.error
+                    break
+                self._chunk, self._position = chunk, 0
+                continue
+            # avro reads are small (often a single byte), slice the current chunk rather than a growing buffer
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._position + size)
+            parts.append(self._chunk[self._position:end])
+            if size > 0:
+                size -= end - self._position
+            self._position = end
+        data = b''.join(parts)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        """Stop reading the source."""
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        """Return self."""
+        return self
+
+    def __exit__(self, *args):
+        """Close."""
+        self.close()
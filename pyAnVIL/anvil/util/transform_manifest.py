@@ -0,0 +1,150 @@
+"""Track content hashes of transform inputs and outputs, supports incremental re-transform."""
+
+import sqlite3
+import hashlib
+import json
+import logging
+from datetime import date, datetime
+
+
+def json_serial(obj):
+    """JSON serializer for objects not serializable by default json code."""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    return str(obj)
+
+
+def make_hash(*items):
+    """Return the md5 of items, dict keys are sorted so {'a': 1, 'b': 2} is the same as {'b': 2, 'a': 1}."""
+    d_hash = hashlib.md5()
+    for item in items:
+        d_hash.update(json.dumps(item, sort_keys=True, separators=(',', ':'), default=json_serial).encode())
+    return d_hash.hexdigest()
+
+
+def workspace_input_hash(workspace, spreadsheet_row=None):
+    """Hash everything the transformer reads for a workspace: entities, blobs and spreadsheet row.
+
+    Expects workspace.subjects, subject.samples and sample.blobs to already be populated (see bin/anvil_transform).
+    """
+    d_hash = hashlib.md5()
+
+    def update(item):
+        d_hash.update(json.dumps(item, sort_keys=True, separators=(',', ':'), default=json_serial).encode())
+
+    update(workspace.attributes)
+    update(spreadsheet_row)
+    for subject in workspace.subjects:
+        update(subject.attributes)
+        for sample in getattr(subject, 'samples', None) or []:
+            update(sample.attributes)
+            update(sorted((getattr(sample, 'blobs', None) or {}).items()))
+    return d_hash.hexdigest()
+
+
+class TransformManifest:
+    """Record a content hash per workspace input and per emitted resource.
+
+    Workspaces whose input hash has not changed since the last run can be skipped,
+    resources whose hash changed are written to a manifest so upload and import only handle deltas.
+
+    Examples: ::
+
+        manifest = TransformManifest(f"{output_path}/transform-manifest.sqlite")
+        if manifest.is_unchanged(workspace.name, input_hash):
+            continue
+        manifest.start_workspace(workspace.name)
+        for entity in ...:
+            manifest.record_resource(workspace.name, file_path, entity)
+        manifest.finish_workspace(workspace.name, input_hash)
+        manifest.write_changes(f"{output_path}/transform-changes.json")
+
+    """
+
+    def __init__(self, path):
+        """Set up sqlite db."""
+        self._path = path
+        self._conn = sqlite3.connect(path)
+        cur = self._conn.cursor()
+        cur.executescript("""
+        CREATE TABLE IF NOT EXISTS workspace_inputs (
+            workspace_name text PRIMARY KEY,
+            hash text NOT NULL,
+            updated TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS resources (
+            workspace_name text,
+            file_path text,
+            resource_type text,
+            resource_id text,
+            hash text NOT NULL,
+            seen integer DEFAULT 1,
+            PRIMARY KEY (file_path, resource_type, resource_id)
+        );
+        CREATE INDEX IF NOT EXISTS resources_workspace_name ON resources(workspace_name);
+        """)
+        self._conn.commit()
+        self._changes = {'workspaces': [], 'files': set(), 'upserted': [], 'deleted': []}
+        self._logger = logging.getLogger(__name__)
+
+    def is_unchanged(self, workspace_name, input_hash):
+        """Return True if the workspace was transformed from identical inputs."""
+        data = self._conn.execute("SELECT hash FROM workspace_inputs where workspace_name=?", (workspace_name,)).fetchone()
+        return data is not None and data[0] == input_hash
+
+    def start_workspace(self, workspace_name):
+        """Mark all previously emitted resources as unseen, see finish_workspace."""
+        self._conn.execute("UPDATE resources SET seen = 0 WHERE workspace_name=?", (workspace_name,))
+        self._changes['workspaces'].append(workspace_name)
+
+    def record_resource(self, workspace_name, file_path, entity):
+        """Save the hash of an emitted resource, return True if it is new or changed."""
+        resource_hash = make_hash(entity)
+        key = (file_path, entity['resourceType'], entity['id'])
+        data = self._conn.execute(
+            "SELECT hash FROM resources where file_path=? and resource_type=? and resource_id=?", key
+        ).fetchone()
+        self._conn.execute(
+            "REPLACE into resources values (?, ?, ?, ?, ?, 1);", (workspace_name, ) + key + (resource_hash, )
+        )
+        changed = data is None or data[0] != resource_hash
+        if changed:
+            self._changes['files'].add(file_path)
+            self._changes['upserted'].append({'resourceType': entity['resourceType'], 'id': entity['id'], 'file_path': file_path})
+        return changed
+
+    def finish_workspace(self, workspace_name, input_hash):
+        """Record input hash, resources no longer emitted are reported as deleted."""
+        cur = self._conn.cursor()
+        for file_path, resource_type, resource_id in cur.execute(
+            "SELECT file_path, resource_type, resource_id FROM resources WHERE workspace_name=? and seen = 0", (workspace_name,)
+        ).fetchall():
+            self._changes['files'].add(file_path)
+            self._changes['deleted'].append({'resourceType': resource_type, 'id': resource_id, 'file_path': file_path})
+        cur.execute("DELETE FROM resources WHERE workspace_name=? and seen = 0", (workspace_name,))
+        now = datetime.now().replace(microsecond=0).isoformat()
+        cur.execute("REPLACE into workspace_inputs values (?, ?, ?);", (workspace_name, input_hash, now))
+        self._conn.commit()
+
+    @property
+    def changes(self):
+        """Changes recorded during this run."""
+        return {
+            'workspaces': self._changes['workspaces'],
+            'files': sorted(self._changes['files']),
+            'upserted': self._changes['upserted'],
+            'deleted': self._changes['deleted'],
+        }
+
+    def write_changes(self, path):
+        """Write manifest of changed workspaces, files and resource ids."""
+        changes = self.changes
+        with open(path, 'w') as outs:
+            json.dump(changes, outs, separators=(',', ':'))
+        self._logger.info(f"Wrote {len(changes['upserted'])} upserted, {len(changes['deleted'])} deleted resources in {len(changes['files'])} files to {path}")
+        return changes
+
+    def close(self):
+        """Commit and close db."""
+        self._conn.commit()
+        self._conn.close()
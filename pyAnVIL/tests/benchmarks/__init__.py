@@ -0,0 +1 @@
+"""Benchmarks, run as modules e.g. `python -m tests.benchmarks.bench_fhir_pager`."""
@@ -0,0 +1,102 @@
+"""Time rendering synthetic dashboard project views as a wide table, against the former list.index() implementation.
+
+Usage: ::
+
+    cd pyAnVIL
+    python -m tests.benchmarks.bench_dashboard --projects 5000 --file_types 200 --node_types 50
+
+"""
+
+import argparse
+import io
+import time
+
+import pandas as pd
+
+from anvil.util.dashboard import flatten, write_tsv
+from tests.conftest import synthetic_project_views
+
+
+def legacy_flatten(aggregations):
+    """Flatten the way anvil.util.reconciler.flatten used to: three passes for types, list.index() per cell."""
+    file_types = set()
+    for p in aggregations:
+        for f in p.get('files', []):
+            file_types.add(f['type'])
+    file_types = sorted(list(file_types))
+
+    node_types = set()
+    for p in aggregations:
+        for n in p.get('nodes', []):
+            node_types.add(n['type'])
+    node_types = sorted(list(node_types))
+
+    problem_types = set()
+    for p in aggregations:
+        for n in p.get('problems', []):
+            problem_types.add(n)
+    problem_types = sorted(list(problem_types))
+
+    flattened = []
+    for p in aggregations:
+        flat = [p['source'], p['project_id'], p.get('qualified_accession', None)]
+
+        file_sizes = [''] * len(file_types)
+        for f in p.get('files', []):
+            file_sizes[file_types.index(f['type'])] = f['size']
+        flat.extend(file_sizes)
+        flat.append(p.get('size', 0))
+
+        node_counts = [''] * len(node_types)
+        for n in p.get('nodes', []):
+            node_counts[node_types.index(n['type'])] = n['count']
+        flat.extend(node_counts)
+
+        problems = [''] * len(problem_types)
+        for n in p.get('problems', []):
+            problems[problem_types.index(n)] = True
+        flat.extend(problems)
+
+        flattened.append(flat)
+
+    return flattened, ['source', 'workspace', 'accession'] + file_types + ['size'] + node_types + problem_types
+
+
+def legacy_tsv(aggregations, fo):
+    """Write the tsv the way the report used to, through a DataFrame."""
+    flattened, column_names = legacy_flatten(aggregations)
+    df = pd.DataFrame(flattened)
+    df.columns = column_names
+    df.to_csv(fo, sep="\t")
+
+
+def timed(label, function, *args):
+    """Run function, print and return seconds."""
+    start = time.time()
+    function(*args)
+    seconds = time.time() - start
+    print(f"{label:<16} {seconds:8.3f}s")
+    return seconds
+
+
+def main():
+    """Run the comparison."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--projects', type=int, default=5000)
+    parser.add_argument('--file_types', type=int, default=200)
+    parser.add_argument('--node_types', type=int, default=50)
+    parser.add_argument('--problem_types', type=int, default=20)
+    args = parser.parse_args()
+
+    views = synthetic_project_views(args.projects, args.file_types, args.node_types, args.problem_types)
+    print(f"{args.projects} project views, {args.file_types} file types, {args.node_types} node types, {args.problem_types} problem types")
+    legacy = timed('legacy flatten', legacy_flatten, views)
+    current = timed('flatten', flatten, views)
+    print(f"speedup {legacy / current:.1f}x")
+    legacy = timed('legacy tsv', legacy_tsv, views, io.StringIO())
+    current = timed('streamed tsv', write_tsv, views, io.StringIO())
+    print(f"speedup {legacy / current:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
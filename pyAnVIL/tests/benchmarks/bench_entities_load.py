@@ -0,0 +1,84 @@
+"""Compare per-record, batched and parallel loading of a synthetic PFB into the vertex/edge store.
+
+Usage: ::
+
+    cd pyAnVIL
+    python -m tests.benchmarks.bench_entities_load --subjects 1000000 --workers 2,4,8
+
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from fastavro import reader
+
+from anvil.gen3.entities import Entities
+from tests.conftest import write_synthetic_pfb
+
+
+def decode_only(entities, avro_path):
+    """Decode and discard records, the floor for any loader."""
+    with open(avro_path, 'rb') as fo:
+        for _ in reader(fo):
+            pass
+
+
+def load_per_record(entities, avro_path):
+    """Load the way Entities.load used to: one REPLACE per vertex and edge, ids tracked in a dict."""
+    cur = entities._conn.cursor()
+    ids = {}
+    with open(avro_path, 'rb') as fo:
+        for record in reader(fo):
+            if record['id'] not in ids:
+                entities.put(record['id'], entities._submitter_id(record), record['name'], record, cur)
+                ids[record['id']] = None
+    entities._conn.commit()
+
+
+def load_batched(entities, avro_path):
+    """Load records in batches, the loop in Entities.load."""
+    with open(avro_path, 'rb') as fo:
+        entities.load_records(reader(fo))
+
+
+def parallel(workers):
+    """Return a loader decoding blocks in `workers` processes."""
+    def _load(entities, avro_path):
+        entities.load_parallel(workers=workers)
+    return _load
+
+
+def main():
+    """Run benchmark, print records per second per loader."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subjects', type=int, default=1000000, help='subjects in the PFB, each has a sample and a sequencing record')
+    parser.add_argument('--skip_per_record', action='store_true', help='skip the per-record loader')
+    parser.add_argument('--workers', default='2,4', help='comma separated worker counts for the parallel loader')
+    args = parser.parse_args()
+    records = args.subjects * 3
+
+    with tempfile.TemporaryDirectory() as work:
+        avro_path = os.path.join(work, 'synthetic.avro')
+        with open(avro_path, 'wb') as fo:
+            write_synthetic_pfb(fo, args.subjects)
+        loaders = [('batched', load_batched), ('decode only', decode_only)]
+        loaders += [(f"parallel={workers}", parallel(int(workers))) for workers in args.workers.split(',')]
+        if not args.skip_per_record:
+            loaders.insert(0, ('per-record', load_per_record))
+        results = []
+        for name, loader in loaders:
+            entities = Entities(avro_path, os.path.join(work, f"{name}.sqlite"))
+            start = time.time()
+            loader(entities, avro_path)
+            results.append((name, time.time() - start))
+
+    print(f"{records} records, {os.cpu_count()} cpus")
+    baseline = results[0][1]
+    for name, elapsed in results:
+        print(f"{name:<12} {elapsed:8.2f}s {records / elapsed:10.0f} records/s {baseline / elapsed:6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Compare sequential and prefetching pagination against a stub FHIR server that injects latency.
+
+Usage: ::
+
+    cd pyAnVIL
+    python -m tests.benchmarks.bench_fhir_pager --latency 0.05 --work 0.02 --pages 40
+
+"""
+
+import argparse
+import io
+import threading
+import time
+
+from anvil.clients.transport import new_session
+from anvil.clients.fhir_dispatch import iter_json_pages, prefetch_iter
+from anvil.util.ndjson import NDJSONWriter
+from tests.conftest import StubFHIRSearchServer
+
+
+def run(pages, work, writer):
+    """Consume pages, simulating `work` seconds of parsing/printing per page."""
+    start = time.time()
+    for page in pages:
+        time.sleep(work)
+        writer.write(page)
+    writer.flush()
+    return time.time() - start
+
+
+def main():
+    """Run benchmark, print elapsed time per prefetch depth."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to each response')
+    parser.add_argument('--work', type=float, default=0.02, help='seconds spent on each page by the consumer')
+    parser.add_argument('--pages', type=int, default=40)
+    parser.add_argument('--page_size', type=int, default=100)
+    args = parser.parse_args()
+
+    server = StubFHIRSearchServer(count=args.pages * args.page_size, page_size=args.page_size, latency=args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"{server.base_url}Patient?_count={args.page_size}"
+    session = new_session()
+    try:
+        results = [('sequential', run(iter_json_pages(session, url), args.work, NDJSONWriter(io.StringIO())))]
+        for depth in [0, 1, 4]:
+            pages = prefetch_iter(iter_json_pages(session, url), depth=depth)
+            results.append((f"prefetch={depth}", run(pages, args.work, NDJSONWriter(io.StringIO()))))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print(f"{args.pages} pages, latency {args.latency}s, consumer work {args.work}s per page")
+    baseline = results[0][1]
+    for name, elapsed in results:
+        print(f"{name:<12} {elapsed:8.2f}s {args.pages / elapsed:8.1f} pages/s {baseline / elapsed:6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
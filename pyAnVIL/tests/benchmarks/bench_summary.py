@@ -0,0 +1,79 @@
+"""Time the per project summary on a synthetic flattened table, against the former self join on a smaller table.
+
+Usage: ::
+
+    cd pyAnVIL
+    python -m tests.benchmarks.bench_summary --rows 5000000 --projects 50 --legacy_rows 20000
+
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from anvil.gen3.entities import summarize
+
+LEGACY_SUMMARY = """
+    drop table if exists summary;
+    create table summary as
+    select f.project_id, f.anvil_project_id,
+        count(distinct f.subject_id) as "subject_count",
+        count(distinct f.sample_id) as "sample_count",
+        count(distinct m.sequencing_id) as "sequencing_count",
+        count(distinct m.ga4gh_drs_uri) as "ga4gh_drs_uri_count"
+        from flattened as f
+            left join flattened as m on f.project_id = m.project_id and f.anvil_project_id = m.anvil_project_id
+        group by f.project_id, f.anvil_project_id;
+"""
+
+
+def create_flattened(path, rows, projects):
+    """Create flattened with rows spread over projects, 2 samples per subject, 2 sequencing per sample."""
+    conn = sqlite3.connect(path)
+    conn.executescript(f"""
+        drop table if exists flattened;
+        create table flattened as
+        with recursive n(i) as (select 0 union all select i + 1 from n where i + 1 < {rows})
+        select 'project-' || (i % {projects}) as project_id, 'anvil-' || (i % {projects}) as anvil_project_id,
+            'subject-' || (i / 4) as subject_id, 'sample-' || (i / 2) as sample_id,
+            'sequencing-' || i as sequencing_id, 'drs://example.org/' || i as ga4gh_drs_uri
+        from n;
+    """)
+    return conn
+
+
+def timed(function):
+    """Return seconds function takes."""
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def main():
+    """Run benchmark, print rows per second per summary method."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--projects', type=int, default=50)
+    parser.add_argument('--legacy_rows', type=int, default=20000, help='rows for the self join, it is quadratic per project')
+    parser.add_argument('--approximate', action='store_true', help='also time the HyperLogLog summary')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work:
+        conn = create_flattened(os.path.join(work, 'legacy.sqlite'), args.legacy_rows, args.projects)
+        results.append(('self join', args.legacy_rows, timed(lambda: conn.executescript(LEGACY_SUMMARY))))
+        results.append(('grouped', args.legacy_rows, timed(lambda: summarize(conn))))
+        conn = create_flattened(os.path.join(work, 'flattened.sqlite'), args.rows, args.projects)
+        results.append(('grouped', args.rows, timed(lambda: summarize(conn))))
+        if args.approximate:
+            results.append(('approximate', args.rows, timed(lambda: summarize(conn, approximate=True))))
+
+    print(f"{args.projects} projects")
+    for name, rows, elapsed in results:
+        print(f"{name:<12} {rows:>9} rows {elapsed:8.2f}s {rows / elapsed:12.0f} rows/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,13 @@
 """Provide test fixtures."""
 
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
 import pytest
+from fastavro import writer
 from anvil.clients.gen3_auth import TERRA_TOKEN_URL
 
 
@@ -90,3 +97,170 @@ def terra_output_path(output_path):
 def drs_output_path(output_path):
     """Return command line options as fixture."""
     return f"{output_path}/gen3-drs.sqlite"
+
+
+class StubFHIRSearchServer(ThreadingHTTPServer):
+    """Local FHIR server serving `count` Patients in pages, with optional latency per request."""
+
+    def __init__(self, count=10, page_size=3, latency=0.0):
+        """Bind to a random port."""
+        super().__init__(('127.0.0.1', 0), StubFHIRSearchHandler)
+        self.count = count
+        self.page_size = page_size
+        self.latency = latency
+        self.version = 1
+        self.requests = []
+        self.headers = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        """Return url of server."""
+        return f"http://127.0.0.1:{self.server_port}/fhir/"
+
+    def page(self, resource_type, query):
+        """Return a search set Bundle for query."""
+        page_size = int(query.get('_count', [self.page_size])[0])
+        offset = int(query.get('_offset', [0])[0])
+        ids = range(offset, min(offset + page_size, self.count))
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'searchset',
+            'total': self.count,
+            'link': [],
+            'entry': [
+                {'fullUrl': f"{self.base_url}{resource_type}/{i}", 'resource': {'resourceType': resource_type, 'id': str(i)}}
+                for i in ids
+            ],
+        }
+        if offset + page_size < self.count:
+            bundle['link'].append({'relation': 'next', 'url': f"{self.base_url}{resource_type}?_count={page_size}&_offset={offset + page_size}"})
+        return bundle
+
+
+class StubFHIRSearchHandler(BaseHTTPRequestHandler):
+    """Answer metadata and search requests."""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """Return CapabilityStatement or a search page."""
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.headers.append(dict(self.headers))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.latency)
+            parts = urlparse(self.path)
+            segments = parts.path.rstrip('/').split('/')
+            resource_type = segments[-1]
+            etag = None
+            if resource_type == 'metadata':
+                body = {'resourceType': 'CapabilityStatement', 'status': 'active', 'date': '2021-01-01', 'kind': 'instance', 'fhirVersion': '4.0.1', 'format': ['json']}
+            elif segments[-2] != 'fhir':
+                # read, resources are versioned with server.version
+                etag = f'W/"{server.version}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = {'resourceType': segments[-2], 'id': segments[-1], 'meta': {'versionId': str(server.version)}}
+            else:
+                body = server.page(resource_type, parse_qs(parts.query))
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/fhir+json')
+            self.send_header('Content-Length', str(len(data)))
+            if etag:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        """Quiet."""
+        pass
+
+
+@pytest.fixture
+def fhir_search_servers():
+    """Return a factory that starts StubFHIRSearchServers, stopped at teardown."""
+    servers = []
+
+    def _start(**kwargs):
+        server = StubFHIRSearchServer(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield _start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+PFB_SCHEMA = {
+    'type': 'record', 'name': 'Entity', 'fields': [
+        {'name': 'id', 'type': 'string'},
+        {'name': 'name', 'type': 'string'},
+        {'name': 'object', 'type': {'type': 'map', 'values': 'string'}},
+        {'name': 'relations', 'type': {'type': 'array', 'items': {
+            'type': 'record', 'name': 'Relation', 'fields': [
+                {'name': 'dst_id', 'type': 'string'}, {'name': 'dst_name', 'type': 'string'}
+            ]
+        }}},
+    ]
+}
+
+
+def synthetic_pfb_records(subjects, projects=3):
+    """Yield a subject, sample and sequencing record per subject, spread over projects."""
+    for i in range(subjects):
+        project_id = f"project-{i % projects}"
+        yield {'id': f"subject-{i}", 'name': 'subject', 'relations': [],
+               'object': {'participant_id': f"p-{i}", 'submitter_id': f"p-{i}", 'project_id': project_id, 'anvil_project_id': f"anvil-{project_id}"}}
+        yield {'id': f"sample-{i}", 'name': 'sample', 'relations': [{'dst_id': f"subject-{i}", 'dst_name': 'subject'}],
+               'object': {'specimen_id': f"s-{i}", 'submitter_id': f"s-{i}", 'sample_id': f"s-{i}", 'project_id': project_id}}
+        yield {'id': f"sequencing-{i}", 'name': 'sequencing', 'relations': [{'dst_id': f"sample-{i}", 'dst_name': 'sample'}],
+               'object': {'file_name': f"f-{i}.cram", 'submitter_id': f"f-{i}.cram", 'md5sum': f"{i:032x}",
+                          'ga4gh_drs_uri': f"drs://example.org/{i}", 'project_id': project_id}}
+
+
+def write_synthetic_pfb(fo, subjects, codec='null', sync_interval=16000):
+    """Write synthetic_pfb_records as an avro container file."""
+    writer(fo, PFB_SCHEMA, synthetic_pfb_records(subjects), codec=codec, sync_interval=sync_interval)
+
+
+@pytest.fixture
+def synthetic_pfb(tmp_path):
+    """Path to a PFB with 500 subjects (1500 records)."""
+    path = tmp_path / 'synthetic.avro'
+    with open(path, 'wb') as fo:
+        write_synthetic_pfb(fo, 500, sync_interval=4096)
+    return path
+
+
+def synthetic_project_views(projects, file_types=40, node_types=20, problem_types=12):
+    """Return dashboard project views, each with a different subset of file, node and problem types."""
+    views = []
+    for i in range(projects):
+        views.append({
+            'source': ['Terra', 'Gen3', 'dbGAP'][i % 3],
+            'project_id': f"AnVIL_project_{i}",
+            'qualified_accession': f"phs{i:06d}.v1.p1" if i % 4 else None,
+            'files': [{'type': f"file_type_{t}", 'size': i * 1000 + t} for t in range(file_types) if (i + t) % 3],
+            'size': i * 100000,
+            'nodes': [{'type': f"node_type_{t}", 'count': i + t} for t in range(node_types) if (i * t) % 5 != 1],
+            'problems': [f"problem_{t}" for t in range(problem_types) if (i + t) % 7 == 0],
+        })
+    return views
@@ -0,0 +1,25 @@
+"""Test rendering dashboard project views."""
+
+import io
+
+from anvil.util.dashboard import flatten, write_tsv
+from tests.benchmarks.bench_dashboard import legacy_flatten, legacy_tsv
+from tests.conftest import synthetic_project_views
+
+
+def test_flatten_matches_legacy():
+    """Rows and columns are the ones the list.index() implementation produced."""
+    views = synthetic_project_views(60)
+    flattened, column_names = flatten(views)
+    assert (flattened, column_names) == legacy_flatten(views)
+    assert column_names[:4] == ['source', 'workspace', 'accession', 'file_type_0']
+    assert flatten([]) == ([], ['source', 'workspace', 'accession', 'size'])
+
+
+def test_write_tsv_matches_dataframe():
+    """The streamed tsv is byte for byte what DataFrame.to_csv wrote."""
+    views = synthetic_project_views(60)
+    streamed, expected = io.StringIO(), io.StringIO()
+    assert write_tsv(views, streamed) == 60
+    legacy_tsv(views, expected)
+    assert streamed.getvalue() == expected.getvalue()
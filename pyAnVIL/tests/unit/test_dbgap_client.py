@@ -0,0 +1,111 @@
+"""Test the dbGap client against a local stub of the NCBI endpoints."""
+
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from anvil.dbgap.client import StudyCache, get_studies, sample_ids
+
+
+def sample_status(qualified_accession, samples):
+    """Return a GetSampleStatus style document."""
+    rows = ''.join(
+        f'<Sample dbgap_sample_id="{i}" submitted_sample_id="{qualified_accession}-s{i}" consent_code="1"/>' for i in range(samples)
+    )
+    return f'<?xml version="1.0"?><DbGap><Study accession="{qualified_accession}"><SampleList>{rows}</SampleList></Study></DbGap>'
+
+
+class NCBIHandler(BaseHTTPRequestHandler):
+    """Redirect study.cgi to the qualified accession, serve sample status for it."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Answer study.cgi and GetSampleStatus.cgi."""
+        server = self.server
+        with server.lock:
+            server.requests.append((time.monotonic(), self.path))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.latency)
+            parts = urlparse(self.path)
+            study_id = parse_qs(parts.query)['study_id'][0]
+            body = b''
+            if parts.path.endswith('/study.cgi') and study_id in server.studies:
+                self.send_response(302)
+                self.send_header('Location', f"/projects/gap/cgi-bin/study.cgi?study_id={study_id}.v1.p1")
+            elif parts.path.endswith('/GetSampleStatus.cgi') and study_id.split('.')[0] in server.studies:
+                body = sample_status(study_id, server.studies[study_id.split('.')[0]]).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml')
+            else:
+                self.send_response(404)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        """Quiet."""
+        pass
+
+
+@pytest.fixture
+def ncbi():
+    """Run a stub NCBI with six studies of 1 to 6 samples."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NCBIHandler)
+    server.studies = {f"phs{i:06d}": i for i in range(1, 7)}
+    server.requests = []
+    server.latency = 0.0
+    server.active = server.max_active = 0
+    server.lock = threading.Lock()
+    server.base_url = f"http://127.0.0.1:{server.server_port}/projects/gap/cgi-bin"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_studies(ncbi, tmp_path):
+    """Studies are fetched concurrently, cached as extracted fields, failures are retried next time."""
+    ncbi.latency = 0.2
+    cache = StudyCache(str(tmp_path / 'cache.sqlite'))
+    accessions = list(ncbi.studies) + ['phs999999']
+    start = time.time()
+    studies = get_studies(accessions, max_workers=7, rate=0, cache=cache, base_url=ncbi.base_url)
+    # two sequential requests per study, the studies in parallel
+    assert time.time() - start < 7 * 2 * 0.2
+    assert ncbi.max_active > 1
+    assert studies['phs999999'] is None
+    assert studies['phs000003'] == {
+        'accession': 'phs000003', 'qualified_accession': 'phs000003.v1.p1', 'sample_count': 3,
+        'sample_ids': ['phs000003.v1.p1-s0', 'phs000003.v1.p1-s1', 'phs000003.v1.p1-s2'],
+    }
+    assert [studies[accession]['sample_count'] for accession in ncbi.studies] == [1, 2, 3, 4, 5, 6]
+
+    requests = len(ncbi.requests)
+    assert get_studies(accessions, cache=cache, base_url=ncbi.base_url) == studies
+    # only the failed accession is asked for again
+    assert [path for _, path in ncbi.requests[requests:]] == ['/projects/gap/cgi-bin/study.cgi?study_id=phs999999']
+
+
+def test_rate_limit(ncbi, tmp_path):
+    """Requests from all workers are spaced by the rate."""
+    get_studies(list(ncbi.studies), max_workers=6, rate=20, cache=StudyCache(str(tmp_path / 'cache.sqlite')), base_url=ncbi.base_url)
+    times = sorted(t for t, _ in ncbi.requests)
+    assert len(times) == 12
+    assert times[-1] - times[0] >= 11 * 0.05 * 0.9
+
+
+def test_sample_ids():
+    """A single sample is counted as one (xmltodict returned a dict there)."""
+    assert sample_ids(io.BytesIO(sample_status('phs000001.v1.p1', 1).encode())) == ['phs000001.v1.p1-s0']
+    assert sample_ids(io.BytesIO(sample_status('phs000001.v1.p1', 0).encode())) == []
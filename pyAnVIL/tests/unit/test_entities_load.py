@@ -0,0 +1,190 @@
+"""Test batched PFB loading."""
+
+import io
+import json
+import os
+import sqlite3
+
+from fastavro import reader, writer
+
+import anvil.gen3.entities
+from anvil.gen3.entities import Entities, avro_blocks, flatten, summarize
+from tests.conftest import PFB_SCHEMA, synthetic_pfb_records
+
+
+def test_batched_load(tmp_path, monkeypatch):
+    """Records spanning several batches load once, repeated records and relations are ignored."""
+    monkeypatch.setattr(anvil.gen3.entities, 'BATCH_SIZE', 100)
+    records = list(synthetic_pfb_records(200))
+    # a PFB may repeat a node, e.g. in several projects' exports
+    records += records[:50]
+    avro_path = tmp_path / 'export.avro'
+    output = io.BytesIO()
+    writer(output, PFB_SCHEMA, records)
+    avro_path.write_bytes(output.getvalue())
+
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    entities = Entities(str(avro_path), drs_output_path)
+    entities.load(workers=1)
+    conn = sqlite3.connect(drs_output_path)
+    assert conn.execute('select count(*) from vertices').fetchone()[0] == 600
+    assert conn.execute('select count(*) from edges').fetchone()[0] == 400
+    assert conn.execute('select count(*) from flattened').fetchone()[0] == 200
+    assert entities.get(key='sequencing-3')['object']['file_name'] == 'f-3.cram'
+
+    # loaded once
+    entities.load(workers=1)
+    assert conn.execute('select count(*) from history').fetchone()[0] == 1
+
+
+def test_parallel_load(tmp_path):
+    """Blocks decoded in worker processes are written in file order, same as a sequential load."""
+    records = list(synthetic_pfb_records(300))
+    # a later duplicate with different content must lose to the first, as in a sequential load
+    records.append(dict(records[0], object={'participant_id': 'changed'}))
+    avro_path = tmp_path / 'export.avro'
+    with open(avro_path, 'wb') as fo:
+        writer(fo, PFB_SCHEMA, records, codec='deflate', sync_interval=1024)
+    header_size, blocks = avro_blocks(str(avro_path))
+    assert len(blocks) > 10
+    assert blocks[0][0] == header_size and sum(size for _, size in blocks) + header_size == avro_path.stat().st_size
+
+    results = []
+    for workers in [1, 3]:
+        drs_output_path = str(tmp_path / f"gen3-drs-{workers}.sqlite")
+        entities = Entities(str(avro_path), drs_output_path)
+        if workers == 1:
+            with open(avro_path, 'rb') as fo:
+                assert entities.load_records(reader(fo)) == len(records)
+        else:
+            assert entities.load_parallel(workers=workers, chunk_bytes=4096) == len(records)
+        conn = sqlite3.connect(drs_output_path)
+        results.append((
+            conn.execute('select * from vertices order by key').fetchall(),
+            conn.execute('select * from edges order by src, dst').fetchall(),
+        ))
+    assert results[0] == results[1]
+    assert len(results[1][0]) == 900
+    assert entities.get(key='subject-0')['object']['participant_id'] == 'p-0'
+
+
+def test_typed_columns(synthetic_pfb, tmp_path):
+    """Hot node properties are columns, flattened matches the properties in the json."""
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    Entities(str(synthetic_pfb), drs_output_path).load(workers=1)
+    conn = sqlite3.connect(drs_output_path)
+    assert conn.execute("select participant_id, project_id, anvil_project_id from vertices where key = 'subject-1'").fetchone() == ('p-1', 'project-1', 'anvil-project-1')
+    assert conn.execute("select file_name, md5sum, ga4gh_drs_uri from vertices where key = 'sequencing-1'").fetchone() == ('f-1.cram', f"{1:032x}", 'drs://example.org/1')
+    flattened = conn.execute("select subject_id, project_id, anvil_project_id, sample_submitter_id, ga4gh_drs_uri from flattened order by subject_id").fetchall()
+    expected = conn.execute("""
+        select su.key, json_extract(su.json, '$.object.project_id'), json_extract(su.json, '$.object.anvil_project_id'),
+            json_extract(sa.json, '$.object.submitter_id'), json_extract(sq.json, '$.object.ga4gh_drs_uri')
+        from vertices su join vertices sa on sa.key = replace(su.key, 'subject', 'sample')
+            join vertices sq on sq.key = replace(su.key, 'subject', 'sequencing')
+        where su.name = 'subject' order by su.key""").fetchall()
+    assert len(flattened) == 500 and flattened == expected
+    assert conn.execute("select count(*), sum(subject_count) from summary").fetchone() == (3, 500)
+
+
+def test_ensure_columns(tmp_path):
+    """Vertices written before the typed columns existed are migrated."""
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    conn = sqlite3.connect(drs_output_path)
+    conn.execute("CREATE TABLE vertices (key text PRIMARY KEY, submitter_id text, name text, json text NOT NULL);")
+    conn.execute("insert into vertices values ('sample-1', 's-1', 'sample', ?);", (json.dumps({'object': {'specimen_id': 's-1', 'project_id': 'p'}}),))
+    conn.commit()
+    Entities('unused.avro', drs_output_path)
+    assert conn.execute("select specimen_id, project_id, md5sum from vertices").fetchone() == ('s-1', 'p', None)
+
+
+def test_incremental_load(tmp_path):
+    """A new export with the same name applies only its differences, a renamed one changes nothing."""
+    avro_path = tmp_path / 'export.avro'
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    records = list(synthetic_pfb_records(300))
+    with open(avro_path, 'wb') as fo:
+        writer(fo, PFB_SCHEMA, records)
+    Entities(str(avro_path), drs_output_path).load(workers=1)
+    # unchanged file is skipped
+    Entities(str(avro_path), drs_output_path).load(workers=1)
+
+    # next export: subject-0 changed, subject-299 (project-2) and its sample and sequencing gone, subject-300 (project-0) new
+    changed = [dict(r, object=dict(r['object'], participant_id='changed')) if r['id'] == 'subject-0' else r for r in records]
+    changed = [r for r in changed if not r['id'].endswith('-299')] + list(synthetic_pfb_records(301))[-3:]
+    with open(avro_path, 'wb') as fo:
+        writer(fo, PFB_SCHEMA, changed)
+    os.utime(avro_path, ns=(0, 1))
+    entities = Entities(str(avro_path), drs_output_path)
+    entities.load(workers=1)
+
+    conn = sqlite3.connect(drs_output_path)
+    history = conn.execute("select key, records, inserted, updated, deleted, unchanged from history order by rowid").fetchall()
+    assert history == [(str(avro_path), 900, 900, 0, 0, 0), (str(avro_path), 900, 3, 1, 3, 896)]
+    assert entities.get(key='subject-0')['object']['participant_id'] == 'changed'
+    assert conn.execute("select count(*) from vertices where key like '%-299'").fetchone()[0] == 0
+    assert conn.execute("select count(*) from edges where src like '%-299'").fetchone()[0] == 0
+
+    # refreshed projects match a full rebuild
+    delta = (conn.execute("select * from flattened order by sequencing_id").fetchall(), conn.execute("select * from summary order by project_id").fetchall())
+    flatten(conn)
+    summarize(conn)
+    assert delta == (conn.execute("select * from flattened order by sequencing_id").fetchall(), conn.execute("select * from summary order by project_id").fetchall())
+    assert conn.execute("select participant_id from flattened where subject_id = 'subject-0'").fetchone()[0] == 'changed'
+    # project rows are found through indexes
+    for table, index in [('flattened', 'flattened_project_id'), ('summary', 'summary_project_id'), ('vertices', 'vertices_project_id')]:
+        plan = ' '.join(row[-1] for row in conn.execute(f"explain query plan delete from {table} where project_id in ('project-0');"))
+        assert index in plan, plan
+    plan = ' '.join(row[-1] for row in conn.execute("explain query plan select * from vertices where name = 'subject' and project_id in ('project-0');"))
+    assert 'vertices_name_project_id' in plan, plan
+
+    renamed_path = tmp_path / 'renamed.avro'
+    os.rename(avro_path, renamed_path)
+    Entities(str(renamed_path), drs_output_path).load(workers=1)
+    assert conn.execute("select records, inserted, updated, deleted, unchanged from history order by rowid desc").fetchone() == (900, 0, 0, 0, 900)
+    # both names hold the nodes, neither export alone deletes them
+    assert conn.execute("select source, count(*) from sources group by source order by source").fetchall() == [(str(avro_path), 900), (str(renamed_path), 900)]
+
+
+def test_incremental_load_source(tmp_path):
+    """Exports sharing a source replace each other's nodes whatever their file names, edges into deleted nodes go too."""
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    records = list(synthetic_pfb_records(30))
+    with open(tmp_path / 'export_2021-01-01.avro', 'wb') as fo:
+        writer(fo, PFB_SCHEMA, records)
+    Entities(str(tmp_path / 'export_2021-01-01.avro'), drs_output_path, source='AnVIL_CMG').load(workers=1)
+
+    # subject-29 is gone, its sample is left pointing at it
+    with open(tmp_path / 'export_2021-02-01.avro', 'wb') as fo:
+        writer(fo, PFB_SCHEMA, [r for r in records if r['id'] != 'subject-29'])
+    Entities(str(tmp_path / 'export_2021-02-01.avro'), drs_output_path, source='AnVIL_CMG').load(workers=1)
+
+    conn = sqlite3.connect(drs_output_path)
+    assert conn.execute("select inserted, updated, deleted, unchanged from history order by rowid desc").fetchone() == (0, 0, 1, 89)
+    assert conn.execute("select count(*) from vertices where key = 'subject-29'").fetchone()[0] == 0
+    assert conn.execute("select count(*) from edges where dst = 'subject-29'").fetchone()[0] == 0
+    assert conn.execute("select distinct source from sources").fetchall() == [('AnVIL_CMG',)]
+
+
+def test_incremental_load_shared_nodes(tmp_path):
+    """A node in several exports is only deleted once none of them contain it."""
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    records = list(synthetic_pfb_records(30))
+    without = [r for r in records if r['id'] != 'subject-29']
+    conn = sqlite3.connect(drs_output_path)
+
+    def _load(source, export):
+        with open(tmp_path / f"{source}.avro", 'wb') as fo:
+            writer(fo, PFB_SCHEMA, export)
+        Entities(str(tmp_path / f"{source}.avro"), drs_output_path, source=source).load(workers=1)
+        return conn.execute("select count(*) from vertices where key = 'subject-29'").fetchone()[0]
+
+    assert _load('B', records) == 1
+    assert _load('A', records) == 1
+    # B still holds subject-29
+    assert _load('A', without) == 1
+    assert conn.execute("select count(*) from edges where dst = 'subject-29'").fetchone()[0] == 1
+    assert _load('B', without) == 0
+    assert conn.execute("select count(*) from edges where dst = 'subject-29'").fetchone()[0] == 0
+    assert conn.execute("select deleted from history order by rowid desc").fetchone() == (1,)
+    plan = ' '.join(row[-1] for row in conn.execute("explain query plan select 1 from sources where key = 'subject-29';"))
+    assert 'sources_key' in plan, plan
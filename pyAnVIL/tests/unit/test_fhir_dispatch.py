@@ -0,0 +1,186 @@
+"""Test bounded fan-out of FHIR searches."""
+
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fhirclient import client
+from fhirclient.models.patient import Patient
+
+from anvil.clients.fhir_client import DispatchingFHIRClient
+from anvil.fhir import client as legacy_client
+from anvil.clients.fhir_dispatch import dispatch, iter_json_pages, prefetch_iter
+from anvil.clients.transport import new_session
+from anvil.util.ndjson import NDJSONWriter
+
+
+def _client(servers, retrieve_all=True):
+    """Create a client for servers."""
+    settings = {'app_id': 'test', 'api_bases': [s.base_url for s in servers], 'retrieve_all': retrieve_all}
+    return DispatchingFHIRClient(settings=settings)
+
+
+def test_dispatch_order_and_errors():
+    """Items from each iterator keep their order, errors are raised."""
+    def _slow(name, count, delay):
+        for i in range(count):
+            time.sleep(delay)
+            yield (name, i)
+
+    results = list(dispatch([_slow('a', 5, 0.01), _slow('b', 3, 0.02)], prefetch=1))
+    for name in ['a', 'b']:
+        assert [item for _, item in results if item[0] == name] == [(name, i) for i in range(5 if name == 'a' else 3)]
+
+    def _broken():
+        yield 1
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        list(dispatch([_broken(), _slow('a', 2, 0)]))
+
+
+def test_dispatch_prefetch_and_concurrency():
+    """Producers should run at most `prefetch` items ahead, and no more than pool size at once."""
+    active, max_active, produced = [0], [0], []
+    lock = threading.Lock()
+
+    def _counting(name):
+        for i in range(4):
+            with lock:
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+                produced.append(name)
+            yield i
+
+    pool = ThreadPoolExecutor(max_workers=2)
+    generator = dispatch([_counting(n) for n in range(5)], prefetch=1, pool=pool)
+    next(generator)
+    time.sleep(0.2)
+    # a consumer that stops reading bounds how much is fetched
+    assert len(produced) <= 5 * 2
+    generator.close()
+    results = list(dispatch([_counting(n) for n in range(5)], prefetch=1, pool=pool))
+    assert len(results) == 20
+    assert max_active[0] <= 2
+
+
+def test_nested_dispatch():
+    """A search dispatched while consuming another should not wait on threads held by the outer producers."""
+    pool = ThreadPoolExecutor(max_workers=2)
+    results = []
+
+    def _consume():
+        for _, outer in dispatch([iter(range(3)) for _ in range(4)], prefetch=1, pool=pool):
+            results.append((outer, sorted(item for _, item in dispatch([iter(range(2)) for _ in range(4)], pool=pool))))
+
+    consumer = threading.Thread(target=_consume, daemon=True)
+    consumer.start()
+    consumer.join(timeout=10)
+    assert not consumer.is_alive(), 'nested dispatch deadlocked'
+    assert len(results) == 12
+    assert all(inner == [0, 0, 0, 0, 1, 1, 1, 1] for _, inner in results)
+    # an abandoned generator pins no threads
+    abandoned = dispatch([iter(range(10)) for _ in range(4)], prefetch=1, pool=pool)
+    next(abandoned)
+    assert sorted(item for _, item in dispatch([iter(range(2))], pool=pool)) == [0, 1]
+    abandoned.close()
+
+
+def test_dispatching_client(fhir_search_servers):
+    """All pages from all servers should be returned, each tagged with its source."""
+    servers = [fhir_search_servers(count=7, page_size=3), fhir_search_servers(count=4, page_size=3)]
+    smart = _client(servers)
+    bundles = list(smart.search_bundles(Patient.where(struct={})))
+    assert len(bundles) == 3 + 2
+    for server in servers:
+        ids = [e.resource.id for b in bundles if b.meta.source == server.base_url for e in b.entry]
+        assert ids == [str(i) for i in range(server.count)], "pages should be in order per server"
+
+    resources = Patient.where(struct={}).perform_resources(smart.server)
+    assert len(resources) == 11
+    assert {r.meta.source for r in resources} == {s.base_url for s in servers}
+
+    first_pages = list(_client(servers, retrieve_all=False).search_bundles(Patient.where(struct={})))
+    assert len(first_pages) == 2
+
+
+def test_both_dispatching_clients(fhir_search_servers):
+    """The legacy and current clients, and a plain fhirclient one, share the FHIRSearch patch in one process."""
+    servers = [fhir_search_servers(count=7, page_size=3), fhir_search_servers(count=4, page_size=3)]
+    settings = {'app_id': 'test', 'api_bases': [s.base_url for s in servers]}
+    legacy = legacy_client.DispatchingFHIRClient(settings=settings, access_token='token')
+    smart = _client(servers)
+    for _client_ in (legacy, smart):
+        bundles = Patient.where(struct={}).perform(_client_.server)
+        assert len(bundles) == 3 + 2
+        assert {b.meta.source for b in bundles} == {s.base_url for s in servers}
+    assert settings['api_bases'] == [s.base_url for s in servers]
+    assert 'Bearer token' in {h.get('Authorization') for h in servers[0].headers}
+
+    # not dispatching, fhirclient's own search against its one server
+    plain = client.FHIRClient(settings={'app_id': 'test', 'api_base': servers[1].base_url})
+    bundle = Patient.where(struct={}).perform(plain.server)
+    assert [e.resource.id for e in bundle.entry] == ['0', '1', '2']
+
+
+def test_both_clients_resources(fhir_search_servers):
+    """perform_resources and the iterator API page through all servers for either dispatching client, one server otherwise."""
+    servers = [fhir_search_servers(count=7, page_size=3), fhir_search_servers(count=4, page_size=3)]
+    settings = {'app_id': 'test', 'api_bases': [s.base_url for s in servers]}
+    plain = client.FHIRClient(settings={'app_id': 'test', 'api_base': servers[0].base_url})
+    for _client_ in (legacy_client.DispatchingFHIRClient(settings=settings, access_token='token'), _client(servers)):
+        assert len(Patient.where(struct={}).perform_resources(_client_.server)) == 11
+        assert len(list(Patient.where(struct={}).perform_iter(_client_.server))) == 3 + 2
+        resources = list(Patient.where(struct={}).perform_resources_iter(_client_.server))
+        assert sorted(int(r.id) for r in resources if r.meta.source == servers[0].base_url) == list(range(7))
+        assert len(resources) == 11
+        # fhirclient's own paging against one server
+        assert [r.id for r in Patient.where(struct={}).perform_resources_iter(plain.server)] == [str(i) for i in range(7)]
+        assert len(list(Patient.where(struct={}).perform_iter(plain.server))) == 3
+
+
+def test_iter_resources(fhir_search_servers):
+    """Resources should stream with requested page size, stopping early at limit."""
+    servers = [fhir_search_servers(count=50, page_size=5, latency=0.01), fhir_search_servers(count=20, page_size=5, latency=0.01)]
+    smart = _client(servers)
+    resources = list(smart.iter_resources(Patient.where(struct={}), count=10))
+    assert len(resources) == 70
+    assert all(r.meta.source for r in resources)
+    search_requests = [path for s in servers for path in s.requests if 'Patient' in path]
+    assert all('_count=10' in path for path in search_requests)
+    assert len(search_requests) == 5 + 2
+
+    for s in servers:
+        s.requests.clear()
+    resources = list(smart.iter_resources(Patient.where(struct={}), count=2, limit=3))
+    assert len(resources) == 3
+    time.sleep(0.1)
+    # at most the consumed pages plus prefetch were requested, not all 35
+    assert sum(len(s.requests) for s in servers) <= 8
+
+    # fhirclient's iterator API streams from all servers
+    assert len(list(Patient.where(struct={}).perform_resources_iter(smart.server))) == 70
+
+
+def test_prefetch_pager(fhir_search_servers):
+    """Next page should be requested while the caller writes the current one."""
+    server = fhir_search_servers(count=10, page_size=2, latency=0.05)
+    url = f"{server.base_url}Patient?_count=2"
+    output = io.StringIO()
+    start = time.time()
+    with NDJSONWriter(output, buffer_size=100) as writer:
+        for page in prefetch_iter(iter_json_pages(new_session(), url), depth=1):
+            time.sleep(0.05)
+            writer.write(page)
+    elapsed = time.time() - start
+    pages = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [e['resource']['id'] for p in pages for e in p['entry']] == [str(i) for i in range(10)]
+    assert writer.count == 5
+    # sequential would take 5 * (0.05 + 0.05)
+    assert elapsed < 0.45
@@ -0,0 +1,96 @@
+"""Test Healthcare API import driver against a stub server."""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from anvil.clients.healthcare_import import HealthcareImporter
+from anvil.clients.token_provider import TokenProvider
+
+
+class StubHealthcareHandler(BaseHTTPRequestHandler):
+    """Start import operations, done after `server.polls` GETs."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _send(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        """Start operation."""
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        store = self.path.split('/fhirStores/')[1].split(':')[0]
+        with self.server.lock:
+            self.server.authorization.add(self.headers.get('Authorization'))
+            self.server.active[store] = self.server.active.get(store, 0) + 1
+            assert self.server.active[store] == 1, "imports to a store should not overlap"
+            name = f"projects/p/locations/l/datasets/d/operations/{len(self.server.operations)}"
+            self.server.operations[name] = {'store': store, 'uri': body['gcsSource']['uri'], 'polls': 0, 'started': time.time()}
+            self.server.concurrent = max(self.server.concurrent, sum(self.server.active.values()))
+        self._send({'name': name})
+
+    def do_GET(self):
+        """Poll operation."""
+        name = self.path.lstrip('/').split('/', 1)[1]
+        with self.server.lock:
+            operation = self.server.operations[name]
+            operation['polls'] += 1
+            done = operation['polls'] >= self.server.polls
+            body = {'name': name, 'metadata': {'counter': {'success': '10'}}}
+            if done:
+                self.server.active[operation['store']] -= 1
+                body['done'] = True
+                if 'bad' in operation['uri']:
+                    body['metadata']['counter']['failure'] = '2'
+                    body['error'] = {'code': 3, 'message': 'some resources failed'}
+        self._send(body)
+
+    def log_message(self, *args):
+        """Quiet."""
+        pass
+
+
+@pytest.fixture
+def healthcare_stub():
+    """Run stub Healthcare API."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHealthcareHandler)
+    server.operations, server.active, server.authorization = {}, {}, set()
+    server.lock, server.polls, server.concurrent = threading.Lock(), 3, 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_import_all(healthcare_stub):
+    """Stores import concurrently, imports per store in order, results summarized per store."""
+    importer = HealthcareImporter(
+        'p', 'l', 'd', api=f"http://127.0.0.1:{healthcare_stub.server_port}/v1",
+        token_provider=TokenProvider(lambda: ('test-token', time.time() + 3600)),
+        poll_interval=0.01, max_poll_interval=0.05
+    )
+    imports = [
+        ('public', 'gs://b/w1/public/*.json'),
+        ('public', 'gs://b/w2/public/*.json'),
+        ('store-a', 'gs://b/w1/protected/*.json'),
+        ('store-b', 'gs://b/bad/protected/*.json'),
+    ]
+    jobs = importer.import_all(imports)
+    assert [(j.store, j.gcs_uri) for j in jobs] == [i[:2] for i in imports]
+    assert all(j.done and j.polls == 3 for j in jobs)
+    assert healthcare_stub.concurrent > 1, "stores should import concurrently"
+    assert healthcare_stub.authorization == {'Bearer test-token'}
+
+    report = {row['store']: row for row in importer.report(jobs)}
+    assert report['public']['imports'] == 2 and report['public']['success'] == 20
+    assert report['store-b']['errors'] == 1 and report['store-b']['failure'] == 2
+    assert report['store-a']['per_second'] > 0
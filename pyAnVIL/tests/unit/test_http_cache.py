@@ -0,0 +1,105 @@
+"""Test client side FHIR response cache."""
+
+import base64
+import json
+import time
+
+from fhirclient.models.patient import Patient
+
+from anvil.clients.fhir_client import FHIRClient
+from anvil.clients.http_cache import ResponseCache
+from anvil.clients.transport import new_session
+
+
+def test_ttl_and_revalidation(fhir_search_servers, tmp_path):
+    """Fresh entries are served locally, stale ones revalidated with If-None-Match."""
+    server = fhir_search_servers()
+    url = f"{server.base_url}Patient/1"
+    cache = ResponseCache(path=str(tmp_path / 'cache.sqlite'), ttl=0.2)
+    session = new_session(cache=cache)
+
+    assert session.get(url).json()['meta']['versionId'] == '1'
+    assert session.get(url).json()['meta']['versionId'] == '1'
+    assert len(server.requests) == 1
+    assert cache.stats == {'hits': 1, 'revalidated': 0, 'misses': 1}
+
+    time.sleep(0.3)
+    response = session.get(url)
+    assert response.status_code == 200 and response.json()['id'] == '1'
+    assert server.headers[-1]['If-None-Match'] == 'W/"1"'
+    assert cache.stats['revalidated'] == 1
+
+    # changed on server
+    server.version = 2
+    time.sleep(0.3)
+    assert session.get(url).json()['meta']['versionId'] == '2'
+
+    # different credentials don't share entries
+    other = new_session(cache=cache)
+    other.headers['Authorization'] = 'Bearer other'
+    other.get(url)
+    assert 'If-None-Match' not in server.headers[-1]
+
+    # entries survive restarts
+    restarted = new_session(cache=ResponseCache(path=str(tmp_path / 'cache.sqlite'), ttl=60))
+    requests_made = len(server.requests)
+    assert restarted.get(url).json()['meta']['versionId'] == '2'
+    assert len(server.requests) == requests_made
+
+
+def test_fhir_client_cache(fhir_search_servers):
+    """Repeated reads through FHIRClient should not reach the server."""
+    server = fhir_search_servers()
+    cache = ResponseCache(ttl=60)
+    smart = FHIRClient(settings={'app_id': 'test', 'api_base': server.base_url}, cache=cache)
+    for _ in range(3):
+        assert Patient.read('1', smart.server).id == '1'
+    assert len([path for path in server.requests if 'Patient/1' in path]) == 1
+
+
+def _segment(data):
+    """Return data as a JWT segment."""
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def _jwt(claims, signature):
+    """Return a bearer JWT with claims, the signature is not checked."""
+    return f"Bearer {_segment({'alg': 'RS256'})}.{_segment(claims)}.{signature}"
+
+
+def test_cache_scope_and_limits(fhir_search_servers):
+    """Entries are keyed on the credentials, not on unverified token claims; responses without validators, or too large, aren't stored."""
+    server = fhir_search_servers()
+    url = f"{server.base_url}Patient/1"
+    cache = ResponseCache(ttl=60)
+    session = new_session(cache=cache)
+    session.headers['Authorization'] = _jwt({'iss': 'https://issuer', 'sub': 'user-1', 'exp': 1}, 'a')
+    session.get(url)
+    session.get(url)
+    assert len(server.requests) == 1
+    # a forged token claiming the same subject doesn't read user-1's entries
+    session.headers['Authorization'] = _jwt({'iss': 'https://issuer', 'sub': 'user-1', 'exp': 1}, 'forged')
+    session.get(url)
+    assert len(server.requests) == 2
+
+    # a caller supplied scope is shared by all credentials
+    scoped = new_session(cache=ResponseCache(ttl=60, scope='service-account'))
+    for token in ('ya29.one', 'ya29.two'):
+        scoped.headers['Authorization'] = f"Bearer {token}"
+        scoped.get(url)
+    assert len(server.requests) == 3
+
+    # search pages have no ETag or Last-Modified, they can't be revalidated
+    for _ in range(2):
+        session.get(f"{server.base_url}Patient?_count=3")
+    assert len(server.requests) == 5
+
+    small = new_session(cache=ResponseCache(ttl=60, max_bytes=10))
+    for _ in range(2):
+        assert small.get(url).json()['id'] == '1'
+    assert len(server.requests) == 7
+    # streamed bodies are left to the caller
+    for _ in range(2):
+        with session.get(f"{server.base_url}Patient/2", stream=True) as response:
+            assert response.json()['id'] == '2'
+    assert len(server.requests) == 9
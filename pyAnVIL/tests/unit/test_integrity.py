@@ -0,0 +1,57 @@
+"""Test the gen3 graph integrity checks."""
+
+import io
+import sqlite3
+
+from fastavro import writer
+
+from anvil.gen3.entities import Entities
+from anvil.gen3.integrity import check
+from tests.conftest import PFB_SCHEMA, synthetic_pfb_records
+
+
+def broken_records(subjects):
+    """Synthetic records, every 10th sample without sequencing, every 25th without subject, every 50th pointing at a missing subject."""
+    for record in synthetic_pfb_records(subjects):
+        i = int(record['id'].split('-')[1])
+        if record['name'] == 'sequencing' and i % 10 == 0:
+            continue
+        if record['name'] == 'sample' and i % 25 == 0:
+            record['relations'] = []
+        if record['name'] == 'sample' and i % 50 == 1:
+            record['relations'] = [{'dst_id': 'subject-missing', 'dst_name': 'subject'}]
+        yield record
+
+
+def test_check(tmp_path):
+    """Problems are counted per node type and project, and listed per node."""
+    avro_path = tmp_path / 'export.avro'
+    output = io.BytesIO()
+    writer(output, PFB_SCHEMA, broken_records(300))
+    avro_path.write_bytes(output.getvalue())
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    Entities(str(avro_path), drs_output_path).load(workers=1)
+    conn = sqlite3.connect(drs_output_path)
+
+    report = {(row['name'], row['project_id']): row for row in check(conn)}
+    assert len(report) == 9
+    # subjects 0, 3, 6 ... in project-0; 25 and 50 orphan their subject, 1 and 51 too (their sample points elsewhere)
+    assert sum(row['nodes'] for row in report.values()) == 870
+    samples = [row for (name, _), row in report.items() if name == 'sample']
+    assert sum(row['missing_child'] for row in samples) == 30
+    assert sum(row['missing_parent'] for row in samples) == 12
+    assert sum(row['dangling'] for row in samples) == 6
+    subjects = [row for (name, _), row in report.items() if name == 'subject']
+    assert sum(row['missing_child'] for row in subjects) == 18
+    assert report[('sample', 'project-0')] == {
+        'name': 'sample', 'project_id': 'project-0', 'nodes': 100, 'missing_parent': 4, 'missing_child': 10, 'dangling': 2
+    }
+
+    missing = conn.execute("select key from node_problems where name = 'sample' and missing_parent and not dangling order by key").fetchall()
+    assert missing == [(f"sample-{i}",) for i in sorted(map(str, range(0, 300, 25)))]
+
+    # the anti joins use the covering indexes
+    plan = ' '.join(str(row) for row in conn.execute(
+        "explain query plan select 1 from vertices as v where not exists (select 1 from edges as e where e.dst = v.key and e.src_name = 'sample')"
+    ))
+    assert 'COVERING INDEX edges_dst_src_name' in plan
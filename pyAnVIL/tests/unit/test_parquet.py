@@ -0,0 +1,56 @@
+"""Test the partitioned Parquet export."""
+
+import sqlite3
+
+import pytest
+
+from anvil.util.parquet import consortium, export
+
+pa_dataset = pytest.importorskip('pyarrow.dataset')
+
+CONSORTIUMS = (
+    ('CMG', 'AnVIL_CMG_.*'),
+    ('GTEx', '^AnVIL_GTEx_V8_hg38$'),
+)
+
+
+def database():
+    """Return connection with small flattened and terra_details tables."""
+    conn = sqlite3.connect(':memory:')
+    conn.execute("create table flattened (project_id text, anvil_project_id text, sample_id text, ga4gh_drs_uri text);")
+    conn.executemany("insert into flattened values (?, ?, ?, ?);", [
+        (f"project-{i % 3}", ['AnVIL_CMG_Broad', 'AnVIL_GTEx_V8_hg38', None][i % 3], f"sample-{i}", f"drs://example.org/{i}")
+        for i in range(300)
+    ])
+    conn.execute("create table terra_details (workspace_id text, subject_id text, sample_id text, blob text);")
+    conn.executemany("insert into terra_details values (?, ?, ?, ?);", [
+        (['AnVIL_CMG_Broad', 'AnVIL_Other'][i % 2], f"p-{i}", f"s-{i}", f"gs://bucket/{i}.cram") for i in range(100)
+    ])
+    return conn
+
+
+def test_consortium():
+    """Workspace names match consortium patterns like terra does, case insensitive."""
+    assert consortium('anvil_cmg_broad', CONSORTIUMS) == 'CMG'
+    assert consortium('AnVIL_GTEx_V8_hg38', CONSORTIUMS) == 'GTEx'
+    assert consortium('AnVIL_Other', CONSORTIUMS) is None
+    assert consortium(None, CONSORTIUMS) is None
+
+
+def test_export(tmp_path):
+    """Tables are written in small batches into consortium/project partitions and read back filtered."""
+    counts = export(database(), str(tmp_path), CONSORTIUMS, batch_size=7)
+    assert counts == {'flattened': 300, 'terra_details': 100}
+    assert (tmp_path / 'flattened' / 'consortium=CMG' / 'project_id=project-0').is_dir()
+    assert (tmp_path / 'terra_details' / 'consortium=CMG' / 'workspace_id=AnVIL_CMG_Broad').is_dir()
+
+    dataset = pa_dataset.dataset(str(tmp_path / 'flattened'), partitioning='hive')
+    assert dataset.count_rows() == 300
+    table = dataset.to_table(filter=pa_dataset.field('consortium') == 'GTEx')
+    assert table.num_rows == 100
+    assert set(table.column('project_id').to_pylist()) == {'project-1'}
+    assert table.column('ga4gh_drs_uri').to_pylist()[0].startswith('drs://')
+
+    # re-export replaces partitions rather than adding files
+    export(database(), str(tmp_path), CONSORTIUMS)
+    assert pa_dataset.dataset(str(tmp_path / 'flattened'), partitioning='hive').count_rows() == 300
@@ -0,0 +1,156 @@
+"""Test terra / gen3 reconciliation."""
+
+import io
+import sqlite3
+
+from fastavro import writer
+
+from anvil.gen3.entities import Entities
+from anvil.gen3.reconcile import reconcile
+from tests.conftest import PFB_SCHEMA, synthetic_pfb_records
+
+LEGACY_RECONCILE = """
+    create table legacy_reconcile_counts as
+    select w.workspace_id,
+        count(distinct w.sample_id) as "terra_sample_id_count",
+        count(distinct f.sample_submitter_id) as "gen3_sample_id_count",
+        count(distinct w.blob) as "terra_blob_count",
+        count(distinct f.ga4gh_drs_uri) as "gen3_drs_uri_count"
+        from terra_details as w
+            left join flattened as f on (w.sample_id || '_sample' = f.sample_submitter_id)
+    group by w.workspace_id
+    having gen3_sample_id_count > 0
+    UNION
+    select w.workspace_id,
+        count(distinct w.sample_id) as "terra_sample_id_count",
+        count(distinct f.sample_submitter_id) as "gen3_sample_id_count",
+        count(distinct w.blob) as "terra_blob_count",
+        count(distinct f.ga4gh_drs_uri) as "gen3_drs_uri_count"
+        from terra_details as w
+            left join flattened as f on (w.sample_id = f.sample_submitter_id)
+    group by w.workspace_id
+    having gen3_sample_id_count > 0
+    UNION
+    select w.workspace_id,
+        count(distinct w.sample_id) as "terra_sample_id_count",
+        count(distinct f.sample_submitter_id) as "gen3_sample_id_count",
+        count(distinct w.blob) as "terra_blob_count",
+        count(distinct f.ga4gh_drs_uri) as "gen3_drs_uri_count"
+        from terra_details as w
+            left join flattened as f on (w.sample_id = f.sample_specimen_id)
+    group by w.workspace_id
+    having gen3_sample_id_count > 0
+    ;
+    insert into legacy_reconcile_counts
+    select w.workspace_id,
+        count(distinct w.sample_id) as "terra_sample_id_count",
+        0 as "gen3_sample_id_count",
+        count(distinct w.blob) as "terra_blob_count",
+        0 as "gen3_drs_uri_count"
+    from terra_details as w
+    where workspace_id not in (select distinct workspace_id from legacy_reconcile_counts)
+    group by w.workspace_id;
+
+    create table legacy_missing_sequencing as
+    select s.key, s.submitter_id from vertices as s
+    where s.name = 'sample' and not EXISTS(select q.src from edges as q where q.dst = s.key);
+
+    create table legacy_subjects_missing_sequencing as
+    select s.key, s.submitter_id from vertices as s
+    where s.name = 'subject' and s.key in (
+        select q.dst from edges as q where q.src in (select ms.key from legacy_missing_sequencing as ms)
+    );
+"""
+
+
+def gen3_records(subjects):
+    """Synthetic records, sample submitter_ids in each naming form gen3 uses, every 10th sample without sequencing."""
+    for record in synthetic_pfb_records(subjects):
+        i = int(record['id'].split('-')[1])
+        if record['name'] == 'sample':
+            form = i % 3
+            record['object']['submitter_id'] = [f"s-{i}_sample", f"s-{i}", f"x-{i}"][form]
+            if form != 2:
+                del record['object']['specimen_id']
+        if record['name'] == 'sequencing' and i % 10 == 0:
+            continue
+        yield record
+
+
+def terra_records(subjects):
+    """Two blobs per terra sample, a workspace per naming form, one mixing forms and one unknown to gen3."""
+    for i in range(subjects):
+        for workspace_id in [f"workspace-{i % 3}"] + (['workspace-mixed'] if i < 30 else []):
+            for blob in ['cram', 'crai']:
+                yield {'workspace_id': workspace_id, 'subject_id': f"p-{i}", 'sample_id': f"s-{i}", 'blob': f"gs://bucket/s-{i}.{blob}"}
+    for i in range(5):
+        yield {'workspace_id': 'workspace-unknown', 'subject_id': f"u-{i}", 'sample_id': f"u-{i}", 'blob': f"gs://bucket/u-{i}.cram"}
+
+
+def test_reconcile_matches_legacy_script(tmp_path):
+    """Counts and missing sequencing match the report script, a workspace matched by several naming forms is one row."""
+    avro_path = tmp_path / 'export.avro'
+    output = io.BytesIO()
+    writer(output, PFB_SCHEMA, gen3_records(300))
+    avro_path.write_bytes(output.getvalue())
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    Entities(str(avro_path), drs_output_path).load(workers=1)
+
+    conn = sqlite3.connect(drs_output_path)
+    reconcile(conn, terra_records(300))
+    conn.executescript(LEGACY_RECONCILE)
+
+    def rows(table, where='true'):
+        return conn.execute(f"select * from {table} where {where} order by 1, 2").fetchall()
+
+    single_form = "workspace_id <> 'workspace-mixed'"
+    assert rows('reconcile_counts', single_form) == rows('legacy_reconcile_counts', single_form)
+    assert rows('reconcile_counts', "workspace_id = 'workspace-unknown'") == [('workspace-unknown', 5, 0, 5, 0)]
+    # 100 samples per form, every 10th without sequencing
+    assert rows('reconcile_counts', "workspace_id = 'workspace-0'") == [('workspace-0', 100, 90, 200, 90)]
+    # the script counted each naming form separately, finding a third of the mixed workspace's samples
+    assert rows('legacy_reconcile_counts', "workspace_id = 'workspace-mixed'") == [('workspace-mixed', 30, 9, 60, 9)]
+    assert rows('reconcile_counts', "workspace_id = 'workspace-mixed'") == [('workspace-mixed', 30, 27, 60, 27)]
+
+    assert rows('missing_sequencing') == rows('legacy_missing_sequencing')
+    assert len(rows('missing_sequencing')) == 30
+    assert rows('subjects_missing_sequencing') == rows('legacy_subjects_missing_sequencing')
+
+    # the key lookup is indexed
+    plan = ' '.join(str(row) for row in conn.execute(
+        "explain query plan select * from terra_details as w left join sample_keys as k on k.join_key = w.sample_id"
+    ))
+    assert 'sample_keys_join_key' in plan
+
+
+def test_multiply_matched_sample(tmp_path):
+    """A terra sample matched by several naming forms counts only the gen3 samples of the first form."""
+    records = list(gen3_records(3))
+    # s-0 is also some other sample's specimen_id, s-1 is the submitter_id of two samples
+    records += [
+        {'id': 'sample-other', 'name': 'sample', 'relations': [{'dst_id': 'subject-0', 'dst_name': 'subject'}],
+         'object': {'submitter_id': 'other', 'specimen_id': 's-0', 'project_id': 'project-0'}},
+        {'id': 'sequencing-other', 'name': 'sequencing', 'relations': [{'dst_id': 'sample-other', 'dst_name': 'sample'}],
+         'object': {'file_name': 'other.cram', 'submitter_id': 'other.cram', 'ga4gh_drs_uri': 'drs://example.org/other', 'project_id': 'project-0'}},
+        {'id': 'sample-duplicate', 'name': 'sample', 'relations': [{'dst_id': 'subject-1', 'dst_name': 'subject'}],
+         'object': {'submitter_id': 's-1', 'project_id': 'project-1'}},
+        {'id': 'sequencing-duplicate', 'name': 'sequencing', 'relations': [{'dst_id': 'sample-duplicate', 'dst_name': 'sample'}],
+         'object': {'file_name': 'duplicate.cram', 'submitter_id': 'duplicate.cram', 'ga4gh_drs_uri': 'drs://example.org/duplicate', 'project_id': 'project-1'}},
+    ]
+    avro_path = tmp_path / 'export.avro'
+    with open(avro_path, 'wb') as fo:
+        writer(fo, PFB_SCHEMA, records)
+    drs_output_path = str(tmp_path / 'gen3-drs.sqlite')
+    Entities(str(avro_path), drs_output_path).load(workers=1)
+
+    conn = sqlite3.connect(drs_output_path)
+    reconcile(conn, [
+        {'workspace_id': 'workspace', 'subject_id': f"p-{i}", 'sample_id': f"s-{i}", 'blob': f"gs://bucket/s-{i}.cram"} for i in range(2)
+    ])
+    # s-0 is sample-0 (s-0_sample, no sequencing), not sample-other;
+    # s-1 is sample-1 and sample-duplicate, same form, one submitter_id, both sequenced
+    assert sorted(conn.execute("select join_key, sample_key from sample_keys where join_key in ('s-0', 's-1')").fetchall()) == [
+        ('s-0', 'sample-0'), ('s-1', 'sample-1'), ('s-1', 'sample-duplicate'),
+    ]
+    # flattened only has sequenced samples, so s-0 adds no gen3 sample and no drs uri; matching sample-other as well would be (2, 2, 2, 3)
+    assert conn.execute("select * from reconcile_counts").fetchall() == [('workspace', 2, 1, 2, 2)]
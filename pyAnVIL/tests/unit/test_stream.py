@@ -0,0 +1,57 @@
+"""Test loading a PFB while it downloads."""
+
+import io
+import sqlite3
+import time
+
+import pytest
+
+from anvil.gen3.entities import Entities
+from anvil.util.stream import PrefetchReader
+
+
+class SlowSource:
+    """Byte stream delivering data in small, delayed pieces, like a download."""
+
+    def __init__(self, data, fail_after=None):
+        """Wrap data."""
+        self._data = io.BytesIO(data)
+        self._fail_after = fail_after
+        self.reads = 0
+
+    def read(self, size):
+        """Return at most 4KB."""
+        self.reads += 1
+        if self._fail_after and self.reads > self._fail_after:
+            raise ConnectionError('connection reset')
+        time.sleep(0.001)
+        return self._data.read(min(size, 4096))
+
+
+@pytest.fixture
+def pfb(synthetic_pfb):
+    """Avro bytes with subjects, samples and sequencing."""
+    return synthetic_pfb.read_bytes()
+
+
+def test_stream_load_and_spill(pfb, tmp_path):
+    """Vertices load from the stream, the spill is the complete download."""
+    spill_path = tmp_path / 'export.avro'
+    entities = Entities(str(spill_path), str(tmp_path / 'gen3-drs.sqlite'))
+    with PrefetchReader(SlowSource(pfb), spill_path=str(spill_path), chunk_size=8192) as stream:
+        entities.load(stream)
+        assert stream.bytes_read == len(pfb)
+    assert spill_path.read_bytes() == pfb
+    conn = sqlite3.connect(str(tmp_path / 'gen3-drs.sqlite'))
+    assert conn.execute('select count(*) from vertices').fetchone()[0] == 1500
+    assert conn.execute('select count(*) from edges').fetchone()[0] == 1000
+    assert entities.get(submitter_id='s-7')['id'] == 'sample-7'
+
+
+def test_stream_error(pfb, tmp_path):
+    """A failed download surfaces to the reader and leaves no spill to retry from."""
+    spill_path = tmp_path / 'export.avro'
+    with pytest.raises(IOError):
+        with PrefetchReader(SlowSource(pfb, fail_after=3), spill_path=str(spill_path)) as stream:
+            stream.read()
+    assert not spill_path.exists()
@@ -0,0 +1,64 @@
+"""Test per project summaries."""
+
+import sqlite3
+
+from anvil.gen3.entities import summarize
+from anvil.util.hyperloglog import HyperLogLog
+
+LEGACY_SUMMARY = """
+    create table legacy_summary as
+    select f.project_id, f.anvil_project_id,
+        count(distinct f.subject_id) as "subject_count",
+        count(distinct f.sample_id) as "sample_count",
+        count(distinct m.sequencing_id) as "sequencing_count",
+        count(distinct m.ga4gh_drs_uri) as "ga4gh_drs_uri_count"
+        from flattened as f
+            left join flattened as m on f.project_id = m.project_id and f.anvil_project_id = m.anvil_project_id
+        group by f.project_id, f.anvil_project_id;
+"""
+
+
+def flattened(rows_per_project=2000, projects=3):
+    """Return connection with a synthetic flattened table, 2 samples per subject, 2 sequencing per sample."""
+    conn = sqlite3.connect(':memory:')
+    conn.execute("create table flattened (project_id, anvil_project_id, subject_id, sample_id, sequencing_id, ga4gh_drs_uri);")
+    conn.executemany("insert into flattened values (?, ?, ?, ?, ?, ?);", [
+        (f"project-{p}", f"anvil-{p}", f"subject-{p}-{i // 4}", f"sample-{p}-{i // 2}", f"sequencing-{p}-{i}", f"drs://{p}/{i}" if i % 10 else None)
+        for p in range(projects) for i in range(rows_per_project)
+    ])
+    return conn
+
+
+def test_summarize_matches_self_join():
+    """The grouped pass gives the counts the self join did."""
+    conn = flattened(200)
+    conn.execute(LEGACY_SUMMARY)
+    summarize(conn)
+    summary = conn.execute("select * from summary order by project_id").fetchall()
+    assert summary == conn.execute("select * from legacy_summary order by project_id").fetchall()
+    assert summary[0] == ('project-0', 'anvil-0', 50, 100, 200, 180)
+
+
+def test_summarize_approximate():
+    """Sketch counts are within a few percent."""
+    conn = flattened(20000)
+    summarize(conn)
+    exact = conn.execute("select * from summary order by project_id").fetchall()
+    summarize(conn, approximate=True)
+    approximate = conn.execute("select * from summary order by project_id").fetchall()
+    assert len(exact) == len(approximate) == 3
+    for e, a in zip(exact, approximate):
+        assert e[:2] == a[:2]
+        for expected, actual in zip(e[2:], a[2:]):
+            assert abs(expected - actual) / expected < 0.03
+
+
+def test_hyperloglog_merge():
+    """Merged sketches count the union."""
+    a, b = HyperLogLog(), HyperLogLog()
+    for i in range(5000):
+        a.add(i)
+        b.add(i + 2500)
+    a.add(None)
+    a.update(b)
+    assert abs(len(a) - 7500) / 7500 < 0.03
@@ -0,0 +1,191 @@
+"""Test cached, proactively refreshed tokens."""
+
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from anvil.clients.gen3_auth import Gen3TerraAuth
+from anvil.clients.smart_auth import GoogleFHIRAuth
+from anvil.clients.token_provider import TokenProvider, gcloud_provider
+from anvil.fhir import smart_auth as legacy_smart_auth
+
+
+def _gcloud_stub(tmp_path, token_expiry='2099-01-01T00:00:00Z'):
+    """Write a stub gcloud binary printing config-helper json with token-<n>, n counts invocations.
+
+    Tokens expire at token_expiry, unless refreshed with --force-auth-refresh.
+    """
+    counter = tmp_path / 'count'
+    counter.write_text('0')
+    path = tmp_path / 'gcloud'
+    path.write_text(f"""#!/bin/sh
+n=$(( $(cat {counter}) + 1 ))
+echo $n > {counter}
+expiry={token_expiry}
+case "$*" in *--force-auth-refresh*) expiry=2099-01-01T00:00:00Z ;; esac
+echo '{{"credential": {{"access_token": "token-'$n'", "token_expiry": "'$expiry'"}}}}'
+""")
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def gcloud(tmp_path):
+    """Stub gcloud binary, see _gcloud_stub."""
+    return _gcloud_stub(tmp_path)
+
+
+def _counting_fetch(lifetime=60, delay=0.05):
+    """Return fetch function and list of calls."""
+    calls = []
+
+    def _fetch():
+        time.sleep(delay)
+        calls.append(1)
+        return f"token-{len(calls)}", time.time() + lifetime
+
+    return _fetch, calls
+
+
+def test_coalesced_fetch_and_invalidate():
+    """Concurrent callers share one fetch, a 401 storm triggers one refresh."""
+    fetch, calls = _counting_fetch()
+    provider = TokenProvider(fetch, refresh_margin=1)
+    threads = [threading.Thread(target=provider.token) for _ in range(10)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert len(calls) == 1
+    assert provider.token() == 'token-1'
+
+    for _ in range(10):
+        provider.invalidate('token-1')
+    threads = [threading.Thread(target=provider.token) for _ in range(10)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert len(calls) == 2
+    assert provider.token() == 'token-2'
+
+
+def test_background_refresh():
+    """Tokens about to expire are replaced without blocking callers."""
+    fetch, calls = _counting_fetch(lifetime=1.5, delay=0.2)
+    provider = TokenProvider(fetch, refresh_margin=1)
+    assert provider.token() == 'token-1'
+    time.sleep(0.6)
+    start = time.time()
+    assert provider.token() == 'token-1', "current token is still valid"
+    assert time.time() - start < 0.1, "refresh should not block"
+    time.sleep(0.4)
+    assert provider.token() == 'token-2'
+    assert provider.stats['background_refreshes'] == 1
+
+
+def test_google_fhir_auth(gcloud):
+    """Google tokens should come from the (stub) gcloud binary, once, valid until the expiry it reports."""
+    provider = gcloud_provider(gcloud=gcloud)
+    auth = GoogleFHIRAuth(token_provider=provider)
+    assert auth.signed_headers({})['Authorization'] == 'Bearer token-1'
+    assert provider.expires_at == datetime(2099, 1, 1, tzinfo=timezone.utc).timestamp()
+    assert GoogleFHIRAuth(token_provider=provider).access_token == 'token-1'
+    provider.invalidate('token-1')
+    assert auth.signed_headers({})['Authorization'] == 'Bearer token-2'
+    # the legacy module signs with the same provider rather than running gcloud per request
+    assert legacy_smart_auth.GoogleFHIRAuth is GoogleFHIRAuth
+
+
+def test_gcloud_force_refresh(tmp_path):
+    """A cached gcloud token is refreshed once, rather than re-read on every call, when it is about to expire."""
+    expiring = (datetime.now(timezone.utc) + timedelta(seconds=60)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    provider = gcloud_provider(gcloud=_gcloud_stub(tmp_path, expiring))
+    for _ in range(3):
+        assert provider.token() == 'token-2'
+    assert (tmp_path / 'count').read_text().strip() == '2'
+    assert provider.expires_at == datetime(2099, 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+def test_gen3_terra_auth(gcloud):
+    """Fence tokens are cached until they are about to expire."""
+    calls = []
+
+    class TerraHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            calls.append(self.headers['Authorization'])
+            expires_at = (datetime.now() + timedelta(hours=1)).isoformat()
+            data = json.dumps({'token': f"fence-{len(calls)}", 'expires_at': expires_at}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TerraHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        auth = Gen3TerraAuth(
+            endpoint='http://localhost', terra_auth_url=f"http://127.0.0.1:{server.server_port}/",
+            gcloud_token_provider=TokenProvider(lambda: ('google', time.time() + 3600))
+        )
+        for _ in range(3):
+            request = auth(requests.Request('GET', 'http://localhost/').prepare())
+            assert request.headers['Authorization'] == 'Bearer fence-1'
+        assert calls == ['Bearer google']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_preflight_and_held_requests():
+    """Tokens about to expire are replaced before use, requests during a refresh wait for it."""
+    fetch, calls = _counting_fetch(lifetime=1, delay=0.2)
+    provider = TokenProvider(fetch, refresh_margin=0, preflight_margin=0.5)
+    # requests waiting for the first token couldn't have failed, they aren't counted
+    threads = [threading.Thread(target=provider.preflight) for _ in range(5)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert provider.preflight() == 'token-1'
+    assert provider.stats['held'] == 0
+    time.sleep(0.6)
+    # still valid, but not for long enough to sign a request
+    assert provider.token() == 'token-1'
+    threads = [threading.Thread(target=provider.preflight) for _ in range(5)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert len(calls) == 2
+    # each request is counted once, as a preflight refresh, even if it also waited for the refresh
+    assert provider.stats['preflight_refreshes'] == 5
+    assert provider.stats['held'] == 0
+    assert provider.retries_avoided == 5
+
+    # expired, the first request fetches and the others are held until it is done
+    time.sleep(1)
+    threads = [threading.Thread(target=provider.preflight) for _ in range(5)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert len(calls) == 3
+    assert provider.stats['preflight_refreshes'] == 5
+    assert provider.stats['held'] == 4
+    assert provider.retries_avoided == 9
+
+
+def test_no_replay_with_preflight(fhir_search_servers):
+    """An expiring token is refreshed before a large request, so its body is sent once."""
+    fetch, calls = _counting_fetch(lifetime=1, delay=0)
+    provider = TokenProvider(fetch, refresh_margin=0, preflight_margin=0.5)
+    auth = GoogleFHIRAuth(token_provider=provider)
+    server = fhir_search_servers()
+    session = requests.Session()
+    session.hooks['response'].append(auth.handle_401)
+    url = f"{server.base_url}Patient"
+    session.get(url, headers=auth.signed_headers({}))
+    time.sleep(0.6)
+    session.get(url, headers=auth.signed_headers({}))
+    assert [h['Authorization'] for h in server.headers] == ['Bearer token-1', 'Bearer token-2']
+    assert provider.stats['replays'] == 0
+    assert provider.retries_avoided == 1
@@ -0,0 +1,46 @@
+"""Test incremental transform manifest."""
+
+from types import SimpleNamespace
+
+from anvil.util.transform_manifest import TransformManifest, workspace_input_hash
+
+
+def _workspace(size=1):
+    """Create minimal workspace graph."""
+    sample = SimpleNamespace(attributes={'name': 's1'}, blobs={'gs://b/f.cram': {'name': 'gs://b/f.cram', 'size': size}})
+    subject = SimpleNamespace(attributes={'name': 'p1'}, samples=[sample])
+    return SimpleNamespace(attributes={'workspace': {'name': 'w'}}, subjects=[subject])
+
+
+def test_input_hash():
+    """Hash should only change when inputs change."""
+    assert workspace_input_hash(_workspace()) == workspace_input_hash(_workspace())
+    assert workspace_input_hash(_workspace()) != workspace_input_hash(_workspace(size=2))
+    assert workspace_input_hash(_workspace()) != workspace_input_hash(_workspace(), {'dataUseRestriction': 'GRU'})
+
+
+def test_manifest(tmp_path):
+    """Should skip unchanged workspaces and report changed resources."""
+    path = str(tmp_path / 'manifest.sqlite')
+    input_hash = workspace_input_hash(_workspace())
+    patient = {'resourceType': 'Patient', 'id': 'p1'}
+    specimen = {'resourceType': 'Specimen', 'id': 's1'}
+
+    manifest = TransformManifest(path)
+    assert not manifest.is_unchanged('w', input_hash)
+    manifest.start_workspace('w')
+    assert manifest.record_resource('w', 'w/protected/Patient.json', patient)
+    assert manifest.record_resource('w', 'w/protected/Specimen.json', specimen)
+    manifest.finish_workspace('w', input_hash)
+    manifest.close()
+
+    manifest = TransformManifest(path)
+    assert manifest.is_unchanged('w', input_hash)
+    manifest.start_workspace('w')
+    assert not manifest.record_resource('w', 'w/protected/Patient.json', patient)
+    assert manifest.record_resource('w', 'w/protected/Patient.json', dict(patient, gender='female'))
+    manifest.finish_workspace('w', 'new-hash')
+    changes = manifest.write_changes(str(tmp_path / 'changes.json'))
+    assert changes['upserted'] == [{'resourceType': 'Patient', 'id': 'p1', 'file_path': 'w/protected/Patient.json'}]
+    assert changes['deleted'] == [{'resourceType': 'Specimen', 'id': 's1', 'file_path': 'w/protected/Specimen.json'}]
+    assert changes['files'] == ['w/protected/Patient.json', 'w/protected/Specimen.json']
@@ -0,0 +1,90 @@
+"""Test shared HTTP transport."""
+
+import gzip
+import json
+import gc
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from anvil.clients.transport import auth_session, new_session
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    """Echo request headers and decompressed body size."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        """Return what we received."""
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.ports.add(self.client_address[1])
+        data = json.dumps({'encoding': self.headers.get('Content-Encoding'), 'size': len(body)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        """Quiet."""
+        pass
+
+
+@pytest.fixture
+def echo_server():
+    """Run an echo server on a random port."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+    server.ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_gzip_and_keep_alive(echo_server):
+    """Large bodies should be compressed, connections re-used."""
+    url = f"http://127.0.0.1:{echo_server.server_port}/"
+    session = new_session(pool_maxsize=2, gzip_min_size=1024)
+    small = session.post(url, data='x' * 10).json()
+    assert small == {'encoding': None, 'size': 10}
+    large = session.post(url, data='x' * 4096).json()
+    assert large == {'encoding': 'gzip', 'size': 4096}
+    for _ in range(5):
+        session.post(url, data='x')
+    assert len(echo_server.ports) == 1, "sequential requests should share one connection"
+
+
+class FakeAuth:
+    """Authenticator with a 401 hook."""
+
+    def __init__(self):
+        """Start without responses."""
+        self.responses = []
+
+    def handle_401(self, response, **kwargs):
+        """Record response, pass it through."""
+        self.responses.append(response)
+        return response
+
+
+def test_auth_session_lifetime():
+    """An authenticator's session is shared, per cache, and released with the authenticator."""
+    auth, other, cache = FakeAuth(), FakeAuth(), object()
+    session = auth_session(auth)
+    assert auth_session(auth) is session
+    assert auth_session(auth, cache) is not session
+    assert auth_session(other) is not session
+    assert [hook('response') for hook in session.hooks['response']] == ['response']
+    assert auth.responses == ['response']
+    assert auth_session() is auth_session()
+    assert not hasattr(auth, '_anvil_sessions')
+    released = weakref.ref(session), weakref.ref(auth)
+    del auth, session
+    gc.collect()
+    assert [ref() for ref in released] == [None, None]